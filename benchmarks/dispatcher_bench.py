@@ -0,0 +1,211 @@
+import argparse
+import asyncio
+import contextvars
+import inspect
+import itertools
+import json
+import logging
+import random
+import re
+import time
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
+from typing import Dict
+
+from aiogram import Bot, Dispatcher, types
+
+import bot as app
+from benchmarks.seed import seed, seeded_admins, seeded_users
+from benchmarks.stub import callback_update, install_stub, message_update, percentile
+from database.db import Database, db, init_db, close_db
+
+# Прогон смешанной нагрузки через Dispatcher из bot.py с теми же хендлерами и middleware (дедупликация,
+# троттлинг, метрики): апдейты подаются в dp.updates_handler, как при polling и webhook, Bot API заменён
+# заглушкой. Для каждого хендлера считаются задержки и число обращений к Database.
+# Запуск из корня проекта:
+#   python -m benchmarks.dispatcher_bench --seed --users 10000 --messages 1000000 --ops 5000
+
+current_step: contextvars.ContextVar[str] = contextvars.ContextVar('current_step', default='-')
+
+SCENARIOS = {
+    "start": 10,
+    "write_message": 30,
+    "dialog_history": 15,
+    "all_dialogs": 15,
+    "show_dialog": 20,
+    "reply": 10,
+}
+
+class DbCounter:
+    # Оборачивает публичные методы Database и выдачу соединений, складывая счётчики по текущему шагу
+    def __init__(self, database: Database):
+        self.methods: Dict[str, Counter] = defaultdict(Counter)
+        self.queries: Counter = Counter()
+        for name, method in inspect.getmembers(database, inspect.iscoroutinefunction):
+            if not name.startswith('_'):
+                setattr(database, name, self._wrap(name, method))
+        database._read = self._wrap_cm(database._read)
+        database._write = self._wrap_cm(database._write)
+
+    def _wrap(self, name, method):
+        async def wrapper(*args, **kwargs):
+            self.methods[current_step.get()][name] += 1
+            return await method(*args, **kwargs)
+        return wrapper
+
+    def _wrap_cm(self, factory):
+        @asynccontextmanager
+        async def wrapper(*args, **kwargs):
+            self.queries[current_step.get()] += 1
+            async with factory(*args, **kwargs) as conn:
+                yield conn
+        return wrapper
+
+class Runner:
+    def __init__(self, dp: Dispatcher, stub, users, admins, pages: int, first_update_id: int = 1):
+        self.dp = dp
+        self.stub = stub
+        self.users = users
+        self.admins = admins
+        self.pages = pages
+        self.admin_locks = {admin_id: asyncio.Lock() for admin_id in admins}
+        # Повторный прогон на той же БД продолжает нумерацию, иначе дедупликация отбросит все апдейты
+        self.update_ids = itertools.count(first_update_id)
+        self.latencies: Dict[str, list] = defaultdict(list)
+        self.errors: Counter = Counter()
+
+    async def feed(self, step: str, payload: dict) -> None:
+        token = current_step.set(step)
+        started = time.perf_counter()
+        try:
+            # Как и при polling, каждый апдейт — отдельная задача: aiogram кэширует состояние FSM в contextvars
+            await asyncio.create_task(self.dp.updates_handler.notify(types.Update(**payload)))
+        except Exception as e:
+            self.errors[step] += 1
+            # Первая ошибка хендлера — с трассировкой: прогон с ошибками меряет не то, что нужно
+            if self.errors[step] == 1:
+                logging.warning("%s: ошибка хендлера", step, exc_info=True)
+            else:
+                logging.debug("%s: %r", step, e)
+        finally:
+            self.latencies[step].append(time.perf_counter() - started)
+            current_step.reset(token)
+
+    def message(self, user_id: int, text: str) -> dict:
+        return message_update(next(self.update_ids), user_id, text)
+
+    def callback(self, user_id: int, data: str) -> dict:
+        return callback_update(next(self.update_ids), user_id, data)
+
+    async def scenario(self, name: str, rnd: random.Random, user_id: int) -> None:
+        if name == "start":
+            await self.feed("start_cmd", self.message(user_id, "/start"))
+        elif name == "write_message":
+            await self.feed("start_message", self.callback(user_id, "write_message"))
+            await self.feed("process_message", self.message(user_id, f"Нагрузочное сообщение {rnd.random()}"))
+        elif name == "dialog_history":
+            await self.feed("show_dialog_history", self.callback(user_id, "dialog_history"))
+        else:
+            admin_id = rnd.choice(self.admins)
+            async with self.admin_locks[admin_id]:
+                await self.admin_scenario(name, rnd, admin_id)
+
+    async def admin_scenario(self, name: str, rnd: random.Random, admin_id: int) -> None:
+        if name == "all_dialogs":
+            await self.feed("show_all_dialogs", self.callback(admin_id, "all_dialogs"))
+            for _ in range(rnd.randint(0, self.pages)):
+                match = re.search(r'"(page_o_\d+)"', self.stub.last_markup.get(admin_id, ""))
+                if not match:
+                    break
+                await self.feed("process_page_change", self.callback(admin_id, match.group(1)))
+        elif name == "show_dialog":
+            await self.feed("show_dialog", self.callback(admin_id, f"dialog_{rnd.choice(self.users)}"))
+        elif name == "reply":
+            user_id = rnd.choice(self.users)
+            await self.feed("reply_to_user", self.callback(admin_id, f"reply_{user_id}"))
+            await self.feed("process_admin_reply", self.message(admin_id, f"Ответ {rnd.random()}"))
+
+    async def worker(self, worker_id: int, ops: int) -> None:
+        rnd = random.Random(worker_id)
+        names, weights = zip(*SCENARIOS.items())
+        # У каждого воркера свой срез пользователей, чтобы их FSM не пересекались
+        users = self.users[worker_id::self.concurrency] or self.users
+        for _ in range(ops):
+            await self.scenario(rnd.choices(names, weights)[0], rnd, rnd.choice(users))
+
+    async def run(self, ops: int, concurrency: int) -> float:
+        self.concurrency = concurrency
+        started = time.perf_counter()
+        per_worker = [ops // concurrency + (1 if i < ops % concurrency else 0) for i in range(concurrency)]
+        await asyncio.gather(*(self.worker(i, n) for i, n in enumerate(per_worker)))
+        return time.perf_counter() - started
+
+def report(runner: Runner, counter: DbCounter, elapsed: float) -> dict:
+    total = sum(len(samples) for samples in runner.latencies.values())
+    result = {"updates": total, "elapsed": elapsed, "throughput": total / elapsed if elapsed else 0, "handlers": {}}
+    print(f"\nАпдейтов: {total} за {elapsed:.2f} с ({result['throughput']:.0f} upd/s)")
+    print(f"{'хендлер':22} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'db/op':>6} {'conn/op':>7} {'err':>4}")
+    for step, samples in sorted(runner.latencies.items()):
+        n = len(samples)
+        stats = {
+            "n": n,
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p95_ms": percentile(samples, 95) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000,
+            "db_calls_per_op": sum(counter.methods[step].values()) / n,
+            "connections_per_op": counter.queries[step] / n,
+            "db_calls": dict(counter.methods[step]),
+            "errors": runner.errors[step],
+        }
+        result["handlers"][step] = stats
+        print(
+            f"{step:22} {n:6} {stats['p50_ms']:8.2f} {stats['p95_ms']:8.2f} {stats['p99_ms']:8.2f} "
+            f"{stats['db_calls_per_op']:6.1f} {stats['connections_per_op']:7.1f} {stats['errors']:4}"
+        )
+    print("Вызовы Bot API:", dict(runner.stub.calls))
+    errors = sum(runner.errors.values())
+    if errors:
+        print(f"ВНИМАНИЕ: ошибок в хендлерах: {errors}, задержки этих шагов недостоверны")
+    return result
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default='bench_feedback.db')
+    parser.add_argument('--seed', action='store_true', help="пересоздать и наполнить БД перед прогоном")
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--admins', type=int, default=5)
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--ops', type=int, default=2000, help="число сценариев")
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--pages', type=int, default=5, help="максимальная глубина листания списка диалогов")
+    parser.add_argument('--latency', type=float, default=0.0, help="имитация задержки Bot API, секунды")
+    parser.add_argument('--json', help="сохранить результат в файл для сравнения прогонов")
+    args = parser.parse_args()
+
+    if args.seed:
+        await seed(args.db, args.users, args.admins, args.messages)
+
+    stub = install_stub(app.bot, args.latency)
+    Bot.set_current(app.bot)
+    Dispatcher.set_current(app.dp)
+    db.db_name = args.db
+    db.archive_name = db.archive_name and args.db + '.archive'
+    await init_db()
+    app.setup_dispatcher()
+    counter = DbCounter(db)
+
+    runner = Runner(app.dp, stub, seeded_users(args.users), seeded_admins(args.admins), args.pages,
+                    first_update_id=(await db.get_last_update_id() or 0) + 1)
+    elapsed = await runner.run(args.ops, args.concurrency)
+    result = report(runner, counter, elapsed)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    await app.dp.storage.close()
+    await close_db()
+    if sum(runner.errors.values()):
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import time
+from typing import List, Tuple
+
+from database.db import Database, config
+from database.migrations import BACKFILL_ASSIGNMENTS_SQL, REBUILD_CONVERSATIONS_SQL
+
+# Массовое наполнение БД для бенчмарков: пользователи, админы и переписка.
+# Схема создаётся обычным Database.init, строки вставляются пачками через sqlite3 без WAL-fsync на каждую.
+
+USER_ID_BASE = 30_000_000
+ADMIN_ID_BASE = 20_000_000
+
+def seeded_admins(admins: int) -> List[int]:
+    return list(config['ADMIN_IDS']) + [ADMIN_ID_BASE + i for i in range(max(0, admins - len(config['ADMIN_IDS'])))]
+
+def seeded_users(users: int) -> List[int]:
+    return [USER_ID_BASE + i for i in range(users)]
+
+def _message_rows(user_ids: List[int], admin_ids: List[int], count: int, seed: int):
+    rnd = random.Random(seed)
+    # По сообщению в секунду, последнее — сейчас, чтобы выборки по датам и архивация видели реальный разброс
+    started_ms = int(time.time() * 1000) - count * 1000
+    for i in range(count):
+        date = started_ms + i * 1000
+        user_id = rnd.choice(user_ids)
+        admin_id = admin_ids[user_id % len(admin_ids)]
+        from_id, to_id = (user_id, admin_id) if rnd.random() < 0.8 else (admin_id, user_id)
+        yield from_id, to_id, "Сообщение " + str(rnd.random()), date, min(from_id, to_id), max(from_id, to_id)
+
+def _batches(rows, size: int):
+    batch: List[Tuple] = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def seed(path: str, users: int, admins: int, messages: int, batch_size: int = 50_000, rnd_seed: int = 42) -> None:
+    for suffix in ("", "-wal", "-shm", ".archive", ".archive-wal", ".archive-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    database = Database(path)
+    await database.init()
+    await database.close()
+
+    admin_ids = seeded_admins(admins)
+    user_ids = seeded_users(users)
+    started = time.perf_counter()
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous = OFF")
+    now = int(time.time() * 1000)
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, username, full_name, registration_date, is_admin) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, f"user{user_id}", f"User {user_id}", now, 0) for user_id in user_ids]
+            + [(admin_id, f"admin{admin_id}", f"Admin {admin_id}", now, 1) for admin_id in admin_ids]
+        )
+    inserted = 0
+    for batch in _batches(_message_rows(user_ids, admin_ids, messages, rnd_seed), batch_size):
+        with conn:
+            conn.executemany(
+                "INSERT INTO messages (from_id, to_id, message, date, peer_a, peer_b) VALUES (?, ?, ?, ?, ?, ?)",
+                batch
+            )
+        inserted += len(batch)
+        print(f"\rСообщений: {inserted}/{messages}", end="", flush=True)
+    print()
+    with conn:
+        conn.execute(REBUILD_CONVERSATIONS_SQL)
+        conn.execute(BACKFILL_ASSIGNMENTS_SQL)
+    conn.execute("ANALYZE")
+    conn.close()
+    print(f"Готово за {time.perf_counter() - started:.1f} с: {users} пользователей, {len(admin_ids)} админов, {messages} сообщений")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default='bench_feedback.db')
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--admins', type=int, default=5)
+    parser.add_argument('--messages', type=int, default=100_000)
+    args = parser.parse_args()
+    asyncio.run(seed(args.db, args.users, args.admins, args.messages))
+
+if __name__ == '__main__':
+    main()
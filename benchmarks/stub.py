@@ -0,0 +1,81 @@
+import asyncio
+import itertools
+import time
+from collections import Counter
+from typing import Dict, Optional
+
+from aiogram import Bot
+
+# Заглушка Bot API: подменяет Bot.request, поэтому хендлеры, Dispatcher и FSM работают как в бою,
+# но без сети. latency имитирует время ответа Telegram.
+
+class StubSession:
+    def __init__(self, bot: Bot, latency: float = 0.0):
+        self.bot = bot
+        self.latency = latency
+        self.calls: Counter = Counter()
+        # Последняя клавиатура в каждом чате — по ней бенчмарк находит курсоры пагинации
+        self.last_markup: Dict[int, str] = {}
+        self._message_ids = itertools.count(1000)
+
+    async def request(self, method: str, data: Optional[Dict] = None, files: Optional[Dict] = None, **kwargs):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        data = data or {}
+        if data.get('reply_markup') and data.get('chat_id'):
+            self.last_markup[int(data['chat_id'])] = data['reply_markup']
+        if method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            return {
+                "message_id": int(data.get('message_id') or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": int(data.get('chat_id') or 0), "type": "private"},
+                "text": data.get('text', ''),
+            }
+        if method == 'getMe':
+            return {"id": 1, "is_bot": True, "first_name": "feedback", "username": "feedback_bot"}
+        return True
+
+def install_stub(bot: Bot, latency: float = 0.0) -> StubSession:
+    session = StubSession(bot, latency)
+    bot.request = session.request
+    return session
+
+def user_payload(user_id: int) -> Dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+def message_update(update_id: int, user_id: int, text: str) -> Dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": user_payload(user_id),
+        "text": text,
+    }
+    if text.startswith('/'):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+def callback_update(update_id: int, user_id: int, data: str, message_id: int = 1) -> Dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user_payload(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "feedback"},
+                "text": "menu",
+            },
+        },
+    }
+
+def percentile(samples, p: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
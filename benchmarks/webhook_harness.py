@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import itertools
+import logging
+import time
+from collections import defaultdict
+
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestServer
+
+import bot as app
+from benchmarks.stub import callback_update, install_stub, message_update, percentile
+from database.db import db, init_db, close_db
+
+# Локальная проверка webhook-режима: поднимает aiohttp-приложение из bot.create_webhook_app
+# на случайном порту и шлёт в него синтетические Update, Telegram заменён заглушкой.
+# Хендлеры, middleware и доставка уведомлений через outbox — те же, что у бота.
+# Запуск из корня проекта: python -m benchmarks.webhook_harness --users 200
+
+def user_script(user_id: int):
+    yield "start", message_update, "/start"
+    yield "write_message", callback_update, "write_message"
+    yield "message", message_update, f"Сообщение от {user_id}"
+    yield "dialog_history", callback_update, "dialog_history"
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default='bench_feedback.db')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.0, help="имитация задержки Bot API, секунды")
+    args = parser.parse_args()
+
+    logging.getLogger('aiohttp.access').setLevel(logging.WARNING)
+    stub = install_stub(app.bot, args.latency)
+    db.db_name = args.db
+    db.archive_name = db.archive_name and args.db + '.archive'
+    await init_db()
+    app.setup_dispatcher()
+    app.outbox.start(app.bot)
+    for admin_id in app.config['ADMIN_IDS']:
+        await db.add_user(admin_id, f"admin{admin_id}", f"Admin {admin_id}")
+
+    webhook_app = app.create_webhook_app()
+    webhook_app.middlewares.append(app.check_secret)
+    server = TestServer(webhook_app)
+    await server.start_server()
+    url = server.make_url(app.config.get('WEBHOOK_PATH', '/webhook'))
+    headers = {}
+    if app.config.get('WEBHOOK_SECRET'):
+        headers['X-Telegram-Bot-Api-Secret-Token'] = app.config['WEBHOOK_SECRET']
+
+    # Повторный прогон на той же БД продолжает нумерацию, иначе дедупликация и ключ update_id
+    # у сохранённых сообщений отбросят часть апдейтов
+    update_ids = itertools.count((await db.get_last_update_id() or 0) + 1)
+    latencies = defaultdict(list)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run_user(session: ClientSession, user_id: int):
+        # Шаги одного пользователя идут по порядку (FSM), разные пользователи — параллельно
+        async with semaphore:
+            for name, factory, payload in user_script(user_id):
+                started = time.perf_counter()
+                async with session.post(url, json=factory(next(update_ids), user_id, payload), headers=headers) as resp:
+                    await resp.read()
+                    if resp.status != 200:
+                        print(f"{name}: HTTP {resp.status}")
+                latencies[name].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*(run_user(session, 10_000_000 + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    total = sum(len(samples) for samples in latencies.values())
+    print(f"Апдейтов: {total} за {elapsed:.2f} с ({total / elapsed:.0f} upd/s)")
+    for name, samples in latencies.items():
+        print(
+            f"{name:16} n={len(samples):6} "
+            f"p50={percentile(samples, 50) * 1000:7.2f} ms "
+            f"p95={percentile(samples, 95) * 1000:7.2f} ms "
+            f"p99={percentile(samples, 99) * 1000:7.2f} ms"
+        )
+    print("Вызовы Bot API:", dict(stub.calls))
+
+    await server.close()
+    await app.outbox.stop()
+    await app.dp.storage.close()
+    await close_db()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,12 +1,24 @@
 import asyncio
 import json
 import logging
+import os
 from aiogram import Bot, Dispatcher
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.webhook import get_new_configured_app
+from aiohttp import web
 
 from handlers.user_handlers import register_user_handlers
 from handlers.admin_handlers import register_admin_handlers
-from database.db import init_db
+from database.db import db, init_db, close_db
+from states.storage import SQLiteStorage
+from utils.outbox import limiter, outbox
+from utils.metrics import metrics
+from utils.broadcast import broadcaster
+from utils.retention import retention
+from utils.export import wait_exports
+from utils.throttling import throttling
+from utils.dedup import dedup
+from utils.tracing import tracer
+from utils.workers import Supervisor, serve
 
 logging.basicConfig(level=logging.INFO)
 
@@ -14,17 +26,153 @@ with open('config.json', 'r') as f:
     config = json.load(f)
 
 bot = Bot(token=config['BOT_TOKEN'])
-storage = MemoryStorage()
+storage = SQLiteStorage(
+    db,
+    state_ttl=config.get('FSM_STATE_TTL', 86400),
+    cache_size=config.get('FSM_CACHE_SIZE', 10000)
+)
 dp = Dispatcher(bot, storage=storage)
 
-async def main():
-    await init_db()
+def create_webhook_app() -> web.Application:
+    return get_new_configured_app(dp, config.get('WEBHOOK_PATH', '/webhook'))
+
+@web.middleware
+async def check_secret(request: web.Request, handler):
+    # Telegram присылает секрет из set_webhook в заголовке — чужие POST отбрасываем
+    secret = config.get('WEBHOOK_SECRET')
+    if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+        return web.Response(status=403)
+    return await handler(request)
+
+async def run_webhook(app: web.Application):
+    # Общий запуск webhook для одного процесса и для супервизора: проверка секрета, сервер, регистрация в Telegram.
+    # aiohttp обрабатывает каждый POST в своей задаче, так что апдейты идут параллельно
+    app.middlewares.append(check_secret)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, config.get('WEBAPP_HOST', '127.0.0.1'), config.get('WEBAPP_PORT', 8080))
+    await site.start()
+    await bot.set_webhook(
+        config['WEBHOOK_URL'],
+        max_connections=config.get('WEBHOOK_MAX_CONNECTIONS', 40),
+        secret_token=config.get('WEBHOOK_SECRET') or None
+    )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await bot.delete_webhook()
+        await runner.cleanup()
+
+def setup_dispatcher():
+    # Хендлеры и middleware — общие для бота и бенчмарка dispatcher_bench
     register_user_handlers(dp)
     register_admin_handlers(dp)
+    # Дедупликация — первой: повторно доставленный апдейт не должен тратить лимиты пользователя
+    dp.middleware.setup(dedup)
+    tracer.setup(dp)
+    dp.middleware.setup(throttling)
+    metrics.setup(dp)
+
+async def start_services(index: int = 0, workers: int = 1):
+    await init_db()
+    setup_dispatcher()
+    metrics.instrument_database(db)
+    metrics.instrument_bot(bot)
+    metrics.instrument_throttling(throttling)
+    metrics.instrument_dedup(dedup)
+    tracer.instrument_database(db)
+    tracer.instrument_bot(bot)
+    await metrics.start()
+    await tracer.start()
+    outbox.start(bot)
+    # Только для лога: смещение getUpdates из него не берём. Апдейты одной пачки обрабатываются параллельно,
+    # и после падения апдейт с меньшим id мог остаться необработанным — Telegram доставит его снова,
+    # а уже обработанные отсеет дедупликация
+    last_update_id = await db.get_last_update_id()
+    if last_update_id is not None:
+        logging.info("Последний обработанный апдейт: %s", last_update_id)
+    # Рассылки и архивация должны идти в одном экземпляре на все процессы
+    broadcaster.owner = index == 0
+    if index == 0:
+        broadcaster.watch(bot)
+        retention.start()
+
+async def stop_services():
+    await retention.stop()
+    await broadcaster.stop()
+    await outbox.stop()
+    await wait_exports(timeout=30)
+    await metrics.stop()
+    await tracer.stop()
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    await close_db()
+    # Воркер, не сделавший ни одного запроса к Bot API, сессию так и не создал
+    if bot.session is not None:
+        await bot.session.close()
+
+async def run_worker_process(index: int, workers: int, inbox, events, heartbeat_interval: float):
+    # Процесс-воркер в режиме WORKERS > 1: свой диспетчер, пул соединений и кэши, апдейты приходят от супервизора
+    if metrics.port:
+        metrics.port += 1 + index
+    # Каждый воркер пишет трассы в свой файл: feedback_trace.json → feedback_trace.0.json, ...
+    root, ext = os.path.splitext(tracer.path)
+    tracer.path = f"{root}.{index}{ext}"
+    # Outbox доставляет только в свои чаты, а общий лимит Bot API делится между воркерами поровну
+    outbox.shard = (index, workers)
+    bucket = limiter.global_bucket
+    bucket.rate /= workers
+    bucket.capacity /= workers
+    bucket.tokens = min(bucket.tokens, bucket.capacity)
+    await start_services(index, workers)
     try:
-        await dp.start_polling()
+        await serve(dp, db, index, inbox, events, heartbeat_interval)
     finally:
-        await bot.session.close()
+        await stop_services()
+
+def run_worker(index: int, workers: int, inbox, events, heartbeat_interval: float):
+    logging.basicConfig(level=logging.INFO, format=f"[worker {index}] %(levelname)s:%(name)s:%(message)s", force=True)
+    asyncio.run(run_worker_process(index, workers, inbox, events, heartbeat_interval))
+
+async def run_supervisor(workers: int):
+    # Миграции — до запуска воркеров, чтобы процессы не применяли их наперегонки
+    await init_db()
+    await close_db()
+    supervisor = Supervisor(
+        run_worker,
+        workers,
+        heartbeat_interval=config.get('WORKER_HEARTBEAT_INTERVAL', 5),
+        heartbeat_timeout=config.get('WORKER_HEARTBEAT_TIMEOUT', 30),
+        max_queue=config.get('WORKER_MAX_QUEUE', 1000),
+        report_interval=config.get('METRICS_LOG_INTERVAL', 300)
+    )
+    metrics.instrument_supervisor(supervisor)
+    await metrics.start()
+    supervisor.start()
+    try:
+        if config.get('MODE', 'polling') == 'webhook':
+            await run_webhook(supervisor.create_webhook_app(config.get('WEBHOOK_PATH', '/webhook')))
+        else:
+            await supervisor.poll(bot)
+    finally:
+        await supervisor.stop()
+        await metrics.stop()
+        if bot.session is not None:
+            await bot.session.close()
+
+async def main():
+    workers = config.get('WORKERS', 1)
+    if workers > 1:
+        await run_supervisor(workers)
+        return
+    await start_services()
+    try:
+        if config.get('MODE', 'polling') == 'webhook':
+            await run_webhook(create_webhook_app())
+        else:
+            await dp.start_polling()
+    finally:
+        await stop_services()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
@@ -1,17 +1,347 @@
 import aiosqlite
-import datetime
-from typing import List, Dict, Optional
+import asyncio
+import time
+import zlib
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Dict, Hashable, Optional, Tuple
 import json
 
+from database.cache import TTLCache
+from database.loader import DataLoader
+from database.migrations import migrate
+
 with open('config.json', 'r') as f:
     config = json.load(f)
 
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# Сколько id за раз подставляется в IN (...): старые сборки SQLite допускают не больше 999 параметров
+ID_CHUNK = 500
+
+# Сколько действует ключ идемпотентности update_id у сообщения. Telegram хранит недоставленные апдейты сутки,
+# а после недели без апдейтов может начать нумерацию заново — старое совпадение повтором не считается.
+UPDATE_KEY_TTL_MS = 24 * 3600 * 1000
+
+# С какой длины текст архивного сообщения сжимается zlib
+ZIP_MIN_SIZE = 256
+
+# (chat_id, text, reply_markup в JSON) — исходящее сообщение для outbox
+Outgoing = Tuple[int, str, Optional[str]]
+
+HISTORY_SQL = """
+    SELECT m.id, m.from_id, m.to_id, m.message, m.date, m.is_read, u.username, u.full_name, m.id
+    FROM messages m
+    JOIN users u ON m.from_id = u.user_id
+    WHERE m.peer_a = ? AND m.peer_b = ?{where}
+    ORDER BY m.id {order} LIMIT ?
+"""
+
+# Та же выборка по холодному архиву: длинные тексты хранятся сжатыми zlib и распаковываются функцией unzip
+ARCHIVE_HISTORY_SQL = """
+    SELECT m.id, m.from_id, m.to_id, unzip(m.message), m.date, m.is_read, u.username, u.full_name, m.id
+    FROM archive.messages m
+    JOIN users u ON m.from_id = u.user_id
+    WHERE m.peer_a = ? AND m.peer_b = ?{where}
+    ORDER BY m.id {order} LIMIT ?
+"""
+
+# История пользователя со всеми админами: ответственным, прежними и наблюдателями из ROUTING_WATCHERS
+USER_HISTORY_SQL = HISTORY_SQL.replace("m.peer_a = ? AND m.peer_b = ?", "(m.peer_a = ? OR m.peer_b = ?)")
+ARCHIVE_USER_HISTORY_SQL = ARCHIVE_HISTORY_SQL.replace("m.peer_a = ? AND m.peer_b = ?", "(m.peer_a = ? OR m.peer_b = ?)")
+
+ARCHIVE_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS archive.messages (
+        id INTEGER PRIMARY KEY,
+        from_id INTEGER,
+        to_id INTEGER,
+        message BLOB,
+        date,
+        is_read INTEGER,
+        peer_a INTEGER,
+        peer_b INTEGER,
+        date_legacy TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_conversation ON messages (peer_a, peer_b, id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_date ON messages (date)",
+)
+
+# Выгрузка сообщений с именами отправителя и получателя, keyset по id; {table} — messages или archive.messages
+EXPORT_SQL = """
+    SELECT m.id, m.date, m.from_id, fu.username, fu.full_name, m.to_id, tu.username, tu.full_name, {message}, m.is_read
+    FROM {table} m
+    LEFT JOIN users fu ON fu.user_id = m.from_id
+    LEFT JOIN users tu ON tu.user_id = m.to_id
+    WHERE m.id > ?{where}
+    ORDER BY m.id LIMIT ?
+"""
+
+EXPORT_COLUMNS = (
+    "id", "date", "from_id", "from_username", "from_full_name",
+    "to_id", "to_username", "to_full_name", "message", "is_read"
+)
+
+DIALOGS_SQL = """
+    SELECT u.user_id, u.username, u.full_name, c.unread_count, c.message_count, c.last_message_at, c.last_message_id
+    FROM conversations c
+    JOIN users u ON u.user_id = c.user_id
+    WHERE c.admin_id = ? AND u.is_admin = 0{where}
+    ORDER BY c.last_message_id {order} LIMIT ?
+"""
+
+def fts_query(text: str) -> str:
+    # Пользовательский ввод превращаем в набор префиксных термов, чтобы спецсимволы FTS5 не ломали запрос
+    terms = [term.replace('"', '""') for term in text.split()[:10]]
+    return " ".join(f'"{term}"*' for term in terms)
+
+def _zip(text: Optional[str]):
+    # Короткие сообщения zlib не уменьшает (заголовок и контрольная сумма съедают выигрыш) — они остаются текстом
+    if text is None or len(text) < ZIP_MIN_SIZE:
+        return text
+    data = text.encode()
+    packed = zlib.compress(data, 6)
+    return packed if len(packed) < len(data) else text
+
+def _unzip(value) -> Optional[str]:
+    return zlib.decompress(value).decode() if isinstance(value, bytes) else value
+
+async def _fetch(db: aiosqlite.Connection, sql: str, params: tuple) -> List:
+    async with db.execute(sql, params) as cursor:
+        return list(await cursor.fetchall())
+
+def _message_from_row(msg) -> Dict:
+    return {
+        "id": msg[0],
+        "from_id": msg[1],
+        "to_id": msg[2],
+        "message": msg[3],
+        "date": msg[4],
+        "is_read": msg[5],
+        "username": msg[6],
+        "full_name": msg[7]
+    }
+
+def _dialog_from_row(dialog) -> Dict:
+    return {
+        "user_id": dialog[0],
+        "username": dialog[1],
+        "full_name": dialog[2],
+        "unread_count": dialog[3],
+        "message_count": dialog[4],
+        "last_message_at": dialog[5]
+    }
+
+async def _keyset_page(db: aiosqlite.Connection, sql: str, key: str, params: tuple,
+                       older_than: Optional[int], newer_than: Optional[int], limit: int):
+    # Последний столбец выборки — ключ сортировки. Берём limit + 1 строку, чтобы узнать, есть ли следующая страница.
+    if newer_than is not None:
+        query = sql.format(where=f" AND {key} > ?", order="ASC")
+        async with db.execute(query, (*params, newer_than, limit + 1)) as cursor:
+            rows = list(await cursor.fetchall())
+        has_newer, has_older = len(rows) > limit, True
+        rows = rows[:limit][::-1]
+    else:
+        if older_than is not None:
+            query = sql.format(where=f" AND {key} < ?", order="DESC")
+            args = (*params, older_than, limit + 1)
+        else:
+            query = sql.format(where="", order="DESC")
+            args = (*params, limit + 1)
+        async with db.execute(query, args) as cursor:
+            rows = list(await cursor.fetchall())
+        has_newer, has_older = older_than is not None, len(rows) > limit
+        rows = rows[:limit]
+    if not rows:
+        return rows, None, None
+    return rows, rows[0][-1] if has_newer else None, rows[-1][-1] if has_older else None
+
 class Database:
-    def __init__(self, db_name: str = "feedback.db"):
+    def __init__(self, db_name: str = "feedback.db", readers: int = 4, cache_size: int = 10000, cache_ttl: float = 60.0,
+                 batch_size: int = 256, batch_window: float = 0.002, archive_name: Optional[str] = None):
         self.db_name = db_name
+        # Файл холодного архива сообщений, подключается к каждому соединению как схема archive
+        self.archive_name = archive_name
+        # Кэш флагов пользователей (is_admin, is_blocked) и списка админов, сбрасывается при каждой записи
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        # Одновременные одиночные чтения пользователей из разных хендлеров склеиваются в один запрос IN (...)
+        self._users_loader = DataLoader(self._load_users)
+        self._flags_loader = DataLoader(self._load_flags)
+        self._flags_generation = 0
+        # Счётчик сбросов кэша непрочитанных — как _flags_generation для флагов
+        self._unread_generation = 0
+        self.readers = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self._reader_pool: Optional[asyncio.Queue] = None
+        self._reader_conns: List[aiosqlite.Connection] = []
+        self.outbox_ready = asyncio.Event()
+        self.broadcasts_ready = asyncio.Event()
+        # Group commit: частые вставки (сообщения, пользователи) копятся в очереди и пишутся одной транзакцией
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self._batch_queue: Optional[asyncio.Queue] = None
+        self._batch_task: Optional[asyncio.Task] = None
+        # Вызывается с ключами кэша, которые изменила запись в этом процессе ("outbox" — новые исходящие).
+        # В режиме нескольких воркеров через него кэши остальных процессов узнают об изменениях.
+        self.on_change: Optional[Callable[[List[Hashable]], None]] = None
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_name)
+        for pragma in PRAGMAS:
+            await conn.execute(pragma)
+        if self.archive_name:
+            await conn.execute("ATTACH DATABASE ? AS archive", (self.archive_name,))
+            await conn.execute("PRAGMA archive.journal_mode = WAL")
+            await conn.execute("PRAGMA archive.synchronous = NORMAL")
+            await conn.create_function("zip", 1, _zip, deterministic=True)
+            await conn.create_function("unzip", 1, _unzip, deterministic=True)
+        return conn
+
+    async def open(self) -> None:
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            # Один писатель (SQLite всё равно сериализует запись) и N читателей — в WAL они не блокируют друг друга
+            self._writer = await self._connect()
+            pool = asyncio.Queue()
+            for _ in range(self.readers):
+                conn = await self._connect()
+                self._reader_conns.append(conn)
+                pool.put_nowait(conn)
+            self._reader_pool = pool
+            self._batch_queue = asyncio.Queue()
+            self._batch_task = asyncio.create_task(self._batch_writer())
+
+    async def close(self) -> None:
+        self.cache.clear()
+        if self._batch_task is not None:
+            # None — сигнал писателю закончить после того, как он запишет всё, что уже в очереди
+            queue = self._batch_queue
+            queue.put_nowait(None)
+            await self._batch_task
+            self._batch_task = None
+            # Операции, поставленные уже после сигнала, писатель не увидит — выполняем их здесь,
+            # иначе их future никогда не завершатся
+            while not queue.empty():
+                leftover = [item for item in (queue.get_nowait() for _ in range(queue.qsize())) if item is not None]
+                if leftover:
+                    await self._commit_batch(leftover)
+            # Запись после close() снова откроет соединения и запустит писателя, а не повиснет в старой очереди
+            self._batch_queue = None
+        async with self._write_lock:
+            for conn in self._reader_conns:
+                await conn.close()
+            self._reader_conns = []
+            self._reader_pool = None
+            if self._writer is not None:
+                await self._writer.close()
+                self._writer = None
+
+    @asynccontextmanager
+    async def _read(self):
+        if self._reader_pool is None:
+            await self.open()
+        conn = await self._reader_pool.get()
+        try:
+            yield conn
+        finally:
+            self._reader_pool.put_nowait(conn)
+
+    @asynccontextmanager
+    async def _write(self):
+        if self._writer is None:
+            await self.open()
+        async with self._write_lock:
+            try:
+                # Блокировку записи берём сразу: отложенная транзакция, начавшая с чтения, при записи из другого
+                # процесса получила бы SQLITE_BUSY без ожидания busy_timeout
+                await self._writer.execute("BEGIN IMMEDIATE")
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+    async def _batched(self, op: Callable[[aiosqlite.Connection], Awaitable[Any]]) -> Any:
+        # Ставит операцию в очередь group commit и ждёт, пока её транзакция будет зафиксирована
+        if self._batch_queue is None:
+            await self.open()
+        future = asyncio.get_running_loop().create_future()
+        self._batch_queue.put_nowait((op, future))
+        return await future
+
+    async def _batch_writer(self) -> None:
+        queue = self._batch_queue
+        stopping = False
+        while not stopping:
+            item = await queue.get()
+            if item is None:
+                break
+            batch = [item]
+            # Добираем всё, что пришло за batch_window, но не больше batch_size операций
+            deadline = asyncio.get_running_loop().time() + self.batch_window
+            while len(batch) < self.batch_size:
+                try:
+                    item = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - asyncio.get_running_loop().time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._commit_batch(batch)
+
+    async def _commit_batch(self, batch: List[Tuple[Callable, asyncio.Future]]) -> None:
+        results = []
+        async with self._write_lock:
+            db = self._writer
+            try:
+                await db.execute("BEGIN IMMEDIATE")
+                for op, future in batch:
+                    # Savepoint на каждую операцию: ошибка одной не откатывает остальные в пачке
+                    await db.execute("SAVEPOINT op")
+                    try:
+                        result = await op(db)
+                    except Exception as e:
+                        await db.execute("ROLLBACK TO op")
+                        await db.execute("RELEASE op")
+                        results.append((future, None, e))
+                    else:
+                        await db.execute("RELEASE op")
+                        results.append((future, result, None))
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                for op, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
 
     async def init(self):
-        async with aiosqlite.connect(self.db_name) as db:
+        await self.open()
+        async with self._write() as db:
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS users (
                     user_id INTEGER PRIMARY KEY,
@@ -32,16 +362,19 @@ class Database:
                     is_read INTEGER DEFAULT 0
                 )
             """)
-            await db.commit()
+            if self.archive_name:
+                for statement in ARCHIVE_SCHEMA:
+                    await db.execute(statement)
+            await migrate(db)
 
     async def add_user(self, user_id: int, username: str, full_name: str, is_admin: bool = False) -> None:
         # Если user_id находится в ADMIN_IDS из config.json, устанавливаем is_admin = True
         if user_id in config['ADMIN_IDS']:
             is_admin = True
-        async with aiosqlite.connect(self.db_name) as db:
+        async def op(db: aiosqlite.Connection) -> None:
             await db.execute(
                 "INSERT OR IGNORE INTO users (user_id, username, full_name, registration_date, is_admin) VALUES (?, ?, ?, ?, ?)",
-                (user_id, username, full_name, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), int(is_admin))
+                (user_id, username, full_name, int(time.time() * 1000), int(is_admin))
             )
             # Если пользователь уже существует, обновляем его статус, если он в ADMIN_IDS
             if user_id in config['ADMIN_IDS']:
@@ -49,125 +382,748 @@ class Database:
                     "UPDATE users SET is_admin = 1 WHERE user_id = ?",
                     (user_id,)
                 )
-            await db.commit()
+
+        await self._batched(op)
+        self._invalidate_user(user_id)
 
     async def get_user_info(self, user_id: int) -> Optional[Dict]:
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute(
-                    "SELECT user_id, username, full_name, registration_date, is_admin FROM users WHERE user_id = ?",
-                    (user_id,)
-            ) as cursor:
-                user = await cursor.fetchone()
-                if user:
-                    return {
-                        "user_id": user[0],
-                        "username": user[1],
-                        "full_name": user[2],
-                        "registration_date": user[3],
-                        "is_admin": bool(user[4])
-                    }
-                return None
+        return await self._users_loader.load(user_id)
+
+    async def get_users_info(self, user_ids: List[int]) -> Dict[int, Dict]:
+        # Пользователи одним запросом; отсутствующих в результате нет
+        users = await self._users_loader.load_many(user_ids)
+        return {user_id: user for user_id, user in users.items() if user is not None}
 
-    async def add_message(self, from_id: int, to_id: int, message: str) -> None:
-        async with aiosqlite.connect(self.db_name) as db:
+    async def _select_by_ids(self, sql: str, ids: List[int]) -> List:
+        # sql с {ids} на месте списка параметров; SQLite ограничивает их число, поэтому ids режутся на пачки
+        rows = []
+        async with self._read() as db:
+            for start in range(0, len(ids), ID_CHUNK):
+                chunk = ids[start:start + ID_CHUNK]
+                rows.extend(await _fetch(db, sql.format(ids=", ".join("?" * len(chunk))), tuple(chunk)))
+        return rows
+
+    async def _load_users(self, user_ids: List[int]) -> Dict[int, Dict]:
+        rows = await self._select_by_ids(
+            "SELECT user_id, username, full_name, registration_date, is_admin FROM users WHERE user_id IN ({ids})",
+            user_ids
+        )
+        return {
+            user[0]: {
+                "user_id": user[0],
+                "username": user[1],
+                "full_name": user[2],
+                "registration_date": user[3],
+                "is_admin": bool(user[4])
+            }
+            for user in rows
+        }
+
+    async def add_message(self, from_id: int, to_id: int, message: str,
+                          notifications: Optional[List[Outgoing]] = None, update_id: Optional[int] = None) -> int:
+        # update_id — ключ идемпотентности: повторная обработка того же апдейта (рестарт посреди хендлера,
+        # повторная доставка) вернёт уже сохранённое сообщение и не поставит уведомления второй раз
+        date = int(time.time() * 1000)
+
+        async def op(db: aiosqlite.Connection) -> int:
+            if update_id is not None:
+                existing = await _fetch(
+                    db,
+                    "SELECT id FROM messages WHERE update_id = ? AND from_id = ? AND date >= ?",
+                    (update_id, from_id, date - UPDATE_KEY_TTL_MS)
+                )
+                if existing:
+                    return existing[0][0]
+            if notifications:
+                await self._enqueue(db, notifications)
+            cursor = await db.execute(
+                "INSERT INTO messages (from_id, to_id, message, date, peer_a, peer_b, update_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (from_id, to_id, message, date, min(from_id, to_id), max(from_id, to_id), update_id)
+            )
+            message_id = cursor.lastrowid
+            # Обновляем сводку диалога в той же транзакции: ответ админа сбрасывает счётчик непрочитанных
+            from_admin = from_id in config['ADMIN_IDS'] or await self._is_admin(db, from_id)
+            user_id, admin_id = (to_id, from_id) if from_admin else (from_id, to_id)
             await db.execute(
-                "INSERT INTO messages (from_id, to_id, message, date) VALUES (?, ?, ?, ?)",
-                (from_id, to_id, message, datetime.datetime.now().strftime("%Y-%m-d %H:%M:%S"))
+                """
+                INSERT INTO conversations (user_id, admin_id, last_message_id, last_message_at, unread_count, message_count)
+                VALUES (?, ?, ?, ?, ?, 1)
+                ON CONFLICT (user_id, admin_id) DO UPDATE SET
+                    last_message_id = excluded.last_message_id,
+                    last_message_at = excluded.last_message_at,
+                    unread_count = CASE WHEN excluded.unread_count = 0 THEN 0 ELSE unread_count + 1 END,
+                    message_count = message_count + 1
+                """,
+                (user_id, admin_id, message_id, date, 0 if from_admin else 1)
             )
-            await db.commit()
+            return message_id
 
-    async def get_dialog_history(self, user_id: int, admin_id: int, limit: int = 10, offset: int = 0) -> List[Dict]:
-        async with aiosqlite.connect(self.db_name) as db:
+        message_id = await self._batched(op)
+        # Версия диалога для кэша отрисованной истории: id растут, поэтому берём максимум при гонке коммитов
+        key = ("last_message", min(from_id, to_id), max(from_id, to_id))
+        self.cache.set(key, max(self.cache.get(key) or 0, message_id))
+        # ...и версия всей переписки каждого из собеседников
+        peer_keys = [("last_message", from_id), ("last_message", to_id)]
+        for peer_key in peer_keys:
+            self.cache.set(peer_key, max(self.cache.get(peer_key) or 0, message_id))
+        # Кто из собеседников админ, решает транзакция, поэтому сбрасываем счётчик непрочитанных в обе стороны
+        unread = [("unread", from_id, to_id), ("unread", to_id, from_id)]
+        for unread_key in unread:
+            self.cache.invalidate(unread_key)
+        self._unread_generation += 1
+        if notifications:
+            # Будим воркер outbox только после коммита, иначе он не увидит новые строки
+            self.outbox_ready.set()
+            self._changed(key, *peer_keys, *unread, "outbox")
+        else:
+            self._changed(key, *peer_keys, *unread)
+        return message_id
+
+    async def _enqueue(self, db: aiosqlite.Connection, notifications: List[Outgoing]) -> None:
+        now = int(time.time() * 1000)
+        await db.executemany(
+            "INSERT INTO outbox (chat_id, text, reply_markup, created_at) VALUES (?, ?, ?, ?)",
+            [(chat_id, text, reply_markup, now) for chat_id, text, reply_markup in notifications]
+        )
+
+    async def enqueue_messages(self, notifications: List[Outgoing]) -> None:
+        async with self._write() as db:
+            await self._enqueue(db, notifications)
+        self.outbox_ready.set()
+        self._changed("outbox")
+
+    async def claim_outbox(self, limit: int = 50, shard: Optional[Tuple[int, int]] = None) -> List[Dict]:
+        # Только самое старое ожидающее сообщение каждого чата — так сохраняется порядок доставки внутри чата.
+        # shard = (номер, всего): при нескольких процессах каждый доставляет только в свои чаты.
+        where, params = "", []
+        if shard is not None:
+            where, params = " AND ABS(chat_id) % ? = ?", [shard[1], shard[0]]
+        async with self._read() as db:
             async with db.execute(
-                    """
-                    SELECT m.*, u.username, u.full_name 
-                    FROM messages m
-                    JOIN users u ON m.from_id = u.user_id
-                    WHERE (m.from_id = ? AND m.to_id = ?) OR (m.from_id = ? AND m.to_id = ?)
-                    ORDER BY m.date DESC LIMIT ? OFFSET ?
+                    f"""
+                    SELECT o.id, o.chat_id, o.text, o.reply_markup, o.attempts
+                    FROM outbox o
+                    JOIN (SELECT MIN(id) AS id FROM outbox WHERE status = 'pending'{where} GROUP BY chat_id) head
+                        ON head.id = o.id
+                    WHERE o.next_attempt_at <= ?
+                    ORDER BY o.id LIMIT ?
                     """,
-                    (user_id, admin_id, admin_id, user_id, limit, offset)
+                    (*params, int(time.time() * 1000), limit)
             ) as cursor:
-                messages = await cursor.fetchall()
                 return [
-                    {
-                        "id": msg[0],
-                        "from_id": msg[1],
-                        "to_id": msg[2],
-                        "message": msg[3],
-                        "date": msg[4],
-                        "is_read": msg[5],
-                        "username": msg[6],
-                        "full_name": msg[7]
-                    }
-                    for msg in messages
+                    {"id": row[0], "chat_id": row[1], "text": row[2], "reply_markup": row[3], "attempts": row[4]}
+                    for row in await cursor.fetchall()
                 ]
 
-    async def get_all_dialogs(self, admin_id: int) -> List[Dict]:
-        async with aiosqlite.connect(self.db_name) as db:
+    async def outbox_sent(self, ids: List[int]) -> None:
+        async with self._write() as db:
+            await db.executemany("DELETE FROM outbox WHERE id = ?", [(outbox_id,) for outbox_id in ids])
+
+    async def outbox_retry(self, outbox_id: int, delay: float, error: str, count_attempt: bool = True) -> None:
+        async with self._write() as db:
+            await db.execute(
+                "UPDATE outbox SET attempts = attempts + ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (int(count_attempt), int((time.time() + delay) * 1000), error, outbox_id)
+            )
+
+    async def outbox_dead(self, outbox_id: int, error: str) -> None:
+        async with self._write() as db:
+            await db.execute(
+                "UPDATE outbox SET status = 'dead', attempts = attempts + 1, last_error = ? WHERE id = ?",
+                (error, outbox_id)
+            )
+
+    async def purge_dead_outbox(self, older_than: int) -> int:
+        async with self._write() as db:
+            cursor = await db.execute("DELETE FROM outbox WHERE status = 'dead' AND created_at < ?", (older_than,))
+            return cursor.rowcount
+
+    async def create_broadcast(self, admin_id: int, text: str, progress_chat_id: int, progress_message_id: int) -> Dict:
+        now = int(time.time() * 1000)
+        async with self._write() as db:
+            async with db.execute("SELECT COUNT(*) FROM users WHERE is_blocked = 0") as cursor:
+                total = (await cursor.fetchone())[0]
+            cursor = await db.execute(
+                """
+                INSERT INTO broadcasts (admin_id, text, total, progress_chat_id, progress_message_id, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (admin_id, text, total, progress_chat_id, progress_message_id, now, now)
+            )
+            broadcast_id = cursor.lastrowid
+        self.broadcasts_ready.set()
+        self._changed("broadcasts")
+        return await self.get_broadcast(broadcast_id)
+
+    async def get_broadcast(self, broadcast_id: int) -> Optional[Dict]:
+        async with self._read() as db:
             async with db.execute(
                     """
-                    SELECT DISTINCT u.user_id, u.username, u.full_name
-                    FROM messages m
-                    JOIN users u ON (m.from_id = u.user_id OR m.to_id = u.user_id)
-                    WHERE (m.from_id = ? OR m.to_id = ?) AND u.is_admin = 0
+                    SELECT id, admin_id, text, status, last_user_id, total, sent, failed, progress_chat_id, progress_message_id
+                    FROM broadcasts WHERE id = ?
                     """,
-                    (admin_id, admin_id)
+                    (broadcast_id,)
             ) as cursor:
-                dialogs = await cursor.fetchall()
-                return [
-                    {
-                        "user_id": dialog[0],
-                        "username": dialog[1],
-                        "full_name": dialog[2]
-                    }
-                    for dialog in dialogs
-                ]
+                row = await cursor.fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "admin_id": row[1],
+            "text": row[2],
+            "status": row[3],
+            "last_user_id": row[4],
+            "total": row[5],
+            "sent": row[6],
+            "failed": row[7],
+            "progress_chat_id": row[8],
+            "progress_message_id": row[9]
+        }
+
+    async def get_running_broadcasts(self) -> List[int]:
+        async with self._read() as db:
+            async with db.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id") as cursor:
+                return [row[0] for row in await cursor.fetchall()]
+
+    async def iter_broadcast_recipients(self, after_user_id: int = 0, batch_size: int = 500) -> AsyncIterator[List[int]]:
+        # Получатели пачками по возрастанию user_id (keyset), соединение держится только на время одной пачки
+        while True:
+            async with self._read() as db:
+                async with db.execute(
+                        "SELECT user_id FROM users WHERE user_id > ? AND is_blocked = 0 ORDER BY user_id LIMIT ?",
+                        (after_user_id, batch_size)
+                ) as cursor:
+                    batch = [row[0] for row in await cursor.fetchall()]
+            if not batch:
+                return
+            yield batch
+            after_user_id = batch[-1]
+
+    async def save_broadcast_progress(self, broadcast_id: int, last_user_id: int, sent: int,
+                                      failures: List[Tuple[int, str]]) -> str:
+        # Контрольная точка и ошибки доставки пишутся одной транзакцией; возвращается текущий статус рассылки —
+        # её могли остановить из другого процесса
+        async with self._write() as db:
+            await db.executemany(
+                "INSERT OR REPLACE INTO broadcast_failures (broadcast_id, user_id, error) VALUES (?, ?, ?)",
+                [(broadcast_id, user_id, error) for user_id, error in failures]
+            )
+            await db.execute(
+                """
+                UPDATE broadcasts SET last_user_id = MAX(last_user_id, ?), sent = sent + ?, failed = failed + ?, updated_at = ?
+                WHERE id = ?
+                """,
+                (last_user_id, sent, len(failures), int(time.time() * 1000), broadcast_id)
+            )
+            async with db.execute("SELECT status FROM broadcasts WHERE id = ?", (broadcast_id,)) as cursor:
+                return (await cursor.fetchone())[0]
+
+    async def finish_broadcast(self, broadcast_id: int, status: str = 'done') -> None:
+        async with self._write() as db:
+            await db.execute(
+                "UPDATE broadcasts SET status = ?, updated_at = ? WHERE id = ? AND status = 'running'",
+                (status, int(time.time() * 1000), broadcast_id)
+            )
+
+    async def archive_messages(self, older_than: int, limit: int = 500) -> int:
+        # Переносит в архив самые старые по id сообщения, пока их дата раньше older_than (мс). Архив всегда
+        # остаётся префиксом по id — на этом держится дочитывание истории; сообщение с датой новее границы
+        # останавливает пачку. Строки без даты (не разобранные при миграции старых дат) заведомо старые.
+        # Две короткие транзакции: сначала копия в архив (идемпотентно), потом удаление из горячей таблицы —
+        # так сбой между ними оставит лишнюю копию, но не потеряет сообщения.
+        if not self.archive_name:
+            return 0
+        async with self._write() as db:
+            upto, count = None, 0
+            for message_id, date in await _fetch(db, "SELECT id, date FROM messages ORDER BY id LIMIT ?", (limit,)):
+                if date is not None and date >= older_than:
+                    break
+                upto, count = message_id, count + 1
+            if not count:
+                return 0
+            await db.execute(
+                """
+                INSERT OR REPLACE INTO archive.messages
+                    (id, from_id, to_id, message, date, is_read, peer_a, peer_b, date_legacy)
+                SELECT id, from_id, to_id, zip(message), date, is_read, peer_a, peer_b, date_legacy
+                FROM messages WHERE id <= ?
+                """,
+                (upto,)
+            )
+        async with self._write() as db:
+            await db.execute("DELETE FROM messages WHERE id <= ?", (upto,))
+        return count
+
+    async def fsm_load(self, chat_id: int, user_id: int, newer_than: int) -> Optional[Tuple[Optional[str], str]]:
+        async with self._read() as db:
+            async with db.execute(
+                    "SELECT state, data FROM fsm_states WHERE chat_id = ? AND user_id = ? AND updated_at >= ?",
+                    (chat_id, user_id, newer_than)
+            ) as cursor:
+                return await cursor.fetchone()
+
+    async def fsm_save_many(self, records: List[Tuple[int, int, Optional[str], Optional[str]]]) -> None:
+        # records: (chat_id, user_id, state, data JSON); пустая запись (state и data = None) удаляется
+        now = int(time.time() * 1000)
+        async with self._write() as db:
+            await db.executemany(
+                """
+                INSERT INTO fsm_states (chat_id, user_id, state, data, updated_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (chat_id, user_id) DO UPDATE SET
+                    state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+                """,
+                [(chat_id, user_id, state, data, now) for chat_id, user_id, state, data in records
+                 if state is not None or data is not None]
+            )
+            await db.executemany(
+                "DELETE FROM fsm_states WHERE chat_id = ? AND user_id = ?",
+                [(chat_id, user_id) for chat_id, user_id, state, data in records if state is None and data is None]
+            )
+
+    async def fsm_purge(self, older_than: int) -> int:
+        async with self._write() as db:
+            cursor = await db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (older_than,))
+            return cursor.rowcount
+
+    async def is_update_processed(self, update_id: int) -> bool:
+        async with self._read() as db:
+            return bool(await _fetch(db, "SELECT 1 FROM processed_updates WHERE update_id = ?", (update_id,)))
+
+    async def mark_update_processed(self, update_id: int) -> None:
+        now = int(time.time() * 1000)
+
+        async def op(db: aiosqlite.Connection) -> None:
+            await db.execute(
+                "INSERT OR IGNORE INTO processed_updates (update_id, processed_at) VALUES (?, ?)", (update_id, now)
+            )
+
+        await self._batched(op)
+
+    async def get_last_update_id(self) -> Optional[int]:
+        async with self._read() as db:
+            rows = await _fetch(db, "SELECT MAX(update_id) FROM processed_updates", ())
+        return rows[0][0]
+
+    async def prune_processed_updates(self, older_than: int, keep: int) -> int:
+        # Набор обработанных апдейтов ограничен и по времени, и по числу записей
+        async with self._write() as db:
+            cursor = await db.execute("DELETE FROM processed_updates WHERE processed_at < ?", (older_than,))
+            removed = cursor.rowcount
+            cursor = await db.execute(
+                """
+                DELETE FROM processed_updates WHERE processed_at <= (
+                    SELECT processed_at FROM processed_updates ORDER BY processed_at DESC LIMIT 1 OFFSET ?
+                )
+                """,
+                (keep,)
+            )
+            return removed + cursor.rowcount
+
+    async def _is_admin(self, db: aiosqlite.Connection, user_id: int) -> bool:
+        async with db.execute("SELECT is_admin FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            result = await cursor.fetchone()
+            return bool(result and result[0])
+
+    async def get_unread_count(self, user_id: int, admin_id: int) -> int:
+        key = ("unread", user_id, admin_id)
+        count = self.cache.get(key)
+        if count is None:
+            generation = self._unread_generation
+            async with self._read() as db:
+                rows = await _fetch(
+                    db, "SELECT unread_count FROM conversations WHERE user_id = ? AND admin_id = ?", (user_id, admin_id)
+                )
+            count = rows[0][0] if rows else 0
+            # Пока шёл запрос, mark_dialog_read мог записать свежее значение — его не затираем
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+            # Чтение, начатое до нового сообщения, в кэш не кладём — иначе устаревший 0 переживёт сброс
+            if generation == self._unread_generation:
+                self.cache.set(key, count)
+        return count
+
+    async def mark_dialog_read(self, user_id: int, admin_id: int) -> None:
+        # Повторное открытие прочитанного диалога не должно занимать писателя — счётчик берём из кэша
+        if not await self.get_unread_count(user_id, admin_id):
+            return
+        key = ("unread", user_id, admin_id)
+        async with self._write() as db:
+            await db.execute(
+                "UPDATE conversations SET unread_count = 0 WHERE user_id = ? AND admin_id = ? AND unread_count > 0",
+                (user_id, admin_id)
+            )
+            await db.execute(
+                "UPDATE messages SET is_read = 1 WHERE peer_a = ? AND peer_b = ? AND to_id = ? AND is_read = 0",
+                (min(user_id, admin_id), max(user_id, admin_id), admin_id)
+            )
+        self.cache.set(key, 0)
+        self._changed(key)
+
+    async def get_history_page(self, user_id: int, admin_id: Optional[int], before_id: Optional[int] = None,
+                               limit: int = 10, after_id: Optional[int] = None) -> Tuple[List[Dict], Optional[int], Optional[int]]:
+        # Keyset-пагинация по id: страница новых → старых, возвращает (сообщения, курсор новее, курсор старше).
+        # admin_id=None — вся переписка пользователя, со всеми админами сразу
+        if admin_id is None:
+            peers, sql, archive_sql = (user_id, user_id), USER_HISTORY_SQL, ARCHIVE_USER_HISTORY_SQL
+        else:
+            peers, sql, archive_sql = (min(user_id, admin_id), max(user_id, admin_id)), HISTORY_SQL, ARCHIVE_HISTORY_SQL
+        async with self._read() as db:
+            if self.archive_name:
+                rows, newer, older = await self._history_page(db, peers, before_id, after_id, limit, sql, archive_sql)
+            else:
+                rows, newer, older = await _keyset_page(
+                    db, sql, "m.id", peers, before_id, after_id, limit
+                )
+        return [_message_from_row(msg) for msg in rows], newer, older
+
+    async def _history_page(self, db: aiosqlite.Connection, peers: tuple, older_than: Optional[int],
+                            newer_than: Optional[int], limit: int, sql: str = HISTORY_SQL,
+                            archive_sql: str = ARCHIVE_HISTORY_SQL):
+        # Как _keyset_page, но по двум источникам: архив хранит только id меньше любого горячего сообщения,
+        # поэтому в архив идём, лишь когда горячая часть диалога кончилась. Граница следующего запроса —
+        # последний уже взятый id, так что сообщение, попавшее в оба источника во время переноса, не задвоится.
+        if newer_than is not None:
+            rows = await _fetch(
+                db, archive_sql.format(where=" AND m.id > ?", order="ASC"), (*peers, newer_than, limit + 1)
+            )
+            if len(rows) <= limit:
+                bound = rows[-1][-1] if rows else newer_than
+                rows += await _fetch(
+                    db, sql.format(where=" AND m.id > ?", order="ASC"), (*peers, bound, limit + 1 - len(rows))
+                )
+            has_newer, has_older = len(rows) > limit, True
+            rows = rows[:limit][::-1]
+        else:
+            if older_than is not None:
+                rows = await _fetch(
+                    db, sql.format(where=" AND m.id < ?", order="DESC"), (*peers, older_than, limit + 1)
+                )
+            else:
+                rows = await _fetch(db, sql.format(where="", order="DESC"), (*peers, limit + 1))
+            if len(rows) <= limit:
+                bound = rows[-1][-1] if rows else older_than
+                if bound is None:
+                    rows += await _fetch(
+                        db, archive_sql.format(where="", order="DESC"), (*peers, limit + 1 - len(rows))
+                    )
+                else:
+                    rows += await _fetch(
+                        db, archive_sql.format(where=" AND m.id < ?", order="DESC"),
+                        (*peers, bound, limit + 1 - len(rows))
+                    )
+            has_newer, has_older = older_than is not None, len(rows) > limit
+            rows = rows[:limit]
+        if not rows:
+            return rows, None, None
+        return rows, rows[0][-1] if has_newer else None, rows[-1][-1] if has_older else None
+
+    async def get_last_message_id(self, user_id: int, admin_id: Optional[int]) -> int:
+        # id последнего сообщения диалога (0 — диалог пуст); add_message обновляет значение в кэше сам.
+        # admin_id=None — последнее сообщение пользователя с любым админом
+        if admin_id is None:
+            key, where, params = ("last_message", user_id), "peer_a = ? OR peer_b = ?", (user_id, user_id)
+        else:
+            key = ("last_message", min(user_id, admin_id), max(user_id, admin_id))
+            where, params = "peer_a = ? AND peer_b = ?", key[1:]
+        last_id = self.cache.get(key)
+        if last_id is None:
+            async with self._read() as db:
+                async with db.execute(f"SELECT MAX(id) FROM messages WHERE {where}", params) as cursor:
+                    last_id = (await cursor.fetchone())[0] or 0
+                if not last_id and self.archive_name:
+                    async with db.execute(f"SELECT MAX(id) FROM archive.messages WHERE {where}", params) as cursor:
+                        last_id = (await cursor.fetchone())[0] or 0
+            # Пока шёл запрос, add_message мог записать более свежий id — его не затираем
+            last_id = max(self.cache.get(key) or 0, last_id)
+            self.cache.set(key, last_id)
+        return last_id
+
+    async def stream_messages(self, admin_id: Optional[int] = None, user_id: Optional[int] = None,
+                              since: Optional[int] = None, until: Optional[int] = None,
+                              batch_size: int = 1000) -> AsyncIterator[List[Dict]]:
+        # Все сообщения по возрастанию id пачками по batch_size: сначала архив, затем горячая таблица.
+        # Соединение берётся на одну пачку, так что выгрузка любого размера не держит читателя и память.
+        # since/until — мс от эпохи. Порядок дат по id не гарантирован (даты старых строк восстановлены миграцией),
+        # поэтому границы id берутся точные: первый id с датой не раньше since и последний с датой раньше until;
+        # фильтр по дате остаётся, а границы только сужают обход по id.
+        where, params = "", []
+        if admin_id is not None and user_id is not None:
+            where += " AND m.peer_a = ? AND m.peer_b = ?"
+            params += [min(admin_id, user_id), max(admin_id, user_id)]
+        else:
+            for peer in (admin_id, user_id):
+                if peer is not None:
+                    where += " AND (m.peer_a = ? OR m.peer_b = ?)"
+                    params += [peer, peer]
+        if since is not None:
+            where += " AND m.date >= ?"
+            params.append(since)
+        if until is not None:
+            where += " AND m.date < ?"
+            params.append(until)
+        sources = [("messages", "m.message")]
+        if self.archive_name:
+            sources.insert(0, ("archive.messages", "unzip(m.message)"))
+        last_id = 0
+        for table, message in sources:
+            stop_where, stop_params = "", []
+            async with self._read() as db:
+                if since is not None:
+                    first = (await _fetch(db, f"SELECT MIN(id) FROM {table} WHERE date >= ?", (since,)))[0][0]
+                    if first is None:
+                        continue
+                    last_id = max(last_id, first - 1)
+                if until is not None:
+                    stop = (await _fetch(db, f"SELECT MAX(id) FROM {table} WHERE date < ?", (until,)))[0][0]
+                    if stop is None:
+                        continue
+                    stop_where, stop_params = " AND m.id <= ?", [stop]
+            sql = EXPORT_SQL.format(table=table, message=message, where=stop_where + where)
+            while True:
+                async with self._read() as db:
+                    rows = await _fetch(db, sql, (last_id, *stop_params, *params, batch_size))
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                yield [dict(zip(EXPORT_COLUMNS, row)) for row in rows]
+                if len(rows) < batch_size:
+                    break
+
+    async def get_dialogs_page(self, admin_id: int, after_cursor: Optional[int] = None,
+                               limit: int = 10, before_cursor: Optional[int] = None) -> Tuple[List[Dict], Optional[int], Optional[int]]:
+        # Курсор — last_message_id диалога, список отсортирован по последней активности
+        async with self._read() as db:
+            rows, newer, older = await _keyset_page(
+                db, DIALOGS_SQL, "c.last_message_id", (admin_id,), after_cursor, before_cursor, limit
+            )
+        return [_dialog_from_row(dialog) for dialog in rows], newer, older
+
+    async def get_assignment(self, user_id: int) -> Optional[int]:
+        key = ("assignment", user_id)
+        admin_id = self.cache.get(key)
+        if admin_id is None:
+            async with self._read() as db:
+                async with db.execute("SELECT admin_id FROM assignments WHERE user_id = ?", (user_id,)) as cursor:
+                    result = await cursor.fetchone()
+            if result is None:
+                return None
+            admin_id = result[0]
+            self.cache.set(key, admin_id)
+        return admin_id
+
+    async def assign_conversation(self, user_id: int, admin_id: int, stale_admin_id: Optional[int] = None) -> int:
+        # Закрепляет пользователя за админом и возвращает фактического ответственного: при гонке побеждает
+        # первая запись, а чужое закрепление перезаписывается, только если оно указывает на stale_admin_id
+        async with self._write() as db:
+            await db.execute(
+                """
+                INSERT INTO assignments (user_id, admin_id, assigned_at) VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET admin_id = excluded.admin_id, assigned_at = excluded.assigned_at
+                WHERE assignments.admin_id = ?
+                """,
+                (user_id, admin_id, int(time.time() * 1000), stale_admin_id)
+            )
+            async with db.execute("SELECT admin_id FROM assignments WHERE user_id = ?", (user_id,)) as cursor:
+                admin_id = (await cursor.fetchone())[0]
+        self.cache.set(("assignment", user_id), admin_id)
+        self._changed(("assignment", user_id))
+        return admin_id
+
+    async def get_open_counts(self, admin_ids: List[int]) -> Dict[int, int]:
+        # Открытые диалоги — с непрочитанными сообщениями пользователя, считаются по частичному индексу
+        if not admin_ids:
+            return {}
+        async with self._read() as db:
+            async with db.execute(
+                    f"""
+                    SELECT admin_id, COUNT(*) FROM conversations
+                    WHERE unread_count > 0 AND admin_id IN ({", ".join("?" * len(admin_ids))})
+                    GROUP BY admin_id
+                    """,
+                    admin_ids
+            ) as cursor:
+                counts = dict(await cursor.fetchall())
+        return {admin_id: counts.get(admin_id, 0) for admin_id in admin_ids}
+
+    def _forget_user(self, user_id: int) -> None:
+        self.cache.invalidate(("flags", user_id))
+        self._flags_generation += 1
+        self._users_loader.forget(user_id)
+        self._flags_loader.forget(user_id)
+
+    def _invalidate_user(self, user_id: int) -> None:
+        self._forget_user(user_id)
+        self.cache.invalidate("admins")
+        self._changed(("flags", user_id), "admins")
+
+    def _changed(self, *keys: Hashable) -> None:
+        if self.on_change is not None:
+            self.on_change(list(keys))
+
+    def forget(self, keys: List[Hashable]) -> None:
+        # Изменения из другого процесса: сбрасываем затронутые записи кэша, "outbox" будит воркер outbox,
+        # "broadcasts" — процесс, который ведёт рассылки
+        for key in keys:
+            if key == "outbox":
+                self.outbox_ready.set()
+            elif key == "broadcasts":
+                self.broadcasts_ready.set()
+            elif isinstance(key, tuple) and key[0] == "flags":
+                self._forget_user(key[1])
+            elif isinstance(key, tuple) and key[0] == "unread":
+                self.cache.invalidate(key)
+                self._unread_generation += 1
+            else:
+                self.cache.invalidate(key)
+
+    async def search_messages(self, query: str, admin_id: int, cursor: int = 0, limit: int = 10) -> Tuple[List[Dict], Optional[int]]:
+        # Поиск по диалогам админа, результаты по релевантности (bm25). Курсор — смещение в ранжированной выдаче.
+        match = fts_query(query)
+        if not match:
+            return [], None
+        async with self._read() as db:
+            async with db.execute(
+                    """
+                    SELECT m.id, m.from_id, m.to_id, m.date,
+                           snippet(messages_fts, 0, '«', '»', '…', 12),
+                           u.user_id, u.username, u.full_name
+                    FROM messages_fts f
+                    JOIN messages m ON m.id = f.rowid
+                    JOIN users u ON u.user_id = CASE WHEN m.peer_a = ? THEN m.peer_b ELSE m.peer_a END
+                    WHERE messages_fts MATCH ? AND (m.peer_a = ? OR m.peer_b = ?)
+                    ORDER BY f.rank LIMIT ? OFFSET ?
+                    """,
+                    (admin_id, match, admin_id, admin_id, limit + 1, cursor)
+            ) as db_cursor:
+                rows = await db_cursor.fetchall()
+        hits = [
+            {
+                "id": row[0],
+                "from_id": row[1],
+                "to_id": row[2],
+                "date": row[3],
+                "snippet": row[4],
+                "user_id": row[5],
+                "username": row[6],
+                "full_name": row[7]
+            }
+            for row in rows[:limit]
+        ]
+        return hits, cursor + limit if len(rows) > limit else None
 
     async def block_user(self, user_id: int) -> None:
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._write() as db:
             await db.execute("UPDATE users SET is_blocked = 1 WHERE user_id = ?", (user_id,))
-            await db.commit()
+        self._invalidate_user(user_id)
 
     async def unblock_user(self, user_id: int) -> None:
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._write() as db:
             await db.execute("UPDATE users SET is_blocked = 0 WHERE user_id = ?", (user_id,))
-            await db.commit()
+        self._invalidate_user(user_id)
+
+    async def _set_admin(self, user_id: int, is_admin: bool, notifications: Optional[List[Outgoing]]) -> bool:
+        # Уведомления ставятся в outbox той же транзакцией и только если флаг действительно поменялся:
+        # повтор апдейта после падения посреди хендлера второй раз ничего не отправит
+        async with self._write() as db:
+            cursor = await db.execute(
+                "UPDATE users SET is_admin = ? WHERE user_id = ? AND is_admin IS NOT ?",
+                (int(is_admin), user_id, int(is_admin))
+            )
+            changed = cursor.rowcount > 0
+            if changed and notifications:
+                await self._enqueue(db, notifications)
+        self._invalidate_user(user_id)
+        if changed and notifications:
+            self.outbox_ready.set()
+            self._changed("outbox")
+        return changed
 
-    async def promote_to_admin(self, user_id: int) -> None:
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute("UPDATE users SET is_admin = 1 WHERE user_id = ?", (user_id,))
-            await db.commit()
+    async def promote_to_admin(self, user_id: int, notifications: Optional[List[Outgoing]] = None) -> bool:
+        return await self._set_admin(user_id, True, notifications)
 
-    async def demote_from_admin(self, user_id: int) -> None:
+    async def demote_from_admin(self, user_id: int, notifications: Optional[List[Outgoing]] = None) -> bool:
         # Предотвращаем снятие админки с пользователей из ADMIN_IDS
         if user_id in config['ADMIN_IDS']:
-            return
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute("UPDATE users SET is_admin = 0 WHERE user_id = ?", (user_id,))
-            await db.commit()
+            return False
+        return await self._set_admin(user_id, False, notifications)
+
+    async def get_flags(self, user_id: int) -> Tuple[bool, bool]:
+        return (await self.get_users_flags([user_id]))[user_id]
+
+    async def get_users_flags(self, user_ids: List[int]) -> Dict[int, Tuple[bool, bool]]:
+        # (is_admin, is_blocked) по каждому id; промахи кэша догружаются одним запросом.
+        # Отсутствующий пользователь тоже кэшируется — add_user сбросит запись.
+        flags = {}
+        missing = []
+        for user_id in user_ids:
+            cached = self.cache.get(("flags", user_id))
+            if cached is None:
+                missing.append(user_id)
+            else:
+                flags[user_id] = cached
+        if missing:
+            generation = self._flags_generation
+            for user_id, row in (await self._flags_loader.load_many(missing)).items():
+                flags[user_id] = (bool(row and row[0]), bool(row and row[1]))
+                # Чтение, начатое до записи флагов, в кэш не кладём — иначе оно переживёт сброс
+                if generation == self._flags_generation:
+                    self.cache.set(("flags", user_id), flags[user_id])
+        return flags
+
+    async def _load_flags(self, user_ids: List[int]) -> Dict[int, Tuple[int, int]]:
+        rows = await self._select_by_ids("SELECT user_id, is_admin, is_blocked FROM users WHERE user_id IN ({ids})", user_ids)
+        return {row[0]: row[1:] for row in rows}
 
     async def is_user_blocked(self, user_id: int) -> bool:
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute("SELECT is_blocked FROM users WHERE user_id = ?", (user_id,)) as cursor:
-                result = await cursor.fetchone()
-                return bool(result and result[0])
+        return (await self.get_flags(user_id))[1]
 
     async def is_user_admin(self, user_id: int) -> bool:
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute("SELECT is_admin FROM users WHERE user_id = ?", (user_id,)) as cursor:
-                result = await cursor.fetchone()
-                # Если пользователь в ADMIN_IDS, всегда возвращаем True
-                if user_id in config['ADMIN_IDS']:
-                    return True
-                return bool(result and result[0])
+        # Если пользователь в ADMIN_IDS, всегда возвращаем True
+        if user_id in config['ADMIN_IDS']:
+            return True
+        return (await self.get_flags(user_id))[0]
 
     async def get_all_admins(self) -> List[int]:
-        async with aiosqlite.connect(self.db_name) as db:
-            async with db.execute("SELECT user_id FROM users WHERE is_admin = 1") as cursor:
-                admins = await cursor.fetchall()
-                return [admin[0] for admin in admins]
+        admins = self.cache.get("admins")
+        if admins is None:
+            async with self._read() as db:
+                async with db.execute("SELECT user_id FROM users WHERE is_admin = 1") as cursor:
+                    admins = [admin[0] for admin in await cursor.fetchall()]
+            self.cache.set("admins", admins)
+        return list(admins)
 
-db = Database()
+    async def delete_dialog(self, user_id: int, admin_id: int) -> None:
+        async with self._write() as db:
+            await db.execute(
+                "DELETE FROM messages WHERE peer_a = ? AND peer_b = ?",
+                (min(user_id, admin_id), max(user_id, admin_id))
+            )
+            if self.archive_name:
+                await db.execute(
+                    "DELETE FROM archive.messages WHERE peer_a = ? AND peer_b = ?",
+                    (min(user_id, admin_id), max(user_id, admin_id))
+                )
+            await db.execute(
+                "DELETE FROM conversations WHERE (user_id = ? AND admin_id = ?) OR (user_id = ? AND admin_id = ?)",
+                (user_id, admin_id, admin_id, user_id)
+            )
+        keys = [("last_message", min(user_id, admin_id), max(user_id, admin_id)),
+                ("last_message", user_id), ("last_message", admin_id)]
+        for key in keys:
+            self.cache.invalidate(key)
+        self._changed(*keys)
+
+db = Database(
+    readers=config.get('DB_READERS', 4),
+    cache_size=config.get('CACHE_SIZE', 10000),
+    cache_ttl=config.get('CACHE_TTL', 60),
+    batch_size=config.get('WRITE_BATCH_SIZE', 256),
+    batch_window=config.get('WRITE_BATCH_WINDOW_MS', 2) / 1000,
+    archive_name=config.get('ARCHIVE_DB') or None
+)
 async def init_db():
-    await db.init()
\ No newline at end of file
+    await db.init()
+
+async def close_db():
+    await db.close()
\ No newline at end of file
@@ -0,0 +1,73 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Tuple
+
+class DataLoader:
+    # Склеивает одиночные загрузки по ключу: все load(), вызванные до следующего прохода цикла событий,
+    # уходят одним вызовом batch_fn (один запрос IN (...)). Ключ, который уже загружается, второй раз
+    # не запрашивается — все ждут один и тот же результат. batch_fn возвращает {ключ: значение},
+    # отсутствующие ключи получают None. Результаты не хранятся — это дело кэша над загрузчиком.
+    def __init__(self, batch_fn: Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]], max_batch: int = 500):
+        self.batch_fn = batch_fn
+        self.max_batch = max_batch
+        self._futures: Dict[Hashable, asyncio.Future] = {}
+        self._queue: List[Tuple[Hashable, asyncio.Future]] = []
+        self._scheduled = False
+        self.loads = 0
+        self.coalesced = 0
+        self.batches = 0
+
+    async def load(self, key: Hashable) -> Any:
+        self.loads += 1
+        future = self._futures.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._futures[key] = loop.create_future()
+            self._queue.append((key, future))
+            if not self._scheduled:
+                self._scheduled = True
+                loop.call_soon(self._dispatch)
+        else:
+            self.coalesced += 1
+        # shield: отмена одного ожидающего не должна отменять загрузку для остальных
+        return await asyncio.shield(future)
+
+    async def load_many(self, keys: List[Hashable]) -> Dict[Hashable, Any]:
+        keys = list(dict.fromkeys(keys))
+        return dict(zip(keys, await asyncio.gather(*(self.load(key) for key in keys))))
+
+    def forget(self, key: Hashable) -> None:
+        # После записи: следующий load() пойдёт в БД, а не присоединится к чтению, начатому до неё
+        self._futures.pop(key, None)
+
+    def _dispatch(self) -> None:
+        queue, self._queue, self._scheduled = self._queue, [], False
+        for start in range(0, len(queue), self.max_batch):
+            asyncio.ensure_future(self._run(queue[start:start + self.max_batch]))
+
+    async def _run(self, batch: List[Tuple[Hashable, asyncio.Future]]) -> None:
+        self.batches += 1
+        try:
+            values = await self.batch_fn([key for key, _ in batch])
+        except BaseException as e:
+            for key, future in batch:
+                self._settle(key, future)
+                if not future.done():
+                    if isinstance(e, asyncio.CancelledError):
+                        future.cancel()
+                    else:
+                        future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        for key, future in batch:
+            self._settle(key, future)
+            if not future.done():
+                future.set_result(values.get(key))
+
+    def _settle(self, key: Hashable, future: asyncio.Future) -> None:
+        # Ключ мог быть забыт и запрошен заново — тогда в словаре уже другая загрузка
+        if self._futures.get(key) is future:
+            del self._futures[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {"loads": self.loads, "coalesced": self.coalesced, "batches": self.batches}
@@ -0,0 +1,332 @@
+import aiosqlite
+import calendar
+import datetime
+import logging
+import re
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+# Каждая миграция — список SQL-выражений или корутин, принимающих соединение.
+# Номер версии = позиция в списке + 1, текущая версия хранится в PRAGMA user_version.
+Step = Union[str, Callable[[aiosqlite.Connection], Awaitable[None]]]
+
+log = logging.getLogger(__name__)
+
+# Пересчёт сводки диалогов по всей таблице messages: используется миграцией и при массовой загрузке данных
+REBUILD_CONVERSATIONS_SQL = """
+    INSERT OR REPLACE INTO conversations
+        (user_id, admin_id, last_message_id, last_message_at, unread_count, message_count)
+    SELECT user_id, admin_id, MAX(id), date, SUM(is_read = 0 AND to_id = admin_id), COUNT(*)
+    FROM (
+        SELECT
+            CASE WHEN peer_a IN (SELECT user_id FROM users WHERE is_admin = 1) THEN peer_b ELSE peer_a END AS user_id,
+            CASE WHEN peer_a IN (SELECT user_id FROM users WHERE is_admin = 1) THEN peer_a ELSE peer_b END AS admin_id,
+            id, date, is_read, to_id
+        FROM messages
+    )
+    GROUP BY user_id, admin_id
+"""
+
+# Закрепление пользователей без назначенного админа за тем, с кем был последний диалог
+BACKFILL_ASSIGNMENTS_SQL = """
+    INSERT OR IGNORE INTO assignments (user_id, admin_id, assigned_at)
+    SELECT user_id, admin_id, CAST(strftime('%s', 'now') AS INTEGER) * 1000
+    FROM conversations
+    ORDER BY last_message_id DESC
+"""
+
+# Старые даты писались как "%Y-%m-d %H:%M:%S" с буквальной d вместо дня месяца
+LEGACY_DATE = re.compile(r"^(\d{4})-(\d{2})-(\d{2}|d) (\d{2}):(\d{2}):(\d{2})$")
+
+def _legacy_ms(value, state: Dict) -> Tuple[Optional[int], Optional[str]]:
+    # Текстовая дата в локальном времени → (мс от эпохи, исходный текст). Там, где день потерян, он восстанавливается
+    # по порядку id: в пределах месяца каждый откат времени суток означает, что наступил следующий день.
+    # Исходный текст возвращается только для восстановленных и неразобранных дат — он остаётся в date_legacy.
+    if value is None or isinstance(value, int):
+        return value, None
+    match = LEGACY_DATE.match(str(value))
+    if not match:
+        return None, str(value)
+    year, month, day, hour, minute, second = match.groups()
+    year, month, hour, minute, second = int(year), int(month), int(hour), int(minute), int(second)
+    clock = (hour, minute, second)
+    if day != "d":
+        state.update(month=(year, month), day=int(day), clock=clock)
+    elif state.get("month") != (year, month):
+        state.update(month=(year, month), day=1, clock=clock)
+    else:
+        if clock < state["clock"]:
+            state["day"] = min(state["day"] + 1, calendar.monthrange(year, month)[1])
+        state["clock"] = clock
+    moment = datetime.datetime(year, month, state["day"], hour, minute, second)
+    return int(moment.timestamp() * 1000), str(value) if day == "d" else None
+
+async def _has_archive(conn: aiosqlite.Connection) -> bool:
+    async with conn.execute("PRAGMA database_list") as cursor:
+        return any(row[1] == "archive" for row in await cursor.fetchall())
+
+async def _columns(conn: aiosqlite.Connection, table: str, schema: str = "main") -> List[str]:
+    async with conn.execute(f"PRAGMA {schema}.table_info({table})") as cursor:
+        return [row[1] for row in await cursor.fetchall()]
+
+async def _retype_column(conn: aiosqlite.Connection, table: str, column: str, value_sql: str,
+                         join: str = "", added: Sequence[Tuple[str, str]] = ()) -> None:
+    # SQLite не меняет тип столбца, а ADD/DROP/RENAME переносит столбец в конец таблицы. Поэтому таблица
+    # пересоздаётся по её же CREATE TABLE с типом INTEGER у column: порядок столбцов, ключи, значения
+    # по умолчанию и счётчик AUTOINCREMENT сохраняются, индексы и триггеры создаются заново.
+    # value_sql — новое значение column по строке старой таблицы (join — дополнительные таблицы для него),
+    # added — столбцы (определение, значение), которые дописываются в конец.
+    async with conn.execute(
+            "SELECT type, sql FROM sqlite_master WHERE tbl_name = ? AND sql IS NOT NULL", (table,)
+    ) as cursor:
+        schema = await cursor.fetchall()
+    create = next(sql for kind, sql in schema if kind == "table")
+    create, found = re.subn(rf"^CREATE TABLE {table}\b", f"CREATE TABLE {table}_new", create)
+    create, retyped = re.subn(rf"\b{column}\s+TEXT\b", f"{column} INTEGER", create, count=1)
+    if not found or not retyped:
+        raise RuntimeError(f"Не удалось перестроить {table}.{column}: неожиданная схема таблицы")
+    if added:
+        create = create[:create.rindex(")")] + "".join(f", {definition}" for definition, _ in added) + ")"
+    columns = await _columns(conn, table)
+    values = [value_sql if name == column else f"{table}.{name}" for name in columns] + [value for _, value in added]
+    names = columns + [definition.split()[0] for definition, _ in added]
+    sequence = None
+    if "AUTOINCREMENT" in create.upper():
+        async with conn.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)) as cursor:
+            sequence = await cursor.fetchone()
+    await conn.execute(create)
+    await conn.execute(
+        f"INSERT INTO {table}_new ({', '.join(names)}) SELECT {', '.join(values)} FROM {table} {join}"
+    )
+    await conn.execute(f"DROP TABLE {table}")
+    await conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    if sequence is not None:
+        await conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = ?", (sequence[0], table))
+    for kind, sql in schema:
+        if kind in ("index", "trigger"):
+            await conn.execute(sql)
+
+async def _timestamps_to_epoch(conn: aiosqlite.Connection) -> None:
+    await _retype_column(
+        conn, "users", "registration_date",
+        "CAST(strftime('%s', users.registration_date, 'utc') AS INTEGER) * 1000"
+    )
+    archive = await _has_archive(conn)
+    if archive and "date_legacy" not in await _columns(conn, "messages", "archive"):
+        await conn.execute("ALTER TABLE archive.messages ADD COLUMN date_legacy TEXT")
+    # Новые даты горячей таблицы сначала собираются во временной таблице, потом messages пересоздаётся за один проход
+    await conn.execute("CREATE TEMP TABLE legacy_dates (id INTEGER PRIMARY KEY, ms INTEGER, legacy TEXT)")
+    # Архив и горячая таблица идут одним проходом по возрастанию id, чтобы восстановление дней было сквозным
+    state: Dict = {}
+    unparsed: List[int] = []
+    targets = [(
+        "archive.messages", "UPDATE archive.messages SET date = ?, date_legacy = ? WHERE id = ?"
+    )] if archive else []
+    targets.append(("messages", "INSERT INTO temp.legacy_dates (ms, legacy, id) VALUES (?, ?, ?)"))
+    for table, write_sql in targets:
+        last_id = 0
+        while True:
+            async with conn.execute(
+                    f"SELECT id, date FROM {table} WHERE id > ? ORDER BY id LIMIT 5000", (last_id,)
+            ) as cursor:
+                rows = await cursor.fetchall()
+            if not rows:
+                break
+            batch = []
+            for message_id, date in rows:
+                ms, legacy = _legacy_ms(date, state)
+                if ms is None and legacy is not None:
+                    unparsed.append(message_id)
+                batch.append((ms, legacy, message_id))
+            await conn.executemany(write_sql, batch)
+            last_id = rows[-1][0]
+    if unparsed:
+        log.warning("Миграция дат: не разобрано %s дат, исходный текст оставлен в date_legacy; id: %s%s",
+                    len(unparsed), ", ".join(map(str, unparsed[:100])), " …" if len(unparsed) > 100 else "")
+    await _retype_column(
+        conn, "messages", "date", "legacy_dates.ms",
+        join="LEFT JOIN temp.legacy_dates ON legacy_dates.id = messages.id",
+        added=[("date_legacy TEXT", "legacy_dates.legacy")]
+    )
+    await conn.execute("DROP TABLE temp.legacy_dates")
+    last_at = "(SELECT date FROM messages WHERE id = conversations.last_message_id)"
+    if archive:
+        last_at = f"COALESCE({last_at}, (SELECT date FROM archive.messages WHERE id = conversations.last_message_id))"
+    await _retype_column(conn, "conversations", "last_message_at", last_at)
+    if archive:
+        await conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_date ON messages (date)")
+
+MIGRATIONS: List[List[Step]] = [
+    # 1: канонический ключ диалога (peer_a = min, peer_b = max) и индексы под него
+    [
+        "ALTER TABLE messages ADD COLUMN peer_a INTEGER",
+        "ALTER TABLE messages ADD COLUMN peer_b INTEGER",
+        "UPDATE messages SET peer_a = MIN(from_id, to_id), peer_b = MAX(from_id, to_id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_conversation ON messages (peer_a, peer_b, id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_peer_b ON messages (peer_b)",
+        "CREATE INDEX IF NOT EXISTS idx_users_is_admin ON users (is_admin) WHERE is_admin = 1",
+    ],
+    # 2: материализованный список диалогов, add_message поддерживает его инкрементально
+    [
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_id INTEGER NOT NULL,
+            admin_id INTEGER NOT NULL,
+            last_message_id INTEGER,
+            last_message_at TEXT,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, admin_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_conversations_admin ON conversations (admin_id, last_message_id)",
+        REBUILD_CONVERSATIONS_SQL,
+    ],
+    # 3: outbox исходящих сообщений Telegram, пишется в одной транзакции с messages
+    [
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            reply_markup TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (chat_id, id) WHERE status = 'pending'",
+    ],
+    # 4: состояния FSM вместо MemoryStorage, пустые записи не хранятся, простаивающие удаляются по TTL
+    [
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            state TEXT,
+            data TEXT,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states (updated_at)",
+    ],
+    # 5: полнотекстовый поиск по сообщениям, индекс синхронизируется триггерами
+    [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            message,
+            content = 'messages',
+            content_rowid = 'id',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message) VALUES ('delete', old.id, old.message);
+            INSERT INTO messages_fts (rowid, message) VALUES (new.id, new.message);
+        END
+        """,
+        "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')",
+    ],
+    # 6: закрепление пользователя за админом; существующие диалоги — за админом с последним сообщением
+    [
+        """
+        CREATE TABLE IF NOT EXISTS assignments (
+            user_id INTEGER PRIMARY KEY,
+            admin_id INTEGER NOT NULL,
+            assigned_at INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_assignments_admin ON assignments (admin_id)",
+        "CREATE INDEX IF NOT EXISTS idx_conversations_open ON conversations (admin_id) WHERE unread_count > 0",
+        BACKFILL_ASSIGNMENTS_SQL,
+    ],
+    # 7: рассылки с контрольной точкой по user_id, чтобы после рестарта продолжить с места остановки
+    [
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            progress_chat_id INTEGER,
+            progress_message_id INTEGER,
+            created_at INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_broadcasts_running ON broadcasts (id) WHERE status = 'running'",
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_failures (
+            broadcast_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            error TEXT,
+            PRIMARY KEY (broadcast_id, user_id)
+        ) WITHOUT ROWID
+        """,
+    ],
+    # 8: даты — целые мс от эпохи вместо текста, индекс по дате сообщения для выборок по диапазону
+    [
+        _timestamps_to_epoch,
+        "CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (date)",
+    ],
+    # 9: идемпотентная обработка апдейтов — обработанные update_id и ключ апдейта у сохранённого сообщения
+    [
+        "CREATE TABLE IF NOT EXISTS processed_updates (update_id INTEGER PRIMARY KEY, processed_at INTEGER NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS idx_processed_updates_at ON processed_updates (processed_at)",
+        "ALTER TABLE messages ADD COLUMN update_id INTEGER",
+        "CREATE INDEX IF NOT EXISTS idx_messages_update ON messages (update_id) WHERE update_id IS NOT NULL",
+    ],
+    # 10: чистка недоставленных сообщений outbox по возрасту
+    [
+        "CREATE INDEX IF NOT EXISTS idx_outbox_dead ON outbox (created_at) WHERE status = 'dead'",
+    ],
+]
+
+async def get_version(conn: aiosqlite.Connection) -> int:
+    async with conn.execute("PRAGMA user_version") as cursor:
+        row = await cursor.fetchone()
+        return row[0]
+
+async def migrate(conn: aiosqlite.Connection) -> int:
+    version = await get_version(conn)
+    for number, steps in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        # Каждая миграция применяется атомарно вместе с обновлением user_version
+        await conn.commit()
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Под блокировкой записи версию перечитываем: миграцию мог уже применить другой процесс
+            if await get_version(conn) >= number:
+                await conn.rollback()
+                version = number
+                continue
+            for step in steps:
+                if isinstance(step, str):
+                    await conn.execute(step)
+                else:
+                    await step(conn)
+            await conn.execute(f"PRAGMA user_version = {number}")
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+        version = number
+    return version
@@ -0,0 +1,38 @@
+import argparse
+import asyncio
+import sys
+
+from database.db import db, init_db, close_db
+from utils.dates import parse_date
+from utils.export import FORMATS, export_messages
+
+# Выгрузка переписки из консоли, без бота. Запуск из корня проекта:
+#   python3 export.py -o messages.jsonl.gz --gzip --admin 123 --from 2024-01-01 --to 2024-02-01
+
+async def main():
+    parser = argparse.ArgumentParser(description="Выгрузка сообщений в JSONL или CSV")
+    parser.add_argument('-o', '--output', required=True, help="файл для выгрузки")
+    parser.add_argument('--format', choices=FORMATS, default='jsonl')
+    parser.add_argument('--gzip', action='store_true', help="сжать gzip")
+    parser.add_argument('--admin', type=int, help="только диалоги этого админа")
+    parser.add_argument('--user', type=int, help="только диалоги этого пользователя")
+    parser.add_argument('--from', dest='since', type=parse_date, help="с даты ГГГГ-ММ-ДД включительно")
+    parser.add_argument('--to', dest='until', type=parse_date, help="по дату ГГГГ-ММ-ДД не включая")
+    parser.add_argument('--db', help="путь к БД вместо feedback.db")
+    args = parser.parse_args()
+
+    if args.db:
+        db.db_name = args.db
+    try:
+        # Та же БД, что у бота: схема создаётся и мигрирует до текущей версии, архив подключается
+        await init_db()
+        count = await export_messages(
+            db, args.output, args.format, args.gzip,
+            admin_id=args.admin, user_id=args.user, since=args.since, until=args.until
+        )
+    finally:
+        await close_db()
+    print(f"Выгружено сообщений: {count} → {args.output}", file=sys.stderr)
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,45 +1,40 @@
+from typing import Optional
 from aiogram import types, Dispatcher
 from aiogram.dispatcher import FSMContext
 from states.dialog import DialogStates
 from database.db import db  # Ensure db is imported
 from utils.keyboards import get_main_keyboard, get_dialog_navigation_keyboard, get_admin_message_keyboard
+from utils.callbacks import (ADD_ADMIN, ALL_DIALOGS, BLOCK, BROADCAST, BROADCAST_CONFIRM, BROADCAST_STOP, DELETE_DIALOG, DIALOG,
+                             DIALOGS_PAGE, IGNORE, LIST_ADMINS, MAIN_MENU, MANAGE_ADMINS, REMOVE_ADMIN, REPLY, SEARCH,
+                             SEARCH_PAGE, UNBLOCK, callback_router)
+from utils.outbox import outgoing
+from utils.history import _truncate, renderer
+from utils.broadcast import broadcaster, progress_keyboard, progress_text
+from utils.export import parse_options, start_export
+from utils.dates import format_timestamp
+from utils.retention import retention
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.exceptions import MessageNotModified, BotBlocked, MessageToEditNotFound
-import aiosqlite  # Add this import for the database connection in delete_dialog
 
-async def show_all_dialogs(callback_query: types.CallbackQuery, state: FSMContext):
+async def show_all_dialogs(callback_query: types.CallbackQuery, state: FSMContext,
+                           older: Optional[int] = None, newer: Optional[int] = None):
     try:
         if not await db.is_user_admin(callback_query.from_user.id):
             await callback_query.answer("Недостаточно прав", show_alert=True)
             return
-        current_page = (await state.get_data()).get("current_page", 1)
-        dialogs = await db.get_all_dialogs(callback_query.from_user.id)
-        total_pages = (len(dialogs) + 9) // 10
-        if current_page < 1:
-            current_page = 1
-        elif current_page > total_pages:
-            current_page = total_pages
-        start_index = (current_page - 1) * 10
-        end_index = min(start_index + 10, len(dialogs))
-        page_dialogs = dialogs[start_index:end_index]
+        dialogs, newer_cursor, older_cursor = await db.get_dialogs_page(
+            callback_query.from_user.id, after_cursor=older, before_cursor=newer
+        )
         keyboard = InlineKeyboardMarkup(row_width=2)
-        for dialog in page_dialogs:
+        for dialog in dialogs:
+            unread = f" 🔴{dialog['unread_count']}" if dialog['unread_count'] else ""
             keyboard.add(
                 InlineKeyboardButton(
-                    f"{dialog['full_name']} (@{dialog['username'] if dialog['username'] else 'Отсутствует'})",
-                    callback_data=f"dialog_{dialog['user_id']}"
+                    f"{dialog['full_name']} (@{dialog['username'] if dialog['username'] else 'Отсутствует'}){unread}",
+                    callback_data=DIALOG.new(user_id=dialog['user_id'])
                 )
             )
-        if total_pages > 1:
-            navigation_buttons = []
-            if current_page > 1:
-                navigation_buttons.append(InlineKeyboardButton("⬅️", callback_data=f"page_{current_page - 1}"))
-            navigation_buttons.append(InlineKeyboardButton(f"{current_page}/{total_pages}", callback_data="ignore"))
-            if current_page < total_pages:
-                navigation_buttons.append(InlineKeyboardButton("➡️", callback_data=f"page_{current_page + 1}"))
-            keyboard.add(*navigation_buttons)
-        keyboard.add(InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu"))
-        await state.update_data({"current_page": current_page})
+        get_dialog_navigation_keyboard(DIALOGS_PAGE.new(), newer_cursor, older_cursor, keyboard)
         await callback_query.message.edit_text(
             "📋 Список диалогов:",
             reply_markup=keyboard
@@ -49,99 +44,86 @@ async def show_all_dialogs(callback_query: types.CallbackQuery, state: FSMContex
     except BotBlocked:
         print(f"Ошибка: Не удалось показать диалоги. Бот заблокирован пользователем {callback_query.from_user.id}")
 
-async def process_page_change(callback_query: types.CallbackQuery, state: FSMContext):
+async def process_page_change(callback_query: types.CallbackQuery, state: FSMContext,
+                              older: Optional[int] = None, newer: Optional[int] = None):
     try:
-        page = int(callback_query.data.split('_')[1])
-        await state.update_data({"current_page": page})
-        await show_all_dialogs(callback_query, state)
+        await show_all_dialogs(callback_query, state, older, newer)
     except BotBlocked:
         print(f"Ошибка: Не удалось изменить страницу. Бот заблокирован пользователем {callback_query.from_user.id}")
 
-async def ignore_callback(callback_query: types.CallbackQuery):
+async def ignore_callback(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.answer()
 
-async def show_dialog(callback_query: types.CallbackQuery, state: FSMContext):
+async def show_dialog(callback_query: types.CallbackQuery, state: FSMContext, user_id: int,
+                      older: Optional[int] = None, newer: Optional[int] = None):
     try:
-        user_id = int(callback_query.data.split('_')[1])
-        history = await db.get_dialog_history(user_id, callback_query.from_user.id)
-        if not history:
+        page = await renderer.render(
+            user_id, callback_query.from_user.id, callback_query.from_user.id,
+            f"📋 Диалог с пользователем {user_id}:\n\n", before_id=older, after_id=newer
+        )
+        if page is None:
             await callback_query.answer("Диалог пуст", show_alert=True)
             return
-        history_text = f"📋 Диалог с пользователем {user_id}:\n\n"
-        for msg in history:
-            if msg['from_id'] == callback_query.from_user.id:
-                direction = f"👑 Админ (@{msg['username'] if msg['username'] else 'Отсутствует'}):"
-            else:
-                direction = f"👤 Пользователь (@{msg['username'] if msg['username'] else 'Отсутствует'}):"
-            history_text += f"{direction} {msg['message']}\n"
-            history_text += f"Дата: {msg['date']}\n"
-            history_text += "➖➖➖➖➖➖➖➖\n"
+        history_text, newer_cursor, older_cursor = page
         keyboard = InlineKeyboardMarkup(row_width=2)
         is_blocked = await db.is_user_blocked(user_id)
         keyboard.add(
             InlineKeyboardButton("🔓 Разблокировать" if is_blocked else "🔒 Заблокировать", 
-                                callback_data=f"{'unblock' if is_blocked else 'block'}_{user_id}"),
-            InlineKeyboardButton("✍️ Ответить", callback_data=f"reply_{user_id}")
+                                callback_data=(UNBLOCK if is_blocked else BLOCK).new(user_id=user_id)),
+            InlineKeyboardButton("✍️ Ответить", callback_data=REPLY.new(user_id=user_id))
         )
+        get_dialog_navigation_keyboard(DIALOG.new(user_id=user_id), newer_cursor, older_cursor, keyboard, main_menu=False)
         keyboard.add(
-            InlineKeyboardButton("🗑️ Удалить диалог", callback_data=f"delete_dialog_{user_id}"),
-            InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")
+            InlineKeyboardButton("🗑️ Удалить диалог", callback_data=DELETE_DIALOG.new(user_id=user_id)),
+            InlineKeyboardButton("🔙 Главное меню", callback_data=MAIN_MENU.new())
         )
         await callback_query.message.edit_text(
             history_text,
             reply_markup=keyboard
         )
+        await db.mark_dialog_read(user_id, callback_query.from_user.id)
         await state.update_data(reply_to=user_id)
     except BotBlocked:
         print(f"Ошибка: Не удалось показать диалог. Бот заблокирован пользователем {callback_query.from_user.id}")
 
-async def delete_dialog(callback_query: types.CallbackQuery, state: FSMContext):
+async def delete_dialog(callback_query: types.CallbackQuery, state: FSMContext, user_id: int):
     try:
         if not await db.is_user_admin(callback_query.from_user.id):
             await callback_query.answer("Недостаточно прав", show_alert=True)
             return
-        user_id = int(callback_query.data.split('_')[2])
-        async with aiosqlite.connect("feedback.db") as db_conn:
-            await db_conn.execute(
-                "DELETE FROM messages WHERE (from_id = ? AND to_id = ?) OR (from_id = ? AND to_id = ?)",
-                (user_id, callback_query.from_user.id, callback_query.from_user.id, user_id)
-            )
-            await db_conn.commit()
+        await db.delete_dialog(user_id, callback_query.from_user.id)
         await callback_query.answer("Диалог удален", show_alert=True)
         await show_all_dialogs(callback_query, state)
     except BotBlocked:
         print(f"Ошибка: Не удалось удалить диалог. Бот заблокирован пользователем {callback_query.from_user.id}")
 
-async def block_user(callback_query: types.CallbackQuery, state: FSMContext):
+async def block_user(callback_query: types.CallbackQuery, state: FSMContext, user_id: int):
     try:
         if not await db.is_user_admin(callback_query.from_user.id):
             await callback_query.answer("Недостаточно прав", show_alert=True)
             return
-        user_id = int(callback_query.data.split('_')[1])
         await db.block_user(user_id)
         await callback_query.answer("Пользователь заблокирован", show_alert=True)
-        await show_dialog(callback_query, state)
+        await show_dialog(callback_query, state, user_id)
     except BotBlocked:
         print(f"Ошибка: Не удалось заблокировать пользователя. Бот заблокирован пользователем {callback_query.from_user.id}")
 
-async def unblock_user(callback_query: types.CallbackQuery, state: FSMContext):
+async def unblock_user(callback_query: types.CallbackQuery, state: FSMContext, user_id: int):
     try:
         if not await db.is_user_admin(callback_query.from_user.id):
             await callback_query.answer("Недостаточно прав", show_alert=True)
             return
-        user_id = int(callback_query.data.split('_')[1])
         await db.unblock_user(user_id)
         await callback_query.answer("Пользователь разблокирован", show_alert=True)
-        await show_dialog(callback_query, state)
+        await show_dialog(callback_query, state, user_id)
     except BotBlocked:
         print(f"Ошибка: Не удалось разблокировать пользователя. Бот заблокирован пользователем {callback_query.from_user.id}")
 
-async def reply_to_user(callback_query: types.CallbackQuery, state: FSMContext):
+async def reply_to_user(callback_query: types.CallbackQuery, state: FSMContext, user_id: int):
     try:
         if not await db.is_user_admin(callback_query.from_user.id):
             await callback_query.answer("Недостаточно прав", show_alert=True)
             return
-        user_id = int(callback_query.data.split('_')[1])
         await state.update_data(reply_to=user_id)
         await callback_query.message.edit_text(
             "✍️ Введите ваш ответ:",
@@ -159,20 +141,14 @@ async def process_admin_reply(message: types.Message, state: FSMContext):
     await db.add_message(
         from_id=message.from_user.id,
         to_id=user_id,
-        message=message.text
+        message=message.text,
+        notifications=[outgoing(user_id, f"📨 Ответ от администратора:\n\n{message.text}", get_main_keyboard(False))],
+        update_id=types.Update.get_current().update_id
     )
     await message.answer(
         "✅ Ответ отправлен",
         reply_markup=get_main_keyboard(True)
     )
-    try:
-        await message.bot.send_message(
-            user_id,
-            f"📨 Ответ от администратора:\n\n{message.text}",
-            reply_markup=get_main_keyboard(False)
-        )
-    except BotBlocked:
-        print(f"Ошибка: Не удалось отправить ответ пользователю {user_id}. Бот заблокирован.")
     await state.finish()
 
 async def manage_admins(callback_query: types.CallbackQuery, state: FSMContext):
@@ -181,12 +157,12 @@ async def manage_admins(callback_query: types.CallbackQuery, state: FSMContext):
         return
     keyboard = InlineKeyboardMarkup(row_width=2)
     keyboard.add(
-        InlineKeyboardButton("➕ Добавить админа", callback_data="add_admin"),
-        InlineKeyboardButton("➖ Удалить админа", callback_data="remove_admin")
+        InlineKeyboardButton("➕ Добавить админа", callback_data=ADD_ADMIN.new()),
+        InlineKeyboardButton("➖ Удалить админа", callback_data=REMOVE_ADMIN.new())
     )
     keyboard.add(
-        InlineKeyboardButton("📋 Список админов", callback_data="list_admins"),
-        InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu")
+        InlineKeyboardButton("📋 Список админов", callback_data=LIST_ADMINS.new()),
+        InlineKeyboardButton("🔙 Главное меню", callback_data=MAIN_MENU.new())
     )
     await callback_query.message.edit_text(
         "👑 Управление администраторами:",
@@ -206,8 +182,9 @@ async def list_admins(callback_query: types.CallbackQuery, state: FSMContext):
         return
     
     admin_list_text = "📋 Список администраторов:\n\n"
+    admins = await db.get_users_info(admin_ids)
     for admin_id in admin_ids:
-        user_info = await db.get_user_info(admin_id)
+        user_info = admins.get(admin_id)
         if user_info:
             username = f"@{user_info['username']}" if user_info['username'] else "Отсутствует"
             admin_list_text += f"ID: {admin_id}\n"
@@ -216,8 +193,8 @@ async def list_admins(callback_query: types.CallbackQuery, state: FSMContext):
             admin_list_text += "➖➖➖➖➖➖➖➖\n"
     
     keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("🔙 Управление админами", callback_data="manage_admins"))
-    keyboard.add(InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu"))
+    keyboard.add(InlineKeyboardButton("🔙 Управление админами", callback_data=MANAGE_ADMINS.new()))
+    keyboard.add(InlineKeyboardButton("🔙 Главное меню", callback_data=MAIN_MENU.new()))
     
     await callback_query.message.edit_text(
         admin_list_text,
@@ -229,7 +206,7 @@ async def add_admin(callback_query: types.CallbackQuery, state: FSMContext):
         await callback_query.answer("Недостаточно прав", show_alert=True)
         return
     keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu"))
+    keyboard.add(InlineKeyboardButton("🔙 Главное меню", callback_data=MAIN_MENU.new()))
     prompt_message = await callback_query.message.edit_text(
         "Введите ID пользователя для назначения администратором:",
         reply_markup=keyboard
@@ -243,28 +220,19 @@ async def process_add_admin(message: types.Message, state: FSMContext):
     try:
         user_id = int(message.text)
         user_info = await db.get_user_info(user_id)
-        if user_info:
-            await db.promote_to_admin(user_id)
-            await message.answer(
-                f"Пользователь {user_id} назначен администратором.",
-                reply_markup=get_main_keyboard(True)
-            )
+        if not user_info:
+            await db.add_user(user_id, "Unknown", "Unknown")
+        # Уведомление уходит вместе с назначением; при повторе апдейта пользователь уже админ и его не получит
+        promoted = await db.promote_to_admin(user_id, [
+            outgoing(user_id, "🎉 Вы были назначены администратором!\nВыберите действие в меню ниже:", get_main_keyboard(True))
+        ])
+        if not promoted:
+            text = f"Пользователь {user_id} уже администратор."
+        elif user_info:
+            text = f"Пользователь {user_id} назначен администратором."
         else:
-            await db.add_user(user_id, "Unknown", "Unknown", is_admin=True)
-            await message.answer(
-                f"Пользователь {user_id} добавлен и назначен администратором.",
-                reply_markup=get_main_keyboard(True)
-            )
-        try:
-            await message.bot.send_message(
-                user_id,
-                "🎉 Вы были назначены администратором!\nВыберите действие в меню ниже:",
-                reply_markup=get_main_keyboard(True)
-            )
-        except BotBlocked:
-            print(f"Ошибка: Не удалось уведомить нового админа {user_id}. Бот заблокирован.")
-        except Exception as e:
-            print(f"Ошибка при уведомлении нового админа {user_id}: {str(e)}")
+            text = f"Пользователь {user_id} добавлен и назначен администратором."
+        await message.answer(text, reply_markup=get_main_keyboard(True))
         
         data = await state.get_data()
         prompt_message_id = data.get('prompt_message_id')
@@ -291,7 +259,7 @@ async def remove_admin(callback_query: types.CallbackQuery, state: FSMContext):
         await callback_query.answer("Недостаточно прав", show_alert=True)
         return
     keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu"))
+    keyboard.add(InlineKeyboardButton("🔙 Главное меню", callback_data=MAIN_MENU.new()))
     prompt_message = await callback_query.message.edit_text(
         "Введите ID администратора для удаления:",
         reply_markup=keyboard
@@ -313,21 +281,14 @@ async def process_remove_admin(message: types.Message, state: FSMContext):
             if admin_count <= 1:
                 await message.answer("Нельзя удалить последнего администратора.")
             else:
-                await db.demote_from_admin(user_id)
+                demoted = await db.demote_from_admin(user_id, [
+                    outgoing(user_id, "ℹ️ Вы были удалены из администраторов.\nВыберите действие в меню ниже:", get_main_keyboard(False))
+                ])
                 await message.answer(
-                    f"Пользователь {user_id} удален из администраторов.",
+                    f"Пользователь {user_id} удален из администраторов." if demoted
+                    else f"Пользователя {user_id} нельзя удалить: он указан в ADMIN_IDS или уже не администратор.",
                     reply_markup=get_main_keyboard(True)
                 )
-                try:
-                    await message.bot.send_message(
-                        user_id,
-                        "ℹ️ Вы были удалены из администраторов.\nВыберите действие в меню ниже:",
-                        reply_markup=get_main_keyboard(False)
-                    )
-                except BotBlocked:
-                    print(f"Ошибка: Не удалось уведомить пользователя {user_id}. Бот заблокирован.")
-                except Exception as e:
-                    print(f"Ошибка при уведомлении пользователя {user_id}: {str(e)}")
                 
                 data = await state.get_data()
                 prompt_message_id = data.get('prompt_message_id')
@@ -349,6 +310,157 @@ async def process_remove_admin(message: types.Message, state: FSMContext):
     except Exception as e:
         await message.answer(f"Ошибка: {str(e)}")
 
+def archive_search_note() -> str:
+    # Перенесённые в архив сообщения уходят из полнотекстового индекса — поиск их не находит
+    if not db.archive_name:
+        return ""
+    return (f"\n\nℹ️ Сообщения старше {retention.after_days:g} дн. перенесены в архив и в поиск не попадают, "
+            f"их можно найти в истории диалога")
+
+async def search_messages(callback_query: types.CallbackQuery, state: FSMContext):
+    if not await db.is_user_admin(callback_query.from_user.id):
+        await callback_query.answer("Недостаточно прав", show_alert=True)
+        return
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("🔙 Главное меню", callback_data=MAIN_MENU.new()))
+    await callback_query.message.edit_text(
+        "🔍 Введите текст для поиска по сообщениям:" + archive_search_note(),
+        reply_markup=keyboard
+    )
+    await DialogStates.waiting_for_search_query.set()
+
+async def show_search_results(chat_message: types.Message, admin_id: int, query: str, cursor: int, edit: bool):
+    hits, next_cursor = await db.search_messages(query, admin_id, cursor)
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    # Запрос повторяется в ответе — длинный обрезаем, чтобы ответ не превысил лимит Telegram
+    shown = _truncate(query, 100)
+    if not hits:
+        text = f"🔍 По запросу «{shown}» ничего не найдено."
+    else:
+        lines = [f"🔍 Результаты по запросу «{shown}»:\n"]
+        for number, hit in enumerate(hits, start=cursor + 1):
+            username = f"@{hit['username']}" if hit['username'] else "Отсутствует"
+            direction = "👑" if hit['from_id'] == admin_id else "👤"
+            lines.append(f"{number}. {hit['full_name']} ({username}), {format_timestamp(hit['date'])}\n{direction} {hit['snippet']}")
+            keyboard.insert(InlineKeyboardButton(f"{number}. {hit['full_name']}", callback_data=DIALOG.new(user_id=hit['user_id'])))
+        text = "\n".join(lines)
+    text += archive_search_note()
+    navigation = []
+    if cursor > 0:
+        navigation.append(InlineKeyboardButton("⬅️", callback_data=SEARCH_PAGE.new(cursor=max(0, cursor - 10))))
+    if next_cursor is not None:
+        navigation.append(InlineKeyboardButton("➡️", callback_data=SEARCH_PAGE.new(cursor=next_cursor)))
+    if navigation:
+        keyboard.row(*navigation)
+    keyboard.add(
+        InlineKeyboardButton("🔍 Новый поиск", callback_data=SEARCH.new()),
+        InlineKeyboardButton("🔙 Главное меню", callback_data=MAIN_MENU.new())
+    )
+    if edit:
+        await chat_message.edit_text(text, reply_markup=keyboard)
+    else:
+        await chat_message.answer(text, reply_markup=keyboard)
+
+async def process_search_query(message: types.Message, state: FSMContext):
+    if not await db.is_user_admin(message.from_user.id):
+        return
+    query = message.text.strip()
+    # Запрос остаётся в данных FSM для листания результатов, само состояние сбрасываем
+    await state.reset_state(with_data=False)
+    await state.update_data(search_query=query)
+    await show_search_results(message, message.from_user.id, query, 0, edit=False)
+
+async def process_search_page(callback_query: types.CallbackQuery, state: FSMContext, cursor: int):
+    try:
+        if not await db.is_user_admin(callback_query.from_user.id):
+            await callback_query.answer("Недостаточно прав", show_alert=True)
+            return
+        query = (await state.get_data()).get('search_query')
+        if not query:
+            await search_messages(callback_query, state)
+            return
+        await show_search_results(callback_query.message, callback_query.from_user.id, query, cursor, edit=True)
+    except MessageNotModified:
+        await callback_query.answer()
+    except BotBlocked:
+        print(f"Ошибка: Не удалось показать результаты поиска. Бот заблокирован пользователем {callback_query.from_user.id}")
+
+async def start_broadcast(callback_query: types.CallbackQuery, state: FSMContext):
+    if not await db.is_user_admin(callback_query.from_user.id):
+        await callback_query.answer("Недостаточно прав", show_alert=True)
+        return
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("🔙 Главное меню", callback_data=MAIN_MENU.new()))
+    await callback_query.message.edit_text(
+        "📣 Введите текст рассылки для всех пользователей:",
+        reply_markup=keyboard
+    )
+    await DialogStates.waiting_for_broadcast_text.set()
+
+async def process_broadcast_text(message: types.Message, state: FSMContext):
+    if not await db.is_user_admin(message.from_user.id):
+        return
+    # Текст ждёт подтверждения в данных FSM, само состояние сбрасываем
+    await state.reset_state(with_data=False)
+    await state.update_data(broadcast_text=message.text)
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.add(
+        InlineKeyboardButton("✅ Отправить", callback_data=BROADCAST_CONFIRM.new()),
+        InlineKeyboardButton("❌ Отмена", callback_data=MAIN_MENU.new())
+    )
+    await message.answer(
+        f"📣 Разослать всем пользователям это сообщение?\n\n{message.text}",
+        reply_markup=keyboard
+    )
+
+async def confirm_broadcast(callback_query: types.CallbackQuery, state: FSMContext):
+    try:
+        if not await db.is_user_admin(callback_query.from_user.id):
+            await callback_query.answer("Недостаточно прав", show_alert=True)
+            return
+        data = await state.get_data()
+        text = data.pop('broadcast_text', None)
+        if not text:
+            await callback_query.answer("Рассылка уже запущена или отменена", show_alert=True)
+            return
+        await state.set_data(data)
+        broadcast = await broadcaster.start(
+            callback_query.bot, callback_query.from_user.id, text,
+            callback_query.message.chat.id, callback_query.message.message_id
+        )
+        # Это же сообщение дальше обновляет воркер рассылки
+        await callback_query.message.edit_text(progress_text(broadcast), reply_markup=progress_keyboard(broadcast))
+    except BotBlocked:
+        print(f"Ошибка: Не удалось запустить рассылку. Бот заблокирован пользователем {callback_query.from_user.id}")
+
+async def stop_broadcast(callback_query: types.CallbackQuery, state: FSMContext, broadcast_id: int):
+    try:
+        if not await db.is_user_admin(callback_query.from_user.id):
+            await callback_query.answer("Недостаточно прав", show_alert=True)
+            return
+        broadcast = await broadcaster.cancel(broadcast_id)
+        if broadcast is None:
+            await callback_query.answer("Рассылка не найдена", show_alert=True)
+            return
+        await callback_query.message.edit_text(progress_text(broadcast), reply_markup=progress_keyboard(broadcast))
+    except MessageNotModified:
+        await callback_query.answer()
+    except BotBlocked:
+        print(f"Ошибка: Не удалось остановить рассылку. Бот заблокирован пользователем {callback_query.from_user.id}")
+
+async def export_cmd(message: types.Message):
+    if not await db.is_user_admin(message.from_user.id):
+        return
+    try:
+        options = parse_options(message.get_args().split())
+    except ValueError as e:
+        await message.answer(
+            f"{e}\n\nФормат: /export [jsonl|csv] [gz] [user=ID] [admin=ID] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]"
+        )
+        return
+    start_export(message.bot, db, message.chat.id, options)
+    await message.answer("⏳ Готовлю выгрузку, пришлю файлом, когда закончу.")
+
 async def main_menu(callback_query: types.CallbackQuery, state: FSMContext):
     is_admin = await db.is_user_admin(callback_query.from_user.id)
     await callback_query.message.edit_text(
@@ -358,19 +470,28 @@ async def main_menu(callback_query: types.CallbackQuery, state: FSMContext):
     await state.finish()
 
 def register_admin_handlers(dp: Dispatcher):
-    dp.register_callback_query_handler(show_all_dialogs, lambda c: c.data == 'all_dialogs', state="*")
-    dp.register_callback_query_handler(process_page_change, lambda c: c.data.startswith('page_'), state="*")
-    dp.register_callback_query_handler(ignore_callback, lambda c: c.data == 'ignore', state="*")
-    dp.register_callback_query_handler(show_dialog, lambda c: c.data.startswith('dialog_'))
-    dp.register_callback_query_handler(delete_dialog, lambda c: c.data.startswith('delete_dialog_'))
-    dp.register_callback_query_handler(block_user, lambda c: c.data.startswith('block_'))
-    dp.register_callback_query_handler(unblock_user, lambda c: c.data.startswith('unblock_'))
-    dp.register_callback_query_handler(reply_to_user, lambda c: c.data.startswith('reply_'))
-    dp.register_callback_query_handler(manage_admins, lambda c: c.data == 'manage_admins', state="*")
-    dp.register_callback_query_handler(add_admin, lambda c: c.data == 'add_admin', state="*")
-    dp.register_callback_query_handler(remove_admin, lambda c: c.data == 'remove_admin', state="*")
-    dp.register_callback_query_handler(list_admins, lambda c: c.data == 'list_admins', state="*")
-    dp.register_callback_query_handler(main_menu, lambda c: c.data == 'main_menu', state="*")
+    callbacks = callback_router(dp)
+    callbacks.register(ALL_DIALOGS, show_all_dialogs, state="*")
+    callbacks.register(DIALOGS_PAGE, process_page_change, state="*")
+    callbacks.register(IGNORE, ignore_callback, state="*")
+    callbacks.register(DIALOG, show_dialog)
+    callbacks.register(DELETE_DIALOG, delete_dialog)
+    callbacks.register(BLOCK, block_user)
+    callbacks.register(UNBLOCK, unblock_user)
+    callbacks.register(REPLY, reply_to_user)
+    callbacks.register(MANAGE_ADMINS, manage_admins, state="*")
+    callbacks.register(ADD_ADMIN, add_admin, state="*")
+    callbacks.register(REMOVE_ADMIN, remove_admin, state="*")
+    callbacks.register(LIST_ADMINS, list_admins, state="*")
+    callbacks.register(MAIN_MENU, main_menu, state="*")
     dp.register_message_handler(process_admin_reply, state=DialogStates.waiting_for_reply)
     dp.register_message_handler(process_add_admin, state=DialogStates.waiting_for_add_admin_id)
-    dp.register_message_handler(process_remove_admin, state=DialogStates.waiting_for_remove_admin_id)
\ No newline at end of file
+    dp.register_message_handler(process_remove_admin, state=DialogStates.waiting_for_remove_admin_id)
+    callbacks.register(SEARCH, search_messages, state="*")
+    callbacks.register(SEARCH_PAGE, process_search_page, state="*")
+    dp.register_message_handler(process_search_query, state=DialogStates.waiting_for_search_query)
+    callbacks.register(BROADCAST, start_broadcast, state="*")
+    callbacks.register(BROADCAST_CONFIRM, confirm_broadcast, state="*")
+    callbacks.register(BROADCAST_STOP, stop_broadcast, state="*")
+    dp.register_message_handler(process_broadcast_text, state=DialogStates.waiting_for_broadcast_text)
+    dp.register_message_handler(export_cmd, commands=['export'], state="*")
\ No newline at end of file
@@ -1,9 +1,15 @@
+from typing import Optional
 from aiogram import types, Dispatcher
 from aiogram.dispatcher import FSMContext
 from states.dialog import DialogStates
 from database.db import db
-from utils.keyboards import get_main_keyboard, get_admin_message_keyboard
-from aiogram.utils.exceptions import BotBlocked
+from utils.keyboards import get_main_keyboard, get_admin_message_keyboard, get_dialog_navigation_keyboard
+from utils.callbacks import CANCEL_MESSAGE, DIALOG_HISTORY, HISTORY_PAGE, MAIN_MENU, PROFILE, WRITE_MESSAGE, callback_router
+from utils.outbox import outgoing
+from utils.routing import router
+from utils.history import renderer
+from utils.dates import format_timestamp
+from aiogram.utils.exceptions import BotBlocked, MessageNotModified
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 import json
 
@@ -29,7 +35,7 @@ async def start_cmd(message: types.Message):
         reply_markup=keyboard
     )
 
-async def show_profile(callback_query: types.CallbackQuery):
+async def show_profile(callback_query: types.CallbackQuery, state: FSMContext):
     try:
         user_info = await db.get_user_info(callback_query.from_user.id)
         username = f"@{user_info['username']}" if user_info['username'] else "Отсутствует"
@@ -38,11 +44,11 @@ async def show_profile(callback_query: types.CallbackQuery):
             f"📌 ID: {user_info['user_id']}\n"
             f"👤 Имя: {user_info['full_name']}\n"
             f"🔗 Юзернейм: {username}\n"
-            f"📅 Дата регистрации: {user_info['registration_date']}\n"
+            f"📅 Дата регистрации: {format_timestamp(user_info['registration_date'])}\n"
             f"👑 Админ: {'Да' if user_info['is_admin'] else 'Нет'}"
         )
         keyboard = InlineKeyboardMarkup(row_width=2)
-        keyboard.add(InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu"))
+        keyboard.add(InlineKeyboardButton("🔙 Главное меню", callback_data=MAIN_MENU.new()))
         
         await callback_query.message.edit_text(
             profile_text,
@@ -51,30 +57,29 @@ async def show_profile(callback_query: types.CallbackQuery):
     except BotBlocked:
         print(f"Ошибка: Не удалось показать профиль. Бот заблокирован пользователем {callback_query.from_user.id}")
 
-async def show_dialog_history(callback_query: types.CallbackQuery):
+async def show_dialog_history(callback_query: types.CallbackQuery, state: FSMContext,
+                              older: Optional[int] = None, newer: Optional[int] = None):
     try:
-        user_info = await db.get_user_info(callback_query.from_user.id)
-        admin_ids = await db.get_all_admins()
-        if not admin_ids:
-            await callback_query.message.edit_text("Нет доступных администраторов.")
-            return
-        history = await db.get_dialog_history(callback_query.from_user.id, admin_ids[0])
-        if not history:
+        keyboard = get_main_keyboard(await db.is_user_admin(callback_query.from_user.id))
+        # Пользователю отвечают закреплённый админ, наблюдатели из ROUTING_WATCHERS и прежние ответственные —
+        # показываем переписку со всеми
+        page = await renderer.render(
+            callback_query.from_user.id, None, callback_query.from_user.id, "📋 История диалога:\n\n",
+            before_id=older, after_id=newer
+        )
+        if page is None:
             await callback_query.message.edit_text(
                 "История диалогов пуста",
-                reply_markup=get_main_keyboard(user_info['is_admin'])
+                reply_markup=keyboard
             )
             return
-        history_text = "📋 История диалога:\n\n"
-        for msg in history:
-            direction = "📤" if msg['from_id'] == callback_query.from_user.id else "📥"
-            history_text += f"{direction} {msg['message']}\n"
-            history_text += f"Дата: {msg['date']}\n"
-            history_text += "➖➖➖➖➖➖➖➖\n"
+        history_text, newer_cursor, older_cursor = page
         await callback_query.message.edit_text(
             history_text,
-            reply_markup=get_main_keyboard(user_info['is_admin'])
+            reply_markup=get_dialog_navigation_keyboard(HISTORY_PAGE.new(), newer_cursor, older_cursor, keyboard, main_menu=False)
         )
+    except MessageNotModified:
+        await callback_query.answer()
     except BotBlocked:
         print(f"Ошибка: Не удалось показать историю. Бот заблокирован пользователем {callback_query.from_user.id}")
 
@@ -83,7 +88,7 @@ async def start_message(callback_query: types.CallbackQuery, state: FSMContext):
         await callback_query.answer("Вы заблокированы в системе", show_alert=True)
         return
     keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("❌ Отмена", callback_data="cancel_message"))
+    keyboard.add(InlineKeyboardButton("❌ Отмена", callback_data=CANCEL_MESSAGE.new()))
     await callback_query.message.edit_text(
         "📝 Введите ваше сообщение:",
         reply_markup=keyboard
@@ -103,34 +108,36 @@ async def process_message(message: types.Message, state: FSMContext):
     if await db.is_user_blocked(message.from_user.id):
         await message.answer("Вы заблокированы в системе")
         return
-    admin_ids = await db.get_all_admins()
-    if not admin_ids:
+    admin_id = await router.route(message.from_user.id)
+    if admin_id is None:
         await message.answer("Нет доступных администраторов.")
         return
+    notification = (
+        f"📨 Новое сообщение от @{message.from_user.username if message.from_user.username else 'Отсутствует'} (ID: {message.from_user.id}):\n\n{message.text}"
+    )
+    # Уведомляем только ответственного админа и наблюдателей, а не всех админов сразу
     await db.add_message(
         from_id=message.from_user.id,
-        to_id=admin_ids[0],
-        message=message.text
+        to_id=admin_id,
+        message=message.text,
+        notifications=[
+            outgoing(recipient, notification, get_admin_message_keyboard(message.from_user.id))
+            for recipient in await router.recipients(admin_id)
+        ],
+        update_id=types.Update.get_current().update_id
     )
     await message.answer(
         "✅ Сообщение отправлено администратору",
         reply_markup=get_main_keyboard(await db.is_user_admin(message.from_user.id))
     )
-    for admin_id in admin_ids:
-        try:
-            await message.bot.send_message(
-                admin_id,
-                f"📨 Новое сообщение от @{message.from_user.username if message.from_user.username else 'Отсутствует'} (ID: {message.from_user.id}):\n\n{message.text}",
-                reply_markup=get_admin_message_keyboard(message.from_user.id)
-            )
-        except BotBlocked:
-            print(f"Ошибка: Админ {admin_id} заблокировал бота.")
     await state.finish()
 
 def register_user_handlers(dp: Dispatcher):
+    callbacks = callback_router(dp)
     dp.register_message_handler(start_cmd, commands=['start'])
-    dp.register_callback_query_handler(show_profile, lambda c: c.data == 'profile')
-    dp.register_callback_query_handler(show_dialog_history, lambda c: c.data == 'dialog_history')
-    dp.register_callback_query_handler(start_message, lambda c: c.data == 'write_message')
-    dp.register_callback_query_handler(cancel_message, lambda c: c.data == 'cancel_message', state=DialogStates.waiting_for_message)
+    callbacks.register(PROFILE, show_profile)
+    callbacks.register(DIALOG_HISTORY, show_dialog_history)
+    callbacks.register(HISTORY_PAGE, show_dialog_history)
+    callbacks.register(WRITE_MESSAGE, start_message)
+    callbacks.register(CANCEL_MESSAGE, cancel_message, state=DialogStates.waiting_for_message)
     dp.register_message_handler(process_message, state=DialogStates.waiting_for_message)
\ No newline at end of file
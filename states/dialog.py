@@ -6,4 +6,6 @@ class DialogStates(StatesGroup):
     waiting_for_block_id = State()
     waiting_for_reply = State()
     waiting_for_add_admin_id = State()  # New state for adding admin
-    waiting_for_remove_admin_id = State()  # New state for removing admin
\ No newline at end of file
+    waiting_for_remove_admin_id = State()  # New state for removing admin
+    waiting_for_search_query = State()  # Admin full-text search
+    waiting_for_broadcast_text = State()  # Broadcast to all users
\ No newline at end of file
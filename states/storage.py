@@ -0,0 +1,153 @@
+import asyncio
+import copy
+import json
+import logging
+import time
+import typing
+
+from aiogram.dispatcher.storage import BaseStorage
+
+from database.cache import TTLCache
+from database.db import Database
+
+log = logging.getLogger(__name__)
+
+ChatUser = typing.Tuple[int, int]
+
+class SQLiteStorage(BaseStorage):
+    # FSM-хранилище в той же SQLite, что и остальные данные бота. Горячие состояния живут в LRU-кэше,
+    # изменения копятся в _dirty и сбрасываются в БД одной транзакцией раз в flush_interval секунд.
+    # Состояния, не менявшиеся дольше state_ttl секунд, считаются сброшенными и удаляются из таблицы.
+    def __init__(self, database: Database, state_ttl: float = 86400, cache_size: int = 10000,
+                 flush_interval: float = 0.05, purge_interval: float = 600):
+        self.db = database
+        self.state_ttl = state_ttl
+        self.flush_interval = flush_interval
+        self.purge_interval = purge_interval
+        self._cache = TTLCache(maxsize=cache_size, ttl=min(state_ttl, 3600))
+        self._dirty: typing.Dict[ChatUser, dict] = {}
+        self._flushing: typing.Dict[ChatUser, dict] = {}
+        self._flusher: typing.Optional[asyncio.Task] = None
+        self._last_purge = time.monotonic()
+
+    def _key(self, chat, user) -> ChatUser:
+        chat, user = self.check_address(chat=chat, user=user)
+        return int(chat), int(user)
+
+    async def _load(self, key: ChatUser) -> dict:
+        record = self._dirty.get(key) or self._flushing.get(key)
+        if record is None:
+            record = self._cache.get(key)
+        if record is None:
+            newer_than = int((time.time() - self.state_ttl) * 1000)
+            row = await self.db.fsm_load(key[0], key[1], newer_than)
+            # Пока шло чтение, состояние могли изменить или загрузить заново — прочитанная строка уже устарела
+            newer = self._dirty.get(key) or self._flushing.get(key) or self._cache.get(key)
+            if newer is not None:
+                return newer
+            if row:
+                record = {'state': row[0], 'data': json.loads(row[1]) if row[1] else {}}
+            else:
+                record = {'state': None, 'data': {}}
+            self._cache.set(key, record)
+        return record
+
+    def _store(self, key: ChatUser, record: dict) -> None:
+        self._cache.set(key, record)
+        self._dirty[key] = record
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        delay = self.flush_interval
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.flush()
+                return
+            except Exception:
+                # Уже залогировано в flush, изменения вернулись в _dirty — повторяем с нарастающей паузой,
+                # новый сброс из _store не запланируется, пока эта задача жива
+                delay = min(delay * 2, 5)
+
+    async def flush(self) -> None:
+        if self._dirty:
+            dirty, self._dirty = self._dirty, {}
+            self._flushing = dirty
+            records = [
+                (chat, user, record['state'], json.dumps(record['data'], ensure_ascii=False) if record['data'] else None)
+                for (chat, user), record in dirty.items()
+            ]
+            try:
+                await self.db.fsm_save_many(records)
+            except BaseException:
+                # Не теряем изменения: вернём их в очередь, более свежие записи имеют приоритет
+                log.exception("Не удалось сохранить состояния FSM")
+                self._dirty = {**dirty, **self._dirty}
+                raise
+            finally:
+                self._flushing = {}
+        if time.monotonic() - self._last_purge > self.purge_interval:
+            self._last_purge = time.monotonic()
+            await self.db.fsm_purge(int((time.time() - self.state_ttl) * 1000))
+
+    async def close(self):
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        self._cache.clear()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        record = await self._load(self._key(chat, user))
+        return record['state'] if record['state'] is not None else self.resolve_state(default)
+
+    async def get_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await self._load(self._key(chat, user))
+        return copy.deepcopy(record['data'] or default or {})
+
+    async def set_state(self, *,
+                        chat: typing.Union[str, int, None] = None,
+                        user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        self._store(key, {'state': self.resolve_state(state), 'data': record['data']})
+
+    async def set_data(self, *,
+                       chat: typing.Union[str, int, None] = None,
+                       user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        self._store(key, {'state': record['state'], 'data': copy.deepcopy(data) if data else {}})
+
+    async def update_data(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        new_data = copy.deepcopy(record['data'])
+        new_data.update(data or {}, **kwargs)
+        self._store(key, {'state': record['state'], 'data': new_data})
+
+    async def reset_state(self, *,
+                          chat: typing.Union[str, int, None] = None,
+                          user: typing.Union[str, int, None] = None,
+                          with_data: typing.Optional[bool] = True):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        self._store(key, {'state': None, 'data': {} if with_data else record['data']})
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# Модули читают config.json из текущего каталога при импорте — тесты запускаются из корня проекта
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+from aiogram import Bot, Dispatcher, types
+
+from benchmarks.stub import callback_update, install_stub
+from utils.callbacks import (
+    ALL_DIALOGS, DELETE_DIALOG, DIALOG, DIALOG_HISTORY, DIALOGS_PAGE, HISTORY_PAGE, CallbackRouter, CallbackSchema,
+    callback_router
+)
+
+async def handler(callback_query, state, **kwargs):
+    return kwargs
+
+@pytest.fixture
+def router():
+    router = CallbackRouter(Dispatcher(Bot("123456:" + "A" * 35)))
+    for schema in (ALL_DIALOGS, DIALOGS_PAGE, DIALOG, DELETE_DIALOG, DIALOG_HISTORY, HISTORY_PAGE):
+        router.register(schema, handler)
+    return router
+
+def test_exact_schema_matches_whole_string(router):
+    route, args = router.resolve("all_dialogs")
+    assert route.schema is ALL_DIALOGS and args == {}
+    assert router.resolve("all_dialogs_5") == (None, {})
+
+def test_longest_prefix_wins(router):
+    assert router.resolve("dialog_history")[0].schema is DIALOG_HISTORY
+    route, args = router.resolve("delete_dialog_5")
+    assert route.schema is DELETE_DIALOG and args == {"user_id": 5}
+    route, args = router.resolve("dialog_5")
+    assert route.schema is DIALOG and args == {"user_id": 5, "older": None, "newer": None}
+
+def test_paged_arguments(router):
+    assert router.resolve("dialog_5_o_40")[1] == {"user_id": 5, "older": 40, "newer": None}
+    assert router.resolve("history_n_7")[1] == {"older": None, "newer": 7}
+    assert router.resolve("page")[1] == {"older": None, "newer": None}
+
+def test_malformed_data_does_not_match(router):
+    for data in ("dialog_x", "dialog_5_x_1", "dialog_5_o", "history_o_x", "unknown", ""):
+        assert router.resolve(data) == (None, {}), data
+
+def test_duplicate_registration_is_rejected(router):
+    with pytest.raises(ValueError):
+        router.register(CallbackSchema("dialog", "user_id"), handler)
+    with pytest.raises(ValueError):
+        router.register(CallbackSchema("all_dialogs"), handler)
+
+def test_new_builds_data_that_resolves_back(router):
+    route, args = router.resolve(DELETE_DIALOG.new(user_id=42))
+    assert route.schema is DELETE_DIALOG and args == {"user_id": 42}
+
+def test_unknown_callback_is_answered():
+    async def scenario():
+        bot = Bot("123456:" + "A" * 35)
+        stub = install_stub(bot)
+        dp = Dispatcher(bot)
+        Bot.set_current(bot)
+        Dispatcher.set_current(dp)
+        handled = []
+
+        async def block(callback_query, state, user_id):
+            handled.append(user_id)
+        callback_router(dp).register(CallbackSchema("block", "user_id"), block, state="*")
+        await dp.process_update(types.Update(**callback_update(1, 10, "block_5")))
+        await dp.process_update(types.Update(**callback_update(2, 10, "search_o_10")))
+        return handled, stub.calls["answerCallbackQuery"]
+    assert asyncio.run(scenario()) == ([5], 1)
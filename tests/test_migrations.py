@@ -0,0 +1,111 @@
+import asyncio
+import datetime
+import logging
+import sqlite3
+
+from database.db import Database
+from database.migrations import MIGRATIONS
+
+# Схема и формат дат до первой миграции: даты текстом, в сообщениях вместо дня месяца буквальная d
+BASELINE_SCHEMA = (
+    """
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        full_name TEXT,
+        registration_date TEXT,
+        is_blocked INTEGER DEFAULT 0,
+        is_admin INTEGER DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_id INTEGER,
+        to_id INTEGER,
+        message TEXT,
+        date TEXT,
+        is_read INTEGER DEFAULT 0
+    )
+    """,
+)
+
+USER, ADMIN = 100, 1
+
+def baseline(path, dates):
+    with sqlite3.connect(path) as conn:
+        for statement in BASELINE_SCHEMA:
+            conn.execute(statement)
+        conn.executemany(
+            "INSERT INTO users (user_id, username, full_name, registration_date, is_admin) VALUES (?, ?, ?, ?, ?)",
+            [(USER, "user", "Пользователь", "2024-03-01 10:00:00", 0), (ADMIN, "admin", "Админ", None, 1)]
+        )
+        for index, date in enumerate(dates):
+            sender, recipient = (USER, ADMIN) if index % 2 == 0 else (ADMIN, USER)
+            conn.execute(
+                "INSERT INTO messages (from_id, to_id, message, date) VALUES (?, ?, ?, ?)",
+                (sender, recipient, f"сообщение номер {index}", date)
+            )
+
+def upgrade(path):
+    async def scenario():
+        database = Database(str(path), readers=1)
+        await database.init()
+        await database.close()
+    asyncio.run(scenario())
+
+def ms(*moment):
+    return int(datetime.datetime(*moment).timestamp() * 1000)
+
+def test_baseline_upgrades_to_latest_version(tmp_path):
+    path = tmp_path / "legacy.db"
+    baseline(path, ["2024-03-d 10:00:00", "2024-03-d 12:00:00", "2024-03-d 09:00:00"])
+    upgrade(path)
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+        assert columns == ["user_id", "username", "full_name", "registration_date", "is_blocked", "is_admin"]
+        # Текст даты регистрации — локальное время, как и у сообщений
+        assert conn.execute("SELECT registration_date FROM users WHERE user_id = ?", (USER,)).fetchone()[0] == \
+            ms(2024, 3, 1, 10)
+        assert conn.execute(
+            "SELECT user_id, admin_id, last_message_id, last_message_at, message_count FROM conversations"
+        ).fetchall() == [(USER, ADMIN, 3, ms(2024, 3, 2, 9), 3)]
+        matched = conn.execute("SELECT rowid FROM messages_fts WHERE messages_fts MATCH 'номер' ORDER BY rowid")
+        assert [row[0] for row in matched] == [1, 2, 3]
+        assert conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'").fetchone()[0] == 3
+
+def test_lost_days_are_reconstructed_and_original_text_kept(tmp_path, caplog):
+    path = tmp_path / "legacy.db"
+    baseline(path, [
+        "2024-03-d 10:00:00",
+        "2024-03-d 12:00:00",
+        "2024-03-d 09:00:00",
+        "не дата",
+        "2024-03-05 11:00:00",
+        "2024-03-d 07:00:00",
+    ])
+    with caplog.at_level(logging.WARNING, logger="database.migrations"):
+        upgrade(path)
+    with sqlite3.connect(path) as conn:
+        rows = conn.execute("SELECT id, date, date_legacy FROM messages ORDER BY id").fetchall()
+    assert rows == [
+        (1, ms(2024, 3, 1, 10), "2024-03-d 10:00:00"),
+        (2, ms(2024, 3, 1, 12), "2024-03-d 12:00:00"),
+        (3, ms(2024, 3, 2, 9), "2024-03-d 09:00:00"),
+        (4, None, "не дата"),
+        (5, ms(2024, 3, 5, 11), None),
+        (6, ms(2024, 3, 6, 7), "2024-03-d 07:00:00"),
+    ]
+    assert "id: 4" in caplog.text
+
+def test_upgrade_is_idempotent(tmp_path):
+    path = tmp_path / "legacy.db"
+    baseline(path, ["2024-03-d 10:00:00", "2024-03-d 09:00:00"])
+    upgrade(path)
+    with sqlite3.connect(path) as conn:
+        before = conn.execute("SELECT * FROM messages ORDER BY id").fetchall()
+    upgrade(path)
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == len(MIGRATIONS)
+        assert conn.execute("SELECT * FROM messages ORDER BY id").fetchall() == before
@@ -0,0 +1,84 @@
+import asyncio
+import sqlite3
+
+from aiogram.utils.exceptions import BotBlocked, NetworkError
+
+from database.db import Database
+from utils.outbox import OutboxWorker, outgoing
+from utils.ratelimit import ChatRateLimiter
+
+class FakeBot:
+    # send_message по очереди выбрасывает заготовленные ошибки для чата, потом отправляет
+    def __init__(self, errors=None):
+        self.errors = {chat_id: list(queue) for chat_id, queue in (errors or {}).items()}
+        self.sent = []
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        queue = self.errors.get(chat_id)
+        if queue:
+            raise queue.pop(0)
+        self.sent.append((chat_id, text))
+
+def outbox_rows(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT chat_id, text, status, attempts FROM outbox ORDER BY id").fetchall()
+
+def run(path, bot, notifications, drains, **worker_args):
+    async def scenario():
+        database = Database(str(path), readers=1)
+        await database.init()
+        try:
+            await database.enqueue_messages(notifications)
+            worker = OutboxWorker(database, ChatRateLimiter(1000, 1000), backoff=0, **worker_args)
+            for _ in range(drains):
+                await worker.drain_once(bot)
+        finally:
+            await database.close()
+    asyncio.run(scenario())
+
+def test_delivers_in_chat_order(tmp_path):
+    path = tmp_path / "outbox.db"
+    bot = FakeBot()
+    run(path, bot, [outgoing(1, "первое"), outgoing(2, "другой чат"), outgoing(1, "второе")], drains=2)
+    assert bot.sent == [(1, "первое"), (2, "другой чат"), (1, "второе")]
+    assert outbox_rows(path) == []
+
+def test_network_error_is_retried(tmp_path):
+    path = tmp_path / "outbox.db"
+    bot = FakeBot({1: [NetworkError("timeout")]})
+    run(path, bot, [outgoing(1, "привет")], drains=2)
+    assert bot.sent == [(1, "привет")]
+    assert outbox_rows(path) == []
+
+def test_retries_end_in_dead_letter(tmp_path):
+    path = tmp_path / "outbox.db"
+    bot = FakeBot({1: [NetworkError("timeout")] * 3})
+    run(path, bot, [outgoing(1, "привет")], drains=3, max_attempts=2)
+    assert bot.sent == []
+    assert outbox_rows(path) == [(1, "привет", "dead", 2)]
+
+def test_blocked_chat_goes_dead_without_blocking_others(tmp_path):
+    path = tmp_path / "outbox.db"
+    bot = FakeBot({1: [BotBlocked("Forbidden: bot was blocked by the user")]})
+    run(path, bot, [outgoing(1, "первое"), outgoing(2, "другой чат"), outgoing(1, "второе")], drains=2)
+    assert bot.sent == [(2, "другой чат"), (1, "второе")]
+    assert outbox_rows(path) == [(1, "первое", "dead", 1)]
+
+def test_purge_removes_only_old_dead_rows(tmp_path):
+    path = tmp_path / "outbox.db"
+    bot = FakeBot({1: [BotBlocked("Forbidden: bot was blocked by the user")], 2: [NetworkError("timeout")]})
+    run(path, bot, [outgoing(1, "старое"), outgoing(2, "ждёт повтора")], drains=1)
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE outbox SET created_at = created_at - 8 * 86400 * 1000")
+    bot = FakeBot({2: [NetworkError("timeout")], 3: [BotBlocked("Forbidden: bot was blocked by the user")]})
+    run(path, bot, [outgoing(3, "свежее")], drains=1)
+
+    async def purge():
+        database = Database(str(path), readers=1)
+        await database.init()
+        try:
+            await OutboxWorker(database, ChatRateLimiter(1000, 1000), dead_ttl=7 * 86400)._purge_dead()
+        finally:
+            await database.close()
+    asyncio.run(purge())
+    assert outbox_rows(path) == [(2, "ждёт повтора", "pending", 2), (3, "свежее", "dead", 1)]
@@ -0,0 +1,35 @@
+import asyncio
+import time
+
+from utils.ratelimit import BucketTable, ChatRateLimiter, TokenBucket
+
+def test_bucket_allows_burst_then_refills():
+    bucket = TokenBucket(rate=100, capacity=3)
+    assert [bucket.try_acquire() for _ in range(4)] == [True, True, True, False]
+    time.sleep(0.02)
+    assert bucket.try_acquire()
+
+def test_table_evicts_least_recently_used():
+    table = BucketTable(rate=1, max_size=2)
+    first = table.get(1)
+    table.get(2)
+    table.get(1)
+    table.get(3)
+    assert len(table) == 2
+    assert table.get(1) is first
+    assert table.get(2) is not None and len(table) == 2
+
+def test_limiter_spaces_one_chat_but_not_others():
+    async def scenario():
+        limiter = ChatRateLimiter(global_rate=1000, per_chat_rate=20)
+        started = time.perf_counter()
+        await asyncio.gather(*(limiter.acquire(chat_id) for chat_id in range(10)))
+        parallel = time.perf_counter() - started
+        started = time.perf_counter()
+        for _ in range(3):
+            await limiter.acquire(42)
+        return parallel, time.perf_counter() - started
+    parallel, sequential = asyncio.run(scenario())
+    # Разные чаты не ждут друг друга, второе и третье сообщение в один чат ждут по 1/20 с
+    assert parallel < 0.03
+    assert sequential >= 0.09
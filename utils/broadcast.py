@@ -0,0 +1,205 @@
+import asyncio
+import itertools
+import json
+import logging
+import time
+from typing import Dict, List, Optional
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from aiogram.utils.exceptions import NetworkError, RestartingTelegram, RetryAfter, TelegramAPIError
+
+from database.db import Database, db as default_db
+from utils.callbacks import BROADCAST_STOP
+from utils.keyboards import get_main_keyboard
+from utils.outbox import limiter
+from utils.ratelimit import ChatRateLimiter
+
+with open('config.json', 'r') as f:
+    config = json.load(f)
+
+log = logging.getLogger(__name__)
+
+def progress_text(broadcast: Dict) -> str:
+    title = {
+        "running": "📣 Рассылка",
+        "done": "✅ Рассылка завершена",
+        "cancelled": "⛔ Рассылка остановлена",
+    }[broadcast['status']]
+    return (
+        f"{title} #{broadcast['id']}\n\n"
+        f"Отправлено: {broadcast['sent']}\n"
+        f"Ошибок: {broadcast['failed']}\n"
+        f"Всего получателей: {broadcast['total']}"
+    )
+
+def progress_keyboard(broadcast: Dict) -> InlineKeyboardMarkup:
+    if broadcast['status'] != 'running':
+        return get_main_keyboard(True)
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("⛔ Остановить", callback_data=BROADCAST_STOP.new(broadcast_id=broadcast['id'])))
+    return keyboard
+
+class Broadcaster:
+    # Рассылка по всем незаблокированным пользователям. Получатели читаются пачками по user_id, отправка идёт
+    # под общим с outbox лимитером; после каждой пачки в БД пишется контрольная точка и ошибки доставки,
+    # так что после рестарта рассылка продолжается со следующего пользователя.
+    # Рассылки ведёт один процесс (owner, в режиме нескольких процессов — воркер 0): остальные только создают
+    # запись, а владелец подхватывает её по уведомлению и не реже раза в poll_interval — так же продолжаются
+    # рассылки после рестарта и прерванные ошибкой.
+    def __init__(self, database: Database, limiter: ChatRateLimiter, concurrency: int = 10, batch_size: int = 100,
+                 retries: int = 3, backoff: float = 1.0, progress_interval: float = 5.0, poll_interval: float = 30.0):
+        self.db = database
+        self.limiter = limiter
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.progress_interval = progress_interval
+        self.poll_interval = poll_interval
+        self.owner = True
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._watcher: Optional[asyncio.Task] = None
+
+    async def start(self, bot, admin_id: int, text: str, progress_chat_id: int, progress_message_id: int) -> Dict:
+        broadcast = await self.db.create_broadcast(admin_id, text, progress_chat_id, progress_message_id)
+        if self.owner:
+            self._spawn(bot, broadcast['id'])
+        return broadcast
+
+    def watch(self, bot) -> None:
+        if self._watcher is None:
+            self._watcher = asyncio.create_task(self._watch(bot))
+
+    async def _watch(self, bot) -> None:
+        while True:
+            self.db.broadcasts_ready.clear()
+            try:
+                await self.resume(bot)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Не удалось проверить незавершённые рассылки")
+            try:
+                await asyncio.wait_for(self.db.broadcasts_ready.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def resume(self, bot) -> int:
+        started = [broadcast_id for broadcast_id in await self.db.get_running_broadcasts()
+                   if self._spawn(bot, broadcast_id)]
+        if started:
+            log.info("Продолжаются рассылки: %s", started)
+        return len(started)
+
+    def _spawn(self, bot, broadcast_id: int) -> bool:
+        if broadcast_id in self._tasks:
+            return False
+        task = asyncio.create_task(self._run(bot, broadcast_id))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+        return True
+
+    async def cancel(self, broadcast_id: int) -> Optional[Dict]:
+        await self.db.finish_broadcast(broadcast_id, 'cancelled')
+        task = self._tasks.get(broadcast_id)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        return await self.db.get_broadcast(broadcast_id)
+
+    async def stop(self) -> None:
+        # Остановка бота: статус остаётся running, контрольная точка уже в БД
+        tasks = list(self._tasks.values())
+        if self._watcher is not None:
+            tasks.append(self._watcher)
+            self._watcher = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, bot, broadcast_id: int) -> None:
+        broadcast = await self.db.get_broadcast(broadcast_id)
+        if broadcast is None or broadcast['status'] != 'running':
+            return
+        reported = time.monotonic()
+        try:
+            async for batch in self.db.iter_broadcast_recipients(broadcast['last_user_id'], self.batch_size):
+                await self._send_batch(bot, broadcast, batch)
+                if broadcast['status'] != 'running':
+                    # Остановлена из другого процесса, прогресс там уже показан
+                    return
+                if time.monotonic() - reported >= self.progress_interval:
+                    reported = time.monotonic()
+                    await self._report(bot, broadcast)
+            await self.db.finish_broadcast(broadcast_id, 'done')
+            broadcast['status'] = 'done'
+            await self._report(bot, broadcast)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("Рассылка %s прервана, продолжится при следующей проверке", broadcast_id)
+
+    async def _send_batch(self, bot, broadcast: Dict, batch: List[int]) -> None:
+        outcomes: Dict[int, Optional[str]] = {}
+
+        async def deliver(user_id: int) -> None:
+            async with self.semaphore:
+                outcomes[user_id] = await self._send(bot, user_id, broadcast['text'])
+
+        try:
+            await asyncio.gather(*(deliver(user_id) for user_id in batch))
+        finally:
+            # При отмене сохраняем непрерывный префикс пачки: после рестарта повторно уйдут
+            # только сообщения, отправленные вне очереди, а их не больше concurrency
+            done = list(itertools.takewhile(lambda user_id: user_id in outcomes, batch))
+            if done:
+                failures = [(user_id, outcomes[user_id]) for user_id in done if outcomes[user_id] is not None]
+                sent = len(done) - len(failures)
+                broadcast['status'] = await self.db.save_broadcast_progress(broadcast['id'], done[-1], sent, failures)
+                broadcast['last_user_id'] = done[-1]
+                broadcast['sent'] += sent
+                broadcast['failed'] += len(failures)
+
+    async def _send(self, bot, user_id: int, text: str) -> Optional[str]:
+        # None — доставлено, иначе текст ошибки для broadcast_failures
+        attempt = 0
+        while True:
+            await self.limiter.acquire(user_id)
+            try:
+                await bot.send_message(user_id, text)
+                return None
+            except RetryAfter as e:
+                delay = e.timeout
+            except (NetworkError, RestartingTelegram, asyncio.TimeoutError) as e:
+                if attempt >= self.retries:
+                    return f"{type(e).__name__}: {e}"
+                delay = self.backoff * 2 ** attempt
+                attempt += 1
+            except TelegramAPIError as e:
+                # BotBlocked, ChatNotFound, UserDeactivated — повтор не поможет
+                return f"{type(e).__name__}: {e}"
+            await asyncio.sleep(delay)
+
+    async def _report(self, bot, broadcast: Dict) -> None:
+        if not broadcast['progress_chat_id']:
+            return
+        try:
+            await self.limiter.acquire(broadcast['progress_chat_id'])
+            await bot.edit_message_text(
+                progress_text(broadcast),
+                broadcast['progress_chat_id'],
+                broadcast['progress_message_id'],
+                reply_markup=progress_keyboard(broadcast)
+            )
+        except TelegramAPIError as e:
+            # MessageNotModified, удалённое сообщение и т.п. не должны останавливать рассылку
+            log.debug("Не удалось обновить прогресс рассылки %s: %s", broadcast['id'], e)
+
+broadcaster = Broadcaster(
+    default_db,
+    limiter,
+    concurrency=config.get('BROADCAST_CONCURRENCY', 10),
+    batch_size=config.get('BROADCAST_BATCH_SIZE', 100),
+    progress_interval=config.get('BROADCAST_PROGRESS_INTERVAL', 5),
+    poll_interval=config.get('BROADCAST_POLL_INTERVAL', 30)
+)
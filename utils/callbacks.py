@@ -0,0 +1,153 @@
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import Dispatcher, types
+from aiogram.dispatcher.filters.builtin import StateFilter
+
+log = logging.getLogger(__name__)
+
+# Схемы callback_data. Формат прежний — сегменты через "_", чтобы кнопки в уже отправленных сообщениях
+# продолжали работать: префикс, затем целые поля по порядку, у листаемых схем — хвост o_<id> (старше)
+# или n_<id> (новее).
+
+class CallbackSchema:
+    def __init__(self, prefix: str, *fields: str, paged: bool = False):
+        self.prefix = prefix
+        self.fields = fields
+        self.paged = paged
+
+    @property
+    def exact(self) -> bool:
+        # Схема без аргументов совпадает только целиком
+        return not self.fields and not self.paged
+
+    def new(self, **values: int) -> str:
+        return "_".join([self.prefix, *(str(int(values[field])) for field in self.fields)])
+
+    def parse(self, parts: List[str]) -> Optional[Dict[str, Any]]:
+        # Сегменты после префикса → аргументы хендлера; None, если строка не подходит под схему
+        tail = len(parts) - len(self.fields)
+        if tail not in ((0, 2) if self.paged else (0,)):
+            return None
+        if not all(part.isdigit() for part in parts[:len(self.fields)]):
+            return None
+        args: Dict[str, Any] = {field: int(part) for field, part in zip(self.fields, parts)}
+        if self.paged:
+            older, newer = parse_cursor(parts[len(self.fields):])
+            if tail and older is None and newer is None:
+                return None
+            args.update(older=older, newer=newer)
+        return args
+
+def parse_cursor(parts: List[str]) -> Tuple[Optional[int], Optional[int]]:
+    # Возвращает (older_than, newer_than) из хвоста callback_data вида ..._o_<id> / ..._n_<id>
+    if len(parts) >= 2 and parts[-2] in ("o", "n") and parts[-1].isdigit():
+        cursor = int(parts[-1])
+        return (cursor, None) if parts[-2] == "o" else (None, cursor)
+    return None, None
+
+MAIN_MENU = CallbackSchema("main_menu")
+IGNORE = CallbackSchema("ignore")
+PROFILE = CallbackSchema("profile")
+WRITE_MESSAGE = CallbackSchema("write_message")
+CANCEL_MESSAGE = CallbackSchema("cancel_message")
+DIALOG_HISTORY = CallbackSchema("dialog_history")
+HISTORY_PAGE = CallbackSchema("history", paged=True)
+ALL_DIALOGS = CallbackSchema("all_dialogs")
+DIALOGS_PAGE = CallbackSchema("page", paged=True)
+DIALOG = CallbackSchema("dialog", "user_id", paged=True)
+DELETE_DIALOG = CallbackSchema("delete_dialog", "user_id")
+BLOCK = CallbackSchema("block", "user_id")
+UNBLOCK = CallbackSchema("unblock", "user_id")
+REPLY = CallbackSchema("reply", "user_id")
+MANAGE_ADMINS = CallbackSchema("manage_admins")
+ADD_ADMIN = CallbackSchema("add_admin")
+REMOVE_ADMIN = CallbackSchema("remove_admin")
+LIST_ADMINS = CallbackSchema("list_admins")
+SEARCH = CallbackSchema("search")
+SEARCH_PAGE = CallbackSchema("search_page", "cursor")
+BROADCAST = CallbackSchema("broadcast")
+BROADCAST_CONFIRM = CallbackSchema("broadcast_confirm")
+BROADCAST_STOP = CallbackSchema("broadcast_stop", "broadcast_id")
+
+Handler = Callable[..., Awaitable[Any]]
+
+class Route:
+    def __init__(self, schema: CallbackSchema, handler: Handler, state_filter: StateFilter):
+        self.schema = schema
+        self.handler = handler
+        self.state_filter = state_filter
+
+class _Node:
+    __slots__ = ("children", "route")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.route: Optional[Route] = None
+
+class CallbackRouter:
+    # Один зарегистрированный в aiogram хендлер на все колбэки. Схемы без аргументов ищутся в словаре
+    # по всей строке, остальные — в дереве по сегментам префикса; побеждает самый длинный префикс, так что
+    # dialog_5 не спутать с delete_dialog_5, а dialog_history — с dialog_<id>. Стоимость поиска зависит
+    # от числа сегментов в callback_data, а не от числа кнопок.
+    def __init__(self, dispatcher: Dispatcher):
+        self.dispatcher = dispatcher
+        self._exact: Dict[str, Route] = {}
+        self._root = _Node()
+
+    def register(self, schema: CallbackSchema, handler: Handler, state=None) -> None:
+        route = Route(schema, handler, StateFilter(self.dispatcher, state))
+        if schema.exact:
+            if schema.prefix in self._exact:
+                raise ValueError(f"Колбэк {schema.prefix} уже зарегистрирован")
+            self._exact[schema.prefix] = route
+            return
+        node = self._root
+        for segment in schema.prefix.split("_"):
+            node = node.children.setdefault(segment, _Node())
+        if node.route is not None:
+            raise ValueError(f"Колбэк {schema.prefix}_… уже зарегистрирован")
+        node.route = route
+
+    def resolve(self, data: str) -> Tuple[Optional[Route], Dict[str, Any]]:
+        route = self._exact.get(data)
+        if route is not None:
+            return route, {}
+        parts = data.split("_")
+        node, found, depth = self._root, None, 0
+        for index, part in enumerate(parts):
+            node = node.children.get(part)
+            if node is None:
+                break
+            if node.route is not None:
+                found, depth = node.route, index + 1
+        if found is None:
+            return None, {}
+        args = found.schema.parse(parts[depth:])
+        return (found, args) if args is not None else (None, {})
+
+    async def match(self, callback_query: types.CallbackQuery):
+        route, args = self.resolve(callback_query.data or "")
+        if route is None or not await route.state_filter.check(callback_query):
+            return False
+        return {"callback_route": route, "callback_args": args}
+
+    async def dispatch(self, callback_query: types.CallbackQuery, state, callback_route: Route, callback_args: Dict):
+        return await callback_route.handler(callback_query, state, **callback_args)
+
+    async def fallback(self, callback_query: types.CallbackQuery):
+        # Кнопка из старого сообщения (схема удалена или поменялась) или не для текущего состояния:
+        # отвечаем, чтобы у пользователя не крутились часики на кнопке
+        log.debug("Колбэк без обработчика: %r", callback_query.data)
+        await callback_query.answer("Кнопка устарела, откройте меню заново: /start")
+
+def callback_router(dp: Dispatcher) -> CallbackRouter:
+    # Роутер создаётся при первой регистрации и хранится в данных диспетчера
+    router = dp.get("callback_router")
+    if router is None:
+        router = dp["callback_router"] = CallbackRouter(dp)
+        dp.register_callback_query_handler(router.dispatch, router.match, state="*")
+        # Последним — ответ на колбэки, которые роутер не разобрал. Все колбэки регистрируются через роутер,
+        # хендлер, добавленный в диспетчер напрямую после этого места, не получит ни одного колбэка.
+        dp.register_callback_query_handler(router.fallback, state="*")
+    return router
@@ -0,0 +1,13 @@
+import datetime
+from typing import Optional
+
+# В БД даты хранятся целыми мс от эпохи; в локальное время и текст переводим только при выводе
+
+def format_timestamp(ms: Optional[int], fmt: str = "%Y-%m-%d %H:%M:%S") -> str:
+    if ms is None:
+        return "—"
+    return datetime.datetime.fromtimestamp(ms / 1000).strftime(fmt)
+
+def parse_date(text: str) -> int:
+    # ГГГГ-ММ-ДД → локальная полночь этого дня в мс от эпохи
+    return int(datetime.datetime.strptime(text, "%Y-%m-%d").timestamp() * 1000)
@@ -0,0 +1,82 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Set
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from database.db import Database, db as default_db
+
+with open('config.json', 'r') as f:
+    config = json.load(f)
+
+log = logging.getLogger(__name__)
+
+class UpdateDedupMiddleware(BaseMiddleware):
+    # Пропускает апдейты, которые уже обработаны: повторная доставка webhook, повтор getUpdates после рестарта.
+    # update_id записывается в processed_updates после обработки; процесс, упавший посреди хендлера,
+    # апдейт не отметит — при повторе хендлер выполнится снова, а add_message по ключу update_id
+    # не сохранит сообщение и не поставит уведомления второй раз. Назначение и снятие админа ставят
+    # уведомление только при смене флага, в той же транзакции. Ответы в чат самого апдейта (подтверждения,
+    # правка меню) не ключуются и при таком повторе могут прийти ещё раз.
+    # Сначала проверяются апдейты в работе и недавние в памяти, в БД идём только при промахе.
+    def __init__(self, database: Database, ttl: float = 86400, max_size: int = 100000,
+                 recent_size: int = 10000, prune_every: int = 1000):
+        super().__init__()
+        self.db = database
+        self.ttl = ttl
+        self.max_size = max_size
+        self.recent_size = recent_size
+        self.prune_every = prune_every
+        self._in_flight: Set[int] = set()
+        self._recent: "OrderedDict[int, None]" = OrderedDict()
+        self.counters = {"processed": 0, "skipped_memory": 0, "skipped_db": 0}
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        update_id = update.update_id
+        if update_id in self._in_flight or update_id in self._recent:
+            self.counters["skipped_memory"] += 1
+            raise CancelHandler()
+        # В работу берём до запроса к БД, чтобы одновременные повторы отсеялись по памяти
+        self._in_flight.add(update_id)
+        if await self.db.is_update_processed(update_id):
+            self._in_flight.discard(update_id)
+            self.counters["skipped_db"] += 1
+            self._remember(update_id)
+            raise CancelHandler()
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        # Вызывается и после исключения в хендлере — такой апдейт тоже не повторяем, он упадёт так же
+        update_id = update.update_id
+        self._in_flight.discard(update_id)
+        # Task.cancelling() есть только с Python 3.11; на более старых отмену не различаем и апдейт отмечается
+        cancelling = getattr(asyncio.current_task(), "cancelling", None)
+        if cancelling is not None and cancelling():
+            # Обработку прервала остановка процесса — не отмечаем, при повторной доставке апдейт выполнится
+            return
+        self._remember(update_id)
+        await self.db.mark_update_processed(update_id)
+        self.counters["processed"] += 1
+        if self.counters["processed"] % self.prune_every == 0:
+            removed = await self.db.prune_processed_updates(int((time.time() - self.ttl) * 1000), self.max_size)
+            log.debug("Удалено старых записей об апдейтах: %s", removed)
+
+    def _remember(self, update_id: int) -> None:
+        self._recent[update_id] = None
+        self._recent.move_to_end(update_id)
+        while len(self._recent) > self.recent_size:
+            self._recent.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self.counters, "in_flight": len(self._in_flight)}
+
+dedup = UpdateDedupMiddleware(
+    default_db,
+    ttl=config.get('UPDATE_DEDUP_TTL', 86400),
+    max_size=config.get('UPDATE_DEDUP_MAX', 100000),
+    recent_size=config.get('UPDATE_DEDUP_RECENT', 10000)
+)
@@ -0,0 +1,100 @@
+import asyncio
+import csv
+import datetime
+import gzip
+import json
+import logging
+import os
+import tempfile
+from typing import Dict, List, Optional, Set
+
+from aiogram import types
+
+from database.db import EXPORT_COLUMNS, Database
+from utils.dates import parse_date
+
+log = logging.getLogger(__name__)
+
+FORMATS = ("jsonl", "csv")
+# Лимит Bot API на отправку документа
+UPLOAD_LIMIT = 50 * 1024 * 1024
+
+_tasks: Set[asyncio.Task] = set()
+
+def parse_options(args: List[str]) -> Dict:
+    # Аргументы команды /export: jsonl|csv, gz, user=<id>, admin=<id>, from=ГГГГ-ММ-ДД, to=ГГГГ-ММ-ДД
+    options = {"fmt": "jsonl", "compress": False, "filters": {}}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if arg in FORMATS:
+            options["fmt"] = arg
+        elif arg == "gz":
+            options["compress"] = True
+        elif key in ("user", "admin") and value.lstrip('-').isdigit():
+            options["filters"][f"{key}_id"] = int(value)
+        elif key in ("from", "to") and value:
+            options["filters"]["since" if key == "from" else "until"] = parse_date(value)
+        else:
+            raise ValueError(f"Непонятный параметр: {arg}")
+    return options
+
+def export_filename(fmt: str, compress: bool) -> str:
+    return f"feedback_{datetime.datetime.now():%Y%m%d_%H%M%S}.{fmt}" + (".gz" if compress else "")
+
+def _write_batch(f, writer, fmt: str, batch: List[Dict]) -> None:
+    if fmt == "csv":
+        writer.writerows([[row[column] for column in EXPORT_COLUMNS] for row in batch])
+    else:
+        f.write("".join(json.dumps(row, ensure_ascii=False) + "\n" for row in batch))
+
+async def export_messages(database: Database, path: str, fmt: str = "jsonl", compress: bool = False,
+                          **filters) -> int:
+    # Пишет выгрузку в файл, не держа в памяти больше одной пачки. Кодирование, сжатие и запись
+    # уходят в поток, чтобы большие выгрузки не останавливали цикл событий.
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    opener = gzip.open if compress else open
+    f = await asyncio.to_thread(opener, path, "wt", encoding="utf-8", newline="")
+    count = 0
+    try:
+        writer = csv.writer(f) if fmt == "csv" else None
+        if writer is not None:
+            await asyncio.to_thread(writer.writerow, EXPORT_COLUMNS)
+        async for batch in database.stream_messages(**filters):
+            await asyncio.to_thread(_write_batch, f, writer, fmt, batch)
+            count += len(batch)
+    finally:
+        await asyncio.to_thread(f.close)
+    return count
+
+async def _send_export(bot, database: Database, chat_id: int, options: Dict) -> None:
+    filename = export_filename(options["fmt"], options["compress"])
+    fd, path = tempfile.mkstemp(suffix="_" + filename)
+    os.close(fd)
+    try:
+        count = await export_messages(database, path, options["fmt"], options["compress"], **options["filters"])
+        size = os.path.getsize(path)
+        if size > UPLOAD_LIMIT:
+            await bot.send_message(
+                chat_id,
+                f"Выгрузка занимает {size // (1024 * 1024)} МБ — больше лимита Telegram. "
+                f"Сузьте фильтры, добавьте gz или воспользуйтесь python3 export.py на сервере."
+            )
+            return
+        await bot.send_document(chat_id, types.InputFile(path, filename=filename), caption=f"📦 Сообщений: {count}")
+    except Exception:
+        log.exception("Ошибка выгрузки для чата %s", chat_id)
+        await bot.send_message(chat_id, "Не удалось подготовить выгрузку.")
+    finally:
+        os.remove(path)
+
+def start_export(bot, database: Database, chat_id: int, options: Dict) -> asyncio.Task:
+    # Выгрузка идёт в фоне: хендлер отвечает сразу, документ приходит по готовности
+    task = asyncio.create_task(_send_export(bot, database, chat_id, options))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+async def wait_exports(timeout: Optional[float] = None) -> None:
+    if _tasks:
+        await asyncio.wait(list(_tasks), timeout=timeout)
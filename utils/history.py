@@ -0,0 +1,97 @@
+import json
+from typing import Dict, List, Optional, Tuple
+
+from database.cache import TTLCache
+from database.db import Database, db
+from utils.dates import format_timestamp
+
+with open('config.json', 'r') as f:
+    config = json.load(f)
+
+# Лимит Telegram на текст сообщения, считается в UTF-16 (эмодзи занимают две единицы)
+MESSAGE_LIMIT = 4096
+SEPARATOR = "➖➖➖➖➖➖➖➖"
+
+# (текст, курсор новее, курсор старше) — как у Database.get_history_page
+HistoryPage = Tuple[str, Optional[int], Optional[int]]
+
+def text_length(text: str) -> int:
+    return len(text.encode('utf-16-le')) // 2
+
+def _truncate(text: str, limit: int) -> str:
+    if text_length(text) <= limit:
+        return text
+    limit = max(limit - 1, 0)
+    while text_length(text) > limit:
+        text = text[:max(0, len(text) - (text_length(text) - limit))]
+    return text + "…"
+
+def _admin_entry(msg: Dict, viewer_id: int) -> Tuple[str, str]:
+    who = "👑 Админ" if msg['from_id'] == viewer_id else "👤 Пользователь"
+    return f"{who} (@{msg['username'] if msg['username'] else 'Отсутствует'}): ", msg['message']
+
+def _user_entry(msg: Dict, viewer_id: int) -> Tuple[str, str]:
+    return ("📤 " if msg['from_id'] == viewer_id else "📥 "), msg['message']
+
+def _entry(direction: str, message: str, date: Optional[int], limit: int) -> str:
+    tail = f"\nДата: {format_timestamp(date)}\n{SEPARATOR}\n"
+    # Одно сообщение длиннее лимита обрезаем, чтобы страница всё равно отрисовалась
+    return direction + _truncate(message or "", limit - text_length(direction) - text_length(tail)) + tail
+
+class HistoryRenderer:
+    # Отрисовывает страницу истории диалога. Сообщения, не влезающие в лимит Telegram, уходят на соседнюю
+    # страницу: страница режется по границе сообщения, а курсоры навигации сдвигаются на последнее вошедшее.
+    # Готовые страницы кэшируются по (user_id, admin_id, id последнего сообщения, страница, вид) —
+    # новое сообщение меняет id последнего, и старые записи просто перестают совпадать.
+    # admin_id=None — вся переписка пользователя со всеми админами, как её видит сам пользователь.
+    def __init__(self, database: Database, cache_size: int = 2000, cache_ttl: float = 600, limit: int = MESSAGE_LIMIT):
+        self.db = database
+        self.limit = limit
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+
+    async def render(self, user_id: int, admin_id: Optional[int], viewer_id: int, header: str,
+                     before_id: Optional[int] = None, after_id: Optional[int] = None,
+                     page_size: int = 10) -> Optional[HistoryPage]:
+        last_id = await self.db.get_last_message_id(user_id, admin_id)
+        if not last_id:
+            return None
+        admin_view = viewer_id == admin_id
+        key = (user_id, admin_id, last_id, (before_id, after_id, page_size), admin_view)
+        page = self.cache.get(key)
+        if page is None:
+            history, newer, older = await self.db.get_history_page(
+                user_id, admin_id, before_id=before_id, after_id=after_id, limit=page_size
+            )
+            if not history:
+                return None
+            page = self._build(history, newer, older, viewer_id, header, admin_view, after_id is not None)
+            self.cache.set(key, page)
+        return page
+
+    def _build(self, history: List[Dict], newer: Optional[int], older: Optional[int], viewer_id: int,
+               header: str, admin_view: bool, ascending: bool) -> HistoryPage:
+        entry = _admin_entry if admin_view else _user_entry
+        budget = self.limit - text_length(header)
+        entries = [_entry(*entry(msg, viewer_id), msg['date'], budget) for msg in history]
+        # history идёт от новых к старым. При листании вперёд (ascending) важны самые старые сообщения —
+        # они ближе к курсору, поэтому при переполнении отбрасываем новые, иначе — старые.
+        order = range(len(entries) - 1, -1, -1) if ascending else range(len(entries))
+        kept = []
+        for index in order:
+            size = text_length(entries[index])
+            if kept and size > budget:
+                break
+            budget -= size
+            kept.append(index)
+        first, last = min(kept), max(kept)
+        if ascending and first > 0:
+            newer = history[first]['id']
+        if not ascending and last < len(history) - 1:
+            older = history[last]['id']
+        return header + "".join(entries[first:last + 1]), newer, older
+
+renderer = HistoryRenderer(
+    db,
+    cache_size=config.get('HISTORY_CACHE_SIZE', 2000),
+    cache_ttl=config.get('HISTORY_CACHE_TTL', 600)
+)
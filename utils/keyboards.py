@@ -1,33 +1,45 @@
+from typing import Optional
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from utils.callbacks import (ALL_DIALOGS, BROADCAST, DIALOG_HISTORY, MAIN_MENU, MANAGE_ADMINS, PROFILE, REPLY, SEARCH,
+                             WRITE_MESSAGE)
 
 def get_main_keyboard(is_admin: bool = False) -> InlineKeyboardMarkup:
     keyboard = InlineKeyboardMarkup(row_width=2)
     if not is_admin:
         keyboard.add(
-            InlineKeyboardButton("📝 Написать сообщение", callback_data="write_message"),
-            InlineKeyboardButton("📋 История диалогов", callback_data="dialog_history")
+            InlineKeyboardButton("📝 Написать сообщение", callback_data=WRITE_MESSAGE.new()),
+            InlineKeyboardButton("📋 История диалогов", callback_data=DIALOG_HISTORY.new())
         )
-    keyboard.add(InlineKeyboardButton("👤 Мой профиль", callback_data="profile"))
+    keyboard.add(InlineKeyboardButton("👤 Мой профиль", callback_data=PROFILE.new()))
     if is_admin:
         keyboard.add(
-            InlineKeyboardButton("👥 Все диалоги", callback_data="all_dialogs"),
-            InlineKeyboardButton("👑 Управление админами", callback_data="manage_admins"),
+            InlineKeyboardButton("👥 Все диалоги", callback_data=ALL_DIALOGS.new()),
+            InlineKeyboardButton("👑 Управление админами", callback_data=MANAGE_ADMINS.new()),
+        )
+        keyboard.add(
+            InlineKeyboardButton("🔍 Поиск по сообщениям", callback_data=SEARCH.new()),
+            InlineKeyboardButton("📣 Рассылка", callback_data=BROADCAST.new()),
         )
     return keyboard
 
-def get_dialog_navigation_keyboard(current_page: int, total_pages: int) -> InlineKeyboardMarkup:
-    keyboard = InlineKeyboardMarkup(row_width=3)
+def get_dialog_navigation_keyboard(prefix: str, newer_cursor: Optional[int] = None, older_cursor: Optional[int] = None,
+                                   keyboard: Optional[InlineKeyboardMarkup] = None, main_menu: bool = True) -> InlineKeyboardMarkup:
+    # Курсоры кодируются прямо в callback_data: {prefix}_n_<id> — новее, {prefix}_o_<id> — старше;
+    # prefix — callback_data листаемой схемы из utils.callbacks без курсора
+    if keyboard is None:
+        keyboard = InlineKeyboardMarkup(row_width=3)
     buttons = []
-    if current_page > 0:
-        buttons.append(InlineKeyboardButton("⬅️", callback_data=f"page_{current_page - 1}"))
-    buttons.append(InlineKeyboardButton(f"{current_page + 1}/{total_pages}", callback_data="current_page"))
-    if current_page < total_pages - 1:
-        buttons.append(InlineKeyboardButton("➡️", callback_data=f"page_{current_page + 1}"))
-    keyboard.add(*buttons)
-    keyboard.add(InlineKeyboardButton("🔙 Главное меню", callback_data="main_menu"))
+    if newer_cursor is not None:
+        buttons.append(InlineKeyboardButton("⬅️", callback_data=f"{prefix}_n_{newer_cursor}"))
+    if older_cursor is not None:
+        buttons.append(InlineKeyboardButton("➡️", callback_data=f"{prefix}_o_{older_cursor}"))
+    if buttons:
+        keyboard.row(*buttons)
+    if main_menu:
+        keyboard.add(InlineKeyboardButton("🔙 Главное меню", callback_data=MAIN_MENU.new()))
     return keyboard
 
 def get_admin_message_keyboard(user_id: int) -> InlineKeyboardMarkup:
     keyboard = InlineKeyboardMarkup(row_width=2)
-    keyboard.add(InlineKeyboardButton("✍️ Ответить", callback_data=f"reply_{user_id}"))
+    keyboard.add(InlineKeyboardButton("✍️ Ответить", callback_data=REPLY.new(user_id=user_id)))
     return keyboard
\ No newline at end of file
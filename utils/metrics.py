@@ -0,0 +1,329 @@
+import asyncio
+import contextvars
+import inspect
+import json
+import logging
+import time
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aiogram import Dispatcher, types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import web
+
+with open('config.json', 'r') as f:
+    config = json.load(f)
+
+log = logging.getLogger(__name__)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+# Границы бакетов гистограмм в секундах
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Метод Database, внутри которого сейчас выполняется код, — им подписывается ожидание соединения
+_db_method: contextvars.ContextVar[str] = contextvars.ContextVar('db_method', default='-')
+# Хендлер текущего апдейта — его ищет errors_handler, когда считает исключения
+_handler_name: contextvars.ContextVar[str] = contextvars.ContextVar('handler_name', default='-')
+
+METRICS = {
+    "feedback_handler_seconds": ("histogram", "Время работы хендлера"),
+    "feedback_handler_exceptions_total": ("counter", "Необработанные исключения в хендлерах"),
+    "feedback_db_query_seconds": ("histogram", "Время выполнения метода Database"),
+    "feedback_db_rows_total": ("counter", "Строки, возвращённые методом Database"),
+    "feedback_db_errors_total": ("counter", "Исключения в методах Database"),
+    "feedback_db_connection_wait_seconds": ("histogram", "Ожидание соединения (read, write) или фиксации group commit (batch)"),
+    "feedback_bot_api_seconds": ("histogram", "Время запроса к Bot API"),
+    "feedback_bot_api_errors_total": ("counter", "Ошибки запросов к Bot API"),
+    "feedback_db_cache": ("gauge", "Счётчики кэша флагов пользователей"),
+    "feedback_updates_dedup": ("gauge", "Апдейты: обработанные, пропущенные как повторы (по памяти и по БД), в работе"),
+    "feedback_db_loader": ("gauge", "Склеивание чтений пользователей: загрузки, присоединившиеся к чужому запросу, запросы"),
+    "feedback_throttling": ("gauge", "Отброшенные лимитом апдейты и число отслеживаемых пользователей"),
+    "feedback_workers": ("gauge", "Воркеры в режиме WORKERS > 1: живость, очередь, обработанные апдейты"),
+}
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Оценка сверху: граница бакета, в который попала q-я доля наблюдений
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+def handler_name(data: dict) -> str:
+    # Имя хендлера после фильтров (в process_*). Колбэки идут через общий CallbackRouter —
+    # настоящий хендлер лежит в найденном маршруте
+    route = data.get('callback_route')
+    handler = route.handler if route is not None else current_handler.get()
+    return f"{handler.__module__.rsplit('.', 1)[-1]}.{handler.__name__}"
+
+def _rows(result) -> int:
+    # Методы Database возвращают список строк, страницу (строки, курсоры...), одну запись или None
+    if result is None:
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, tuple) and result and isinstance(result[0], list):
+        return len(result[0])
+    return 1
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+def _format_value(value: float) -> str:
+    return "+Inf" if value == float('inf') else repr(float(value))
+
+class Metrics:
+    # Счётчики и гистограммы в памяти процесса. Отдаются в формате Prometheus на /metrics
+    # и раз в log_interval секунд сводкой в лог.
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, log_interval: float = 0):
+        self.host = host
+        self.port = port
+        self.log_interval = log_interval
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.gauges: Dict[str, Callable[[], Dict[Labels, float]]] = {}
+        self._runner: Optional[web.AppRunner] = None
+        self._log_task: Optional[asyncio.Task] = None
+
+    def inc(self, name: str, labels: Labels, value: float = 1) -> None:
+        series = self.counters.setdefault(name, {})
+        series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, labels: Labels, value: float) -> None:
+        series = self.histograms.setdefault(name, {})
+        histogram = series.get(labels)
+        if histogram is None:
+            histogram = series[labels] = Histogram()
+        histogram.observe(value)
+
+    def setup(self, dp: Dispatcher) -> None:
+        dp.middleware.setup(MetricsMiddleware(self))
+        dp.register_errors_handler(self._on_error)
+
+    async def _on_error(self, update: types.Update, exception: Exception):
+        # Ничего не возвращаем — исключение идёт дальше, как и без метрик
+        self.inc("feedback_handler_exceptions_total",
+                 (("handler", _handler_name.get()), ("exception", type(exception).__name__)))
+
+    def instrument_database(self, database) -> None:
+        # Оборачивает публичные корутины и выдачу соединений конкретного экземпляра Database
+        for name, method in inspect.getmembers(database, inspect.iscoroutinefunction):
+            if not name.startswith('_'):
+                setattr(database, name, self._timed_db_method(name, method))
+        database._read = self._timed_connection(database._read, "read")
+        database._write = self._timed_connection(database._write, "write")
+        database._batched = self._timed_batch(database._batched)
+        self.gauges["feedback_db_cache"] = lambda: {
+            (("kind", key),): value for key, value in database.cache.stats().items()
+        }
+        self.gauges["feedback_db_loader"] = lambda: {
+            (("loader", name), ("kind", key)): value
+            for name, loader in (("users", database._users_loader), ("flags", database._flags_loader))
+            for key, value in loader.stats().items()
+        }
+
+    def _timed_db_method(self, name: str, method):
+        labels = (("method", name),)
+
+        async def wrapper(*args, **kwargs):
+            token = _db_method.set(name)
+            started = time.perf_counter()
+            try:
+                result = await method(*args, **kwargs)
+            except Exception:
+                self.inc("feedback_db_errors_total", labels)
+                raise
+            finally:
+                self.observe("feedback_db_query_seconds", labels, time.perf_counter() - started)
+                _db_method.reset(token)
+            self.inc("feedback_db_rows_total", labels, _rows(result))
+            return result
+        return wrapper
+
+    def _timed_connection(self, factory, kind: str):
+        @asynccontextmanager
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            async with factory(*args, **kwargs) as conn:
+                self.observe("feedback_db_connection_wait_seconds",
+                             (("method", _db_method.get()), ("kind", kind)), time.perf_counter() - started)
+                yield conn
+        return wrapper
+
+    def _timed_batch(self, batched):
+        async def wrapper(op):
+            started = time.perf_counter()
+            try:
+                return await batched(op)
+            finally:
+                self.observe("feedback_db_connection_wait_seconds",
+                             (("method", _db_method.get()), ("kind", "batch")), time.perf_counter() - started)
+        return wrapper
+
+    def instrument_dedup(self, middleware) -> None:
+        self.gauges["feedback_updates_dedup"] = lambda: {
+            (("kind", key),): value for key, value in middleware.stats().items()
+        }
+
+    def instrument_throttling(self, middleware) -> None:
+        self.gauges["feedback_throttling"] = lambda: {
+            (("kind", key),): value for key, value in middleware.stats().items()
+        }
+
+    def instrument_supervisor(self, supervisor) -> None:
+        self.gauges["feedback_workers"] = supervisor.stats
+
+    def instrument_bot(self, bot) -> None:
+        # Все методы Bot (send_message, edit_message_text, ...) в итоге идут через bot.request
+        request = bot.request
+
+        async def timed_request(method, data=None, files=None, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await request(method, data, files, **kwargs)
+            except Exception as e:
+                self.inc("feedback_bot_api_errors_total", (("method", method), ("exception", type(e).__name__)))
+                raise
+            finally:
+                self.observe("feedback_bot_api_seconds", (("method", method),), time.perf_counter() - started)
+        bot.request = timed_request
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for name, (kind, help_text) in METRICS.items():
+            if kind == "histogram":
+                series = self.histograms.get(name)
+            elif kind == "counter":
+                series = self.counters.get(name)
+            else:
+                series = self.gauges[name]() if name in self.gauges else None
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(series.items()):
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(value.buckets + (float('inf'),), value.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', _format_value(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value.sum)}")
+                lines.append(f"{name}_count{_format_labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self, top: int = 10) -> str:
+        lines = []
+        titles = (
+            ("feedback_handler_seconds", "Хендлеры"),
+            ("feedback_db_query_seconds", "Database"),
+            ("feedback_bot_api_seconds", "Bot API"),
+        )
+        for name, title in titles:
+            series = self.histograms.get(name, {})
+            if not series:
+                continue
+            lines.append(f"{title} (по суммарному времени):")
+            ranked = sorted(series.items(), key=lambda item: item[1].sum, reverse=True)[:top]
+            for labels, histogram in ranked:
+                lines.append(
+                    f"  {labels[0][1]:32} n={histogram.count:<7} total={histogram.sum:8.2f}s "
+                    f"p50<={histogram.quantile(0.5) * 1000:.1f}ms p95<={histogram.quantile(0.95) * 1000:.1f}ms"
+                )
+        for name in ("feedback_handler_exceptions_total", "feedback_db_errors_total", "feedback_bot_api_errors_total"):
+            for labels, value in sorted(self.counters.get(name, {}).items()):
+                lines.append(f"  {name}{_format_labels(labels)} = {value:.0f}")
+        return "\n".join(lines)
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=self.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Prometheus-Format": "0.0.4"})
+
+    async def _log_summary(self) -> None:
+        while True:
+            await asyncio.sleep(self.log_interval)
+            report = self.summary()
+            if report:
+                log.info("Метрики за всё время работы:\n%s", report)
+
+    async def start(self) -> None:
+        if self.port and self._runner is None:
+            app = web.Application()
+            app.router.add_get('/metrics', self._handle_metrics)
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, self.host, self.port).start()
+            log.info("Метрики доступны на http://%s:%s/metrics", self.host, self.port)
+        if self.log_interval and self._log_task is None:
+            self._log_task = asyncio.create_task(self._log_summary())
+
+    async def stop(self) -> None:
+        if self._log_task is not None:
+            self._log_task.cancel()
+            try:
+                await self._log_task
+            except asyncio.CancelledError:
+                pass
+            self._log_task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+class MetricsMiddleware(BaseMiddleware):
+    # process_* вызывается уже после фильтров, когда известен хендлер; post_process — в finally,
+    # поэтому время пишется и для упавших хендлеров
+    def __init__(self, metrics: Metrics):
+        super().__init__()
+        self.metrics = metrics
+
+    def _started(self, data: dict) -> None:
+        name = handler_name(data)
+        _handler_name.set(name)
+        data['_metrics_handler'] = name
+        data['_metrics_started'] = time.perf_counter()
+
+    def _finished(self, data: dict) -> None:
+        if '_metrics_started' in data:
+            self.metrics.observe("feedback_handler_seconds", (("handler", data['_metrics_handler']),),
+                                 time.perf_counter() - data['_metrics_started'])
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self._started(data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._finished(data)
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        self._started(data)
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        self._finished(data)
+
+metrics = Metrics(
+    host=config.get('METRICS_HOST', '127.0.0.1'),
+    port=config.get('METRICS_PORT', 0),
+    log_interval=config.get('METRICS_LOG_INTERVAL', 300)
+)
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.utils.exceptions import NetworkError, RestartingTelegram, RetryAfter, TelegramAPIError
+
+from database.db import Database, Outgoing, db as default_db
+from utils.ratelimit import ChatRateLimiter
+
+with open('config.json', 'r') as f:
+    config = json.load(f)
+
+log = logging.getLogger(__name__)
+
+# Общий лимит Bot API на процесс: его делят outbox и рассылки
+limiter = ChatRateLimiter(config.get('RATE_LIMIT_GLOBAL', 30), config.get('RATE_LIMIT_PER_CHAT', 1))
+
+def outgoing(chat_id: int, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> Outgoing:
+    return chat_id, text, reply_markup.as_json() if reply_markup else None
+
+class OutboxWorker:
+    # Фоновый пул, который вычитывает таблицу outbox пачками и доставляет сообщения с повторами.
+    # Сообщение удаляется только после успешной отправки, поэтому рестарт бота ничего не теряет.
+    def __init__(self, database: Database, limiter: ChatRateLimiter, workers: int = 8, batch_size: int = 50,
+                 max_attempts: int = 5, backoff: float = 1.0, poll_interval: float = 1.0,
+                 dead_ttl: float = 7 * 86400, purge_interval: float = 3600):
+        self.db = database
+        self.limiter = limiter
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        # Недоставленные (dead) сообщения хранятся dead_ttl секунд для разбора, потом удаляются
+        self.dead_ttl = dead_ttl
+        self.purge_interval = purge_interval
+        self._purged = 0.0
+        # (номер, всего) в режиме нескольких процессов — см. Database.claim_outbox
+        self.shard: Optional[Tuple[int, int]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, bot) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, bot) -> None:
+        while True:
+            try:
+                await self._purge_dead()
+                delivered = await self.drain_once(bot)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Ошибка обработки outbox")
+                delivered = 0
+            if delivered:
+                continue
+            self.db.outbox_ready.clear()
+            try:
+                await asyncio.wait_for(self.db.outbox_ready.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _purge_dead(self) -> None:
+        now = time.time()
+        if self.dead_ttl and now - self._purged >= self.purge_interval:
+            self._purged = now
+            removed = await self.db.purge_dead_outbox(int((now - self.dead_ttl) * 1000))
+            if removed:
+                log.info("Удалено недоставленных сообщений outbox: %s", removed)
+
+    async def drain_once(self, bot) -> int:
+        batch = await self.db.claim_outbox(self.batch_size, self.shard)
+        if not batch:
+            return 0
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def deliver(item: Dict) -> Optional[int]:
+            async with semaphore:
+                return await self._deliver(bot, item)
+
+        results = await asyncio.gather(*(deliver(item) for item in batch))
+        sent: List[int] = [outbox_id for outbox_id in results if outbox_id is not None]
+        if sent:
+            await self.db.outbox_sent(sent)
+        return len(batch)
+
+    async def _deliver(self, bot, item: Dict) -> Optional[int]:
+        await self.limiter.acquire(item['chat_id'])
+        try:
+            await bot.send_message(item['chat_id'], item['text'], reply_markup=item['reply_markup'])
+            return item['id']
+        except RetryAfter as e:
+            await self.db.outbox_retry(item['id'], e.timeout, str(e), count_attempt=False)
+        except (NetworkError, RestartingTelegram, asyncio.TimeoutError) as e:
+            if item['attempts'] + 1 >= self.max_attempts:
+                await self.db.outbox_dead(item['id'], str(e))
+            else:
+                await self.db.outbox_retry(item['id'], self.backoff * 2 ** item['attempts'], str(e))
+        except TelegramAPIError as e:
+            # BotBlocked, ChatNotFound и т.п. — повтор не поможет, откладываем в dead-letter
+            log.info("Сообщение %s для чата %s не доставлено: %s", item['id'], item['chat_id'], e)
+            await self.db.outbox_dead(item['id'], str(e))
+        return None
+
+outbox = OutboxWorker(
+    default_db,
+    limiter,
+    workers=config.get('OUTBOX_WORKERS', 8),
+    batch_size=config.get('OUTBOX_BATCH_SIZE', 50),
+    max_attempts=config.get('OUTBOX_MAX_ATTEMPTS', 5),
+    dead_ttl=config.get('OUTBOX_DEAD_TTL', 604800)
+)
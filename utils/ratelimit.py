@@ -0,0 +1,64 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        while not self.try_acquire(tokens):
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    @property
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+class BucketTable:
+    # Бакеты по ключу с ограничением памяти: сверх max_size вытесняются давно не использованные.
+    # Заново созданный бакет полон, так что потеря состояния безопасна.
+    def __init__(self, rate: float, capacity: float = 1.0, max_size: int = 10000):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_size = max_size
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+
+    def get(self, key: Hashable) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        self._buckets.move_to_end(key)
+        return bucket
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+class ChatRateLimiter:
+    # Лимиты Telegram: ~30 сообщений/сек на бота и ~1 сообщение/сек в один чат. Один экземпляр на процесс
+    # (utils.outbox.limiter) делят воркер outbox и рассылки.
+    def __init__(self, global_rate: float = 30.0, per_chat_rate: float = 1.0, max_chats: int = 10000):
+        self.global_bucket = TokenBucket(global_rate, capacity=global_rate)
+        self._chats = BucketTable(per_chat_rate, max_size=max_chats)
+
+    async def acquire(self, chat_id: Hashable) -> None:
+        await self._chats.get(chat_id).acquire()
+        await self.global_bucket.acquire()
@@ -0,0 +1,67 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Optional
+
+from database.db import Database, db as default_db
+
+with open('config.json', 'r') as f:
+    config = json.load(f)
+
+log = logging.getLogger(__name__)
+
+class RetentionWorker:
+    # Фоновый перенос старых сообщений в архив. Возраст берётся из messages.date, так что на уже наполненной
+    # БД старые сообщения начинают уходить в архив с первого прохода. Переносит пачками
+    # по batch_size с паузой между пачками, чтобы не держать писателя подолгу и пропускать вперёд запись из хендлеров.
+    def __init__(self, database: Database, after_days: float = 90, batch_size: int = 500, interval: float = 60,
+                 pause: float = 0.05):
+        self.db = database
+        self.after_days = after_days
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pause = pause
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None and self.db.archive_name:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                moved = await self.run_once()
+                if moved:
+                    log.info("В архив перенесено сообщений: %s", moved)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Ошибка архивации сообщений")
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self) -> int:
+        older_than = int((time.time() - self.after_days * 86400) * 1000)
+        moved = 0
+        while True:
+            count = await self.db.archive_messages(older_than, self.batch_size)
+            moved += count
+            if count < self.batch_size:
+                return moved
+            await asyncio.sleep(self.pause)
+
+retention = RetentionWorker(
+    default_db,
+    after_days=config.get('ARCHIVE_AFTER_DAYS', 90),
+    batch_size=config.get('ARCHIVE_BATCH_SIZE', 500),
+    interval=config.get('ARCHIVE_INTERVAL', 60)
+)
@@ -0,0 +1,54 @@
+import itertools
+import json
+import zlib
+from typing import List, Optional
+
+from database.db import Database, db
+
+with open('config.json', 'r') as f:
+    config = json.load(f)
+
+STRATEGIES = ("least_open", "round_robin", "sticky")
+
+class Router:
+    # Закрепляет диалог пользователя за одним админом. Выбор делается один раз, при первом сообщении,
+    # дальше работает сохранённое закрепление — пока его админ остаётся админом.
+    #   least_open  — админ с наименьшим числом диалогов, ждущих ответа
+    #   round_robin — по кругу
+    #   sticky      — rendezvous-хеш от (user_id, admin_id): при смене состава админов переезжает минимум пользователей
+    def __init__(self, database: Database, strategy: str = "least_open", watchers: Optional[List[int]] = None):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Неизвестная стратегия маршрутизации: {strategy}")
+        self.db = database
+        self.strategy = strategy
+        self.watchers = list(watchers or [])
+        self._round_robin = itertools.count()
+
+    async def _choose(self, user_id: int, admin_ids: List[int]) -> int:
+        admin_ids = sorted(admin_ids)
+        if self.strategy == "round_robin":
+            return admin_ids[next(self._round_robin) % len(admin_ids)]
+        if self.strategy == "sticky":
+            return max(admin_ids, key=lambda admin_id: zlib.crc32(f"{user_id}:{admin_id}".encode()))
+        counts = await self.db.get_open_counts(admin_ids)
+        return min(admin_ids, key=lambda admin_id: counts[admin_id])
+
+    async def route(self, user_id: int) -> Optional[int]:
+        admin_ids = await self.db.get_all_admins()
+        if not admin_ids:
+            return None
+        current = await self.db.get_assignment(user_id)
+        if current in admin_ids:
+            return current
+        return await self.db.assign_conversation(user_id, await self._choose(user_id, admin_ids), current)
+
+    async def recipients(self, admin_id: int) -> List[int]:
+        # Ответственный и наблюдатели из ROUTING_WATCHERS, если они всё ещё админы
+        admin_ids = set(await self.db.get_all_admins())
+        return [admin_id] + [watcher for watcher in self.watchers if watcher != admin_id and watcher in admin_ids]
+
+router = Router(
+    db,
+    strategy=config.get('ROUTING_STRATEGY', 'least_open'),
+    watchers=config.get('ROUTING_WATCHERS', [])
+)
@@ -0,0 +1,72 @@
+import json
+import logging
+from typing import Dict
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import TelegramAPIError
+
+from database.db import Database, db as default_db
+from utils.ratelimit import BucketTable
+
+with open('config.json', 'r') as f:
+    config = json.load(f)
+
+log = logging.getLogger(__name__)
+
+class ThrottlingMiddleware(BaseMiddleware):
+    # Ограничение частоты апдейтов от одного пользователя: отдельные token bucket на сообщения и на колбэки.
+    # Проверка идёт в pre_process — до фильтров и чтения состояния FSM, так что отброшенный апдейт не трогает БД.
+    # Админы не ограничиваются; их флаг (кэшированный) проверяется, только когда бакет уже пуст.
+    def __init__(self, database: Database, message_rate: float = 1.0, message_burst: float = 5,
+                 callback_rate: float = 2.0, callback_burst: float = 10, max_users: int = 10000,
+                 warn_interval: float = 10.0):
+        super().__init__()
+        self.db = database
+        self.messages = BucketTable(message_rate, message_burst, max_users)
+        self.callbacks = BucketTable(callback_rate, callback_burst, max_users)
+        # Предупреждение о лимите — не чаще раза в warn_interval секунд, чтобы не спамить в ответ
+        self.warnings = BucketTable(1 / warn_interval, 1, max_users)
+        self.throttled = {"message": 0, "callback": 0}
+
+    async def _allowed(self, table: BucketTable, user_id: int) -> bool:
+        return table.get(user_id).try_acquire() or await self.db.is_user_admin(user_id)
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        if message.from_user is None or await self._allowed(self.messages, message.from_user.id):
+            return
+        self.throttled["message"] += 1
+        if self.warnings.get(message.from_user.id).try_acquire():
+            try:
+                await message.answer("⏳ Слишком много сообщений подряд. Подождите немного и повторите.")
+            except TelegramAPIError as e:
+                log.debug("Не удалось предупредить %s о лимите: %s", message.from_user.id, e)
+        raise CancelHandler()
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        if await self._allowed(self.callbacks, callback_query.from_user.id):
+            return
+        self.throttled["callback"] += 1
+        # Колбэк всё равно нужно подтвердить, иначе у кнопки крутятся часики; это единственный вызов API
+        try:
+            await callback_query.answer("⏳ Слишком часто, подождите секунду")
+        except TelegramAPIError as e:
+            log.debug("Не удалось ответить на колбэк %s: %s", callback_query.id, e)
+        raise CancelHandler()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "throttled_message": self.throttled["message"],
+            "throttled_callback": self.throttled["callback"],
+            "tracked_users": max(len(self.messages), len(self.callbacks)),
+        }
+
+throttling = ThrottlingMiddleware(
+    default_db,
+    message_rate=config.get('THROTTLE_MESSAGE_RATE', 1),
+    message_burst=config.get('THROTTLE_MESSAGE_BURST', 5),
+    callback_rate=config.get('THROTTLE_CALLBACK_RATE', 2),
+    callback_burst=config.get('THROTTLE_CALLBACK_BURST', 10),
+    max_users=config.get('THROTTLE_MAX_USERS', 10000)
+)
@@ -0,0 +1,352 @@
+import asyncio
+import contextvars
+import inspect
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from aiogram import Dispatcher, types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from utils.metrics import handler_name
+
+with open('config.json', 'r') as f:
+    config = json.load(f)
+
+log = logging.getLogger(__name__)
+
+# Глубина стека в профиле медленного апдейта: всё, что глубже, обрезается со стороны цикла событий
+MAX_STACK_DEPTH = 64
+
+class Trace:
+    # Спаны одного апдейта в формате Chrome trace (события "X"). Каждый апдейт — своя дорожка (tid = update_id),
+    # так что параллельные апдейты в Perfetto / chrome://tracing не накладываются друг на друга.
+    def __init__(self, update_id: int, origin: float, origin_us: float):
+        self.update_id = update_id
+        self.origin = origin
+        self.origin_us = origin_us
+        self.started = time.perf_counter()
+        self.handler: Optional[str] = None
+        self.events: List[Dict] = []
+
+    def add(self, name: str, category: str, started: float, finished: float, **args) -> None:
+        self.events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round(self.origin_us + (started - self.origin) * 1e6, 1),
+            "dur": round((finished - started) * 1e6, 1),
+            "pid": os.getpid(),
+            "tid": self.update_id,
+            "args": {key: value for key, value in args.items() if value is not None},
+        })
+
+# Трасса апдейта, который сейчас обрабатывается в этой задаче; None — апдейт не попал в выборку
+_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar('trace', default=None)
+
+def _fold(frames) -> str:
+    # Стек в «свёрнутом» виде для flamegraph.pl / speedscope: от внешнего вызова к внутреннему через ";"
+    return ";".join(
+        f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+        for frame in frames[-MAX_STACK_DEPTH:]
+    )
+
+def _thread_stack(frame) -> List:
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    return frames[::-1]
+
+def _await_stack(task: asyncio.Task) -> List:
+    # Где задача ждёт: цепочка cr_await от корутины задачи до самой глубокой приостановленной корутины
+    frames = []
+    coro = task.get_coro()
+    while coro is not None and getattr(coro, "cr_frame", None) is not None:
+        frames.append(coro.cr_frame)
+        coro = coro.cr_await
+    return frames
+
+class _Slow:
+    __slots__ = ("update_id", "started", "running", "waiting")
+
+    def __init__(self, update_id: int):
+        self.update_id = update_id
+        self.started = time.perf_counter()
+        self.running: Counter = Counter()
+        self.waiting: Counter = Counter()
+
+class SlowUpdateProfiler:
+    # Сэмплирующий профайлер только для медленных апдейтов: пока апдейт быстрее порога, он ничего не стоит.
+    # Дальше каждые interval секунд снимаются два вида стеков:
+    #  - running: поток цикла событий из отдельного потока — ловит CPU и блокирующие вызовы внутри хендлера.
+    #    Чья это задача, определяется по стеку: у выполняющейся задачи кадр её корутины лежит в стеке потока
+    #    (внутреннее состояние цикла событий из чужого потока не читаем);
+    #  - waiting: точка, где задача апдейта ждёт (cr_await), — снимается из самого цикла, пока задача стоит.
+    # После обработки стеки апдейта дольше порога пишутся в directory в свёрнутом формате.
+    def __init__(self, threshold: float, interval: float = 0.005, directory: str = "profiles"):
+        self.threshold = threshold
+        self.interval = interval
+        self.directory = directory
+        self._updates: Dict[asyncio.Task, _Slow] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._waits: Optional[asyncio.Task] = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._sample_running, args=(threading.get_ident(),),
+                                        name="slow-update-profiler", daemon=True)
+        self._thread.start()
+        self._waits = asyncio.create_task(self._sample_waiting())
+
+    async def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._waits.cancel()
+        await asyncio.gather(self._waits, return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(None, self._thread.join)
+        self._thread = None
+
+    def track(self, update_id: int) -> None:
+        task = asyncio.current_task()
+        if task is not None:
+            self._updates[task] = _Slow(update_id)
+
+    def untrack(self) -> None:
+        slow = self._updates.pop(asyncio.current_task(), None)
+        if slow is None:
+            return
+        elapsed = time.perf_counter() - slow.started
+        if elapsed >= self.threshold and (slow.running or slow.waiting):
+            self._dump(slow, elapsed)
+
+    def _slow(self) -> Dict[asyncio.Task, _Slow]:
+        deadline = time.perf_counter() - self.threshold
+        try:
+            return {task: slow for task, slow in list(self._updates.items()) if slow.started <= deadline}
+        except RuntimeError:
+            # Словарь поменялся под потоком сэмплера — пропускаем один замер
+            return {}
+
+    def _sample_running(self, loop_thread: int) -> None:
+        while not self._stopped.wait(self.interval):
+            slow = self._slow()
+            if not slow:
+                continue
+            frame = sys._current_frames().get(loop_thread)
+            if frame is None:
+                continue
+            stack = _thread_stack(frame)
+            on_stack = {id(frame) for frame in stack}
+            for task, update in slow.items():
+                if id(getattr(task.get_coro(), "cr_frame", None)) in on_stack:
+                    update.running[_fold(stack)] += 1
+                    break
+
+    async def _sample_waiting(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            for task, slow in self._slow().items():
+                if not task.done():
+                    slow.waiting[_fold(_await_stack(task))] += 1
+
+    def _dump(self, slow: _Slow, elapsed: float) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"update-{slow.update_id}-{os.getpid()}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for kind, stacks in (("running", slow.running), ("waiting", slow.waiting)):
+                for stack, count in stacks.most_common():
+                    f.write(f"{kind};{stack} {count}\n")
+        top = (slow.running + slow.waiting).most_common(1)
+        log.warning("Медленный апдейт %s: %.0f мс, стеки в %s; чаще всего: %s",
+                    slow.update_id, elapsed * 1000, path, top[0][0].rsplit(";", 1)[-1] if top else "—")
+
+class Tracer:
+    # Выборочная трассировка апдейтов: корневой спан на апдейт, вложенные — хендлер, методы Database и запросы
+    # к Bot API. Трассы дописываются в файл в формате Chrome trace (JSON-массив событий без закрывающей скобки —
+    # так его читают Perfetto и chrome://tracing), его можно открыть, не останавливая бота.
+    # Апдейты вне выборки проходят через обёртки с одной проверкой contextvar. Готовые трассы копятся в памяти
+    # и раз в flush_interval пишутся в файл в потоке, чтобы диск не задерживал цикл событий; сверх max_pending
+    # неписанных трасс новые отбрасываются.
+    def __init__(self, path: str = "feedback_trace.json", sample_rate: float = 0.0,
+                 profiler: Optional[SlowUpdateProfiler] = None, flush_interval: float = 1.0,
+                 max_pending: int = 10000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.profiler = profiler
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.traced = 0
+        self.dropped = 0
+        self._file = None
+        self._pending: List[List[Dict]] = []
+        self._flusher: Optional[asyncio.Task] = None
+        # Общая точка отсчёта: perf_counter для длительностей, время эпохи — чтобы трассы процессов совпадали по оси
+        self._origin = time.perf_counter()
+        self._origin_us = time.time() * 1e6
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or self.profiler is not None
+
+    def setup(self, dp: Dispatcher) -> None:
+        if self.enabled:
+            dp.middleware.setup(TracingMiddleware(self))
+
+    def instrument_database(self, database) -> None:
+        if not self.sample_rate:
+            return
+        for name, method in inspect.getmembers(database, inspect.iscoroutinefunction):
+            if not name.startswith('_'):
+                setattr(database, name, self._traced(f"db.{name}", "db", method))
+
+    def instrument_bot(self, bot) -> None:
+        if not self.sample_rate:
+            return
+        request = bot.request
+
+        async def traced_request(method, data=None, files=None, **kwargs):
+            return await self._traced(f"bot.{method}", "bot_api", request)(method, data, files, **kwargs)
+        bot.request = traced_request
+
+    def _traced(self, name: str, category: str, method):
+        async def wrapper(*args, **kwargs):
+            trace = _trace.get()
+            if trace is None:
+                return await method(*args, **kwargs)
+            started = time.perf_counter()
+            error = None
+            try:
+                return await method(*args, **kwargs)
+            except BaseException as e:
+                error = type(e).__name__
+                raise
+            finally:
+                trace.add(name, category, started, time.perf_counter(), error=error)
+        return wrapper
+
+    def begin(self, update: types.Update) -> None:
+        if self.profiler is not None:
+            self.profiler.track(update.update_id)
+        if self.sample_rate and random.random() < self.sample_rate:
+            _trace.set(Trace(update.update_id, self._origin, self._origin_us))
+
+    def end(self, update: types.Update) -> None:
+        if self.profiler is not None:
+            self.profiler.untrack()
+        trace = _trace.get()
+        if trace is None:
+            return
+        _trace.set(None)
+        kind = next((key for key in update.values if key != "update_id"), None)
+        event = getattr(update, kind, None) if kind else None
+        sender = getattr(event, "from_user", None)
+        trace.add(f"update.{kind}", "update", trace.started, time.perf_counter(),
+                  update_id=update.update_id, user_id=sender.id if sender else None, handler=trace.handler)
+        if len(self._pending) >= self.max_pending:
+            self.dropped += 1
+            return
+        self._pending.append(trace.events)
+        self.traced += 1
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self._flush()
+            except OSError:
+                log.exception("Не удалось записать трассы в %s", self.path)
+
+    async def _flush(self) -> None:
+        if not self._pending:
+            return
+        traces, self._pending = self._pending, []
+        await asyncio.get_running_loop().run_in_executor(None, self._write, traces)
+
+    def _write(self, traces: List[List[Dict]]) -> None:
+        # Выполняется в потоке; вызовы идут строго по очереди из _flush
+        if self._file is None:
+            fresh = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            self._file = open(self.path, "a", encoding="utf-8")
+            if fresh:
+                self._file.write("[\n")
+        for events in traces:
+            # Корневой спан добавлен последним — пишем его первым, чтобы в файле апдейт читался сверху вниз
+            for event in events[-1:] + events[:-1]:
+                self._file.write(json.dumps(event, ensure_ascii=False) + ",\n")
+        self._file.flush()
+
+    async def start(self) -> None:
+        if self.profiler is not None:
+            self.profiler.start()
+        if self.sample_rate and self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        if self.profiler is not None:
+            await self.profiler.stop()
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+        await self._flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class TracingMiddleware(BaseMiddleware):
+    # Корневой спан — на уровне update (после дедупликации), спан хендлера — после фильтров, как у метрик
+    def __init__(self, tracer: Tracer):
+        super().__init__()
+        self.tracer = tracer
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        self.tracer.begin(update)
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        self.tracer.end(update)
+
+    def _started(self, data: dict) -> None:
+        if _trace.get() is not None:
+            # Имя берём здесь: к post_process aiogram уже сбрасывает current_handler
+            data['_trace_handler'] = handler_name(data)
+            data['_trace_started'] = time.perf_counter()
+
+    def _finished(self, data: dict) -> None:
+        trace = _trace.get()
+        if trace is None or '_trace_started' not in data:
+            return
+        trace.handler = data['_trace_handler']
+        trace.add(trace.handler, "handler", data['_trace_started'], time.perf_counter())
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self._started(data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._finished(data)
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        self._started(data)
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        self._finished(data)
+
+tracer = Tracer(
+    path=config.get('TRACE_FILE', 'feedback_trace.json'),
+    sample_rate=config.get('TRACE_SAMPLE_RATE', 0),
+    profiler=SlowUpdateProfiler(
+        config['TRACE_PROFILE_SLOW_MS'] / 1000,
+        interval=config.get('TRACE_PROFILE_INTERVAL_MS', 5) / 1000,
+        directory=config.get('TRACE_PROFILE_DIR', 'profiles')
+    ) if config.get('TRACE_PROFILE_SLOW_MS') else None
+)
@@ -0,0 +1,263 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot import api
+from aiohttp import web
+
+from database.db import Database
+
+log = logging.getLogger(__name__)
+
+# Сколько элементов воркер забирает из очереди за одно обращение к потоку
+DRAIN_LIMIT = 100
+
+def shard_of(update: Dict, workers: int) -> int:
+    # Апдейты одного пользователя всегда попадают в один процесс — там его FSM, лимиты и порядок обработки
+    for key, value in update.items():
+        if key != "update_id" and isinstance(value, dict):
+            sender = value.get("from") or value.get("user")
+            if sender:
+                return sender["id"] % workers
+    return 0
+
+def _drain(source) -> List:
+    # Выполняется в потоке: ждёт первый элемент и добирает то, что уже лежит в очереди
+    items = [source.get()]
+    while len(items) < DRAIN_LIMIT and items[-1] is not None:
+        try:
+            items.append(source.get_nowait())
+        except queue.Empty:
+            break
+    return items
+
+class WorkerHandle:
+    def __init__(self, index: int, inbox):
+        self.index = index
+        self.inbox = inbox
+        self.process: Optional[multiprocessing.Process] = None
+        # sent считает супервизор, остальное приходит в heartbeat воркера
+        self.sent = 0
+        self.received = 0
+        self.processed = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.heartbeat = 0.0
+        self.restarts = 0
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.sent - self.received)
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+class Supervisor:
+    # Принимает апдейты один раз (polling или webhook) и раскладывает их по процессам-воркерам по from_user.id.
+    # Воркеры раз в heartbeat_interval присылают счётчики, по ним считаются глубина очереди и живость; упавший
+    # воркер перезапускается. Изменения кэша в одном воркере пересылаются остальным.
+    def __init__(self, target: Callable, workers: int, heartbeat_interval: float = 5.0,
+                 heartbeat_timeout: float = 30.0, max_queue: int = 1000, report_interval: float = 60.0):
+        self.target = target
+        self.context = multiprocessing.get_context("spawn")
+        self.events = self.context.Queue()
+        self.workers = [WorkerHandle(index, self.context.Queue()) for index in range(workers)]
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_queue = max_queue
+        self.report_interval = report_interval
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        for worker in self.workers:
+            self._spawn(worker)
+        self._tasks = [asyncio.create_task(self._read_events()), asyncio.create_task(self._monitor())]
+
+    def _spawn(self, worker: WorkerHandle) -> None:
+        worker.sent, worker.received, worker.processed, worker.in_flight = 0, 0, 0, 0
+        worker.process = self.context.Process(
+            target=self.target,
+            args=(worker.index, len(self.workers), worker.inbox, self.events, self.heartbeat_interval),
+            name=f"feedback-worker-{worker.index}"
+        )
+        worker.process.start()
+        worker.heartbeat = time.monotonic()
+
+    def dispatch(self, update: Dict) -> None:
+        worker = self.workers[shard_of(update, len(self.workers))]
+        worker.inbox.put(("update", update))
+        worker.sent += 1
+
+    async def wait_capacity(self) -> None:
+        # Пока какой-то воркер не разобрал свою очередь, новые апдейты у Telegram не забираем
+        while any(worker.queued >= self.max_queue for worker in self.workers):
+            await asyncio.sleep(0.1)
+
+    async def _read_events(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            for event in await loop.run_in_executor(None, _drain, self.events):
+                if event is None:
+                    return
+                kind, index, payload = event
+                if kind == "health":
+                    worker = self.workers[index]
+                    if payload["pid"] != worker.process.pid:
+                        # Запоздавший heartbeat уже перезапущенного воркера
+                        continue
+                    worker.received = payload["received"]
+                    worker.processed = payload["processed"]
+                    worker.errors = payload["errors"]
+                    worker.in_flight = payload["in_flight"]
+                    worker.heartbeat = time.monotonic()
+                elif kind == "changed":
+                    for worker in self.workers:
+                        if worker.index != index:
+                            worker.inbox.put(("changed", payload))
+
+    async def _monitor(self) -> None:
+        reported = time.monotonic()
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            for worker in self.workers:
+                if not worker.alive:
+                    log.error("Воркер %s (pid %s) завершился с кодом %s, перезапуск",
+                              worker.index, worker.process.pid, worker.process.exitcode)
+                    # Убитый процесс мог оставить захваченной блокировку чтения очереди, поэтому очередь новая;
+                    # апдейты, которые не успел разобрать упавший воркер, теряются
+                    if worker.queued:
+                        log.error("Потеряно апдейтов из очереди воркера %s: %s", worker.index, worker.queued)
+                    worker.inbox = self.context.Queue()
+                    worker.restarts += 1
+                    self._spawn(worker)
+                elif now - worker.heartbeat > self.heartbeat_timeout:
+                    log.warning("Воркер %s не присылает heartbeat %.0f с, в очереди %s",
+                                worker.index, now - worker.heartbeat, worker.queued)
+            if self.report_interval and now - reported >= self.report_interval:
+                reported = now
+                log.info("Воркеры: %s", "; ".join(
+                    f"#{worker.index} pid={worker.process.pid} очередь={worker.queued} в работе={worker.in_flight} "
+                    f"обработано={worker.processed} ошибок={worker.errors}"
+                    for worker in self.workers
+                ))
+
+    def stats(self) -> Dict[Tuple[Tuple[str, str], ...], float]:
+        now = time.monotonic()
+        result = {}
+        for worker in self.workers:
+            healthy = worker.alive and now - worker.heartbeat <= self.heartbeat_timeout
+            for kind, value in (("up", int(healthy)), ("queued", worker.queued), ("in_flight", worker.in_flight),
+                                ("processed", worker.processed), ("errors", worker.errors),
+                                ("restarts", worker.restarts)):
+                result[(("worker", str(worker.index)), ("kind", kind))] = value
+        return result
+
+    async def stop(self, timeout: float = 30.0) -> None:
+        if not self._tasks:
+            # start() не вызывался или упал раньше, чем запустил задачи
+            return
+        reader, monitor = self._tasks
+        self._tasks = []
+        # Сначала монитор, чтобы он не перезапускал воркеры, которые выходят штатно
+        monitor.cancel()
+        await asyncio.gather(monitor, return_exceptions=True)
+        # None в очереди — воркер дорабатывает уже полученные апдейты и выходит
+        for worker in self.workers:
+            worker.inbox.put(None)
+        loop = asyncio.get_running_loop()
+        for worker in self.workers:
+            await loop.run_in_executor(None, worker.process.join, timeout)
+            if worker.process.is_alive():
+                log.warning("Воркер %s не завершился за %s с, останавливаем принудительно", worker.index, timeout)
+                worker.process.terminate()
+        self.events.put(None)
+        await reader
+
+    async def poll(self, bot: Bot, timeout: int = 20, error_sleep: float = 5.0) -> None:
+        # Тот же long polling, что у aiogram, но апдейты не разбираются в объекты — они уходят воркерам как есть
+        offset = None
+        request_timeout = aiohttp.ClientTimeout(total=timeout + 10)
+        while True:
+            await self.wait_capacity()
+            payload = {"timeout": timeout}
+            if offset is not None:
+                payload["offset"] = offset
+            try:
+                with bot.request_timeout(request_timeout):
+                    updates = await bot.request(api.Methods.GET_UPDATES, payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("Ошибка получения апдейтов")
+                await asyncio.sleep(error_sleep)
+                continue
+            for update in updates:
+                self.dispatch(update)
+            if updates:
+                offset = updates[-1]["update_id"] + 1
+
+    def create_webhook_app(self, path: str) -> web.Application:
+        async def receive(request: web.Request) -> web.Response:
+            self.dispatch(await request.json())
+            return web.Response()
+
+        app = web.Application()
+        app.router.add_post(path, receive)
+        return app
+
+async def serve(dp: Dispatcher, database: Database, index: int, inbox, events, heartbeat_interval: float) -> None:
+    # Цикл воркера: апдейты из очереди супервизора, каждый в своей задаче, как при polling в одном процессе.
+    # Свои изменения кэша воркер отправляет супервизору, чужие — применяет к своему Database.
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    loop = asyncio.get_running_loop()
+    counters = {"received": 0, "processed": 0, "errors": 0}
+    tasks = set()
+
+    def report() -> None:
+        events.put(("health", index, {**counters, "in_flight": len(tasks), "pid": os.getpid()}))
+
+    def finished(task: asyncio.Task) -> None:
+        tasks.discard(task)
+        counters["processed"] += 1
+        if not task.cancelled() and task.exception() is not None:
+            counters["errors"] += 1
+            log.error("Ошибка обработки апдейта", exc_info=task.exception())
+
+    async def heartbeat() -> None:
+        while True:
+            report()
+            await asyncio.sleep(heartbeat_interval)
+
+    database.on_change = lambda keys: events.put(("changed", index, keys))
+    beat = asyncio.create_task(heartbeat())
+    try:
+        stopping = False
+        while not stopping:
+            for item in await loop.run_in_executor(None, _drain, inbox):
+                if item is None:
+                    stopping = True
+                    break
+                kind, payload = item
+                if kind == "changed":
+                    database.forget(payload)
+                    continue
+                counters["received"] += 1
+                # Через updates_handler, как polling и webhook aiogram, — иначе не сработают middleware уровня update
+                task = asyncio.create_task(dp.updates_handler.notify(types.Update(**payload)))
+                tasks.add(task)
+                task.add_done_callback(finished)
+    finally:
+        beat.cancel()
+        if tasks:
+            await asyncio.wait(list(tasks), timeout=30)
+        database.on_change = None
+        report()